@@ -0,0 +1,202 @@
+import json
+import os
+import random
+import smtplib
+import threading
+import time
+from collections import deque
+from email.message import EmailMessage
+import requests
+from metrics import metrics
+
+# Consecutive failed probes before an UP monitor is marked DOWN, and
+# consecutive successful probes before a DOWN monitor is marked UP
+FLAP_FAILURES = max(1, int(os.getenv('FLAP_FAILURES', '1')))
+FLAP_SUCCESSES = max(1, int(os.getenv('FLAP_SUCCESSES', '1')))
+
+# Transitions buffered per sink; the oldest are dropped once it is full
+ALERT_QUEUE_SIZE = int(os.getenv('ALERT_QUEUE_SIZE', '10000'))
+# Transitions delivered to a sink in one call, and how long to wait for more
+ALERT_BATCH_SIZE = int(os.getenv('ALERT_BATCH_SIZE', '100'))
+ALERT_BATCH_INTERVAL_MS = int(os.getenv('ALERT_BATCH_INTERVAL_MS', '1000'))
+# Failed deliveries are retried with exponential backoff, then dropped
+ALERT_MAX_RETRIES = int(os.getenv('ALERT_MAX_RETRIES', '5'))
+ALERT_BACKOFF_SECONDS = float(os.getenv('ALERT_BACKOFF_SECONDS', '1'))
+ALERT_BACKOFF_MAX_SECONDS = float(os.getenv('ALERT_BACKOFF_MAX_SECONDS', '60'))
+
+# Sinks are enabled by configuring them
+ALERT_WEBHOOK_URL = os.getenv('ALERT_WEBHOOK_URL', '')
+ALERT_LOG_FILE = os.getenv('ALERT_LOG_FILE', '')
+ALERT_SMTP_HOST = os.getenv('ALERT_SMTP_HOST', '')
+ALERT_SMTP_PORT = int(os.getenv('ALERT_SMTP_PORT', '1025'))
+ALERT_SMTP_FROM = os.getenv('ALERT_SMTP_FROM', 'monitor@localhost')
+ALERT_SMTP_TO = os.getenv('ALERT_SMTP_TO', '')
+
+class FlapDetector:
+    # Tracks the run of probe results that disagree with a monitor's current
+    # status; the status only changes once the run is long enough
+
+    def __init__(self, failures=FLAP_FAILURES, successes=FLAP_SUCCESSES):
+        self.failures = failures
+        self.successes = successes
+        self._lock = threading.Lock()
+        self._streaks = {}
+
+    def observe(self, alert_name, current, probed):
+        # Returns the monitor's status after this probe result
+        with self._lock:
+            if probed == current:
+                self._streaks.pop(alert_name, None)
+                return current
+            status, count = self._streaks.get(alert_name, (probed, 0))
+            count = count + 1 if status == probed else 1
+            threshold = self.successes if probed == 'UP' else self.failures
+            if count >= threshold:
+                self._streaks.pop(alert_name, None)
+                return probed
+            self._streaks[alert_name] = (probed, count)
+            return current
+
+    def forget(self, alert_name):
+        with self._lock:
+            self._streaks.pop(alert_name, None)
+
+class WebhookSink:
+    name = 'webhook'
+
+    def __init__(self, url, timeout=(3, 10)):
+        self.url = url
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def send(self, events):
+        response = self.session.post(self.url, json={'events': events}, timeout=self.timeout)
+        response.raise_for_status()
+
+class LogFileSink:
+    name = 'logfile'
+
+    def __init__(self, path):
+        self.path = path
+
+    def send(self, events):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(''.join(json.dumps(event) + '\n' for event in events))
+
+class SMTPSink:
+    # One message per batch; pointed at a local relay or a debugging server
+    # such as `python -m aiosmtpd -n -l localhost:1025`
+    name = 'smtp'
+
+    def __init__(self, host, port, sender, recipients, timeout=10):
+        self.host = host
+        self.port = port
+        self.sender = sender
+        self.recipients = recipients
+        self.timeout = timeout
+
+    def send(self, events):
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = ', '.join(self.recipients)
+        if len(events) == 1:
+            message['Subject'] = f"{events[0]['AlertName']} is {events[0]['Status']}"
+        else:
+            message['Subject'] = f"{len(events)} monitor status changes"
+        message.set_content('\n'.join(
+            f"{e['CheckTime']}  {e['AlertName']}: {e['PreviousStatus']} -> {e['Status']}"
+            for e in events))
+        with smtplib.SMTP(self.host, self.port, timeout=self.timeout) as smtp:
+            smtp.send_message(message)
+
+def build_sinks():
+    sinks = []
+    if ALERT_WEBHOOK_URL:
+        sinks.append(WebhookSink(ALERT_WEBHOOK_URL))
+    if ALERT_LOG_FILE:
+        sinks.append(LogFileSink(ALERT_LOG_FILE))
+    if ALERT_SMTP_HOST and ALERT_SMTP_TO:
+        sinks.append(SMTPSink(ALERT_SMTP_HOST, ALERT_SMTP_PORT, ALERT_SMTP_FROM,
+                              [r.strip() for r in ALERT_SMTP_TO.split(',') if r.strip()]))
+    return sinks
+
+class SinkChannel:
+    # Bounded queue plus delivery thread for one sink, so a slow or failing
+    # target only ever delays its own alerts
+
+    def __init__(self, sink, queue_size, batch_size, interval):
+        self.sink = sink
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.dropped = 0
+        self._events = deque(maxlen=queue_size)
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def put(self, event):
+        with self._cond:
+            if len(self._events) == self._events.maxlen:
+                self.dropped += 1
+            self._events.append(event)
+            self._cond.notify()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name=f'alerts-{self.sink.name}', daemon=True)
+            self._thread.start()
+
+    def _take_batch(self):
+        with self._cond:
+            self._cond.wait_for(lambda: self._events)
+            # Give a burst of transitions a moment to land in the same batch
+            deadline = time.monotonic() + self.interval
+            while len(self._events) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    break
+            count = min(self.batch_size, len(self._events))
+            return [self._events.popleft() for _ in range(count)]
+
+    def _run(self):
+        while True:
+            self._deliver(self._take_batch())
+
+    def _deliver(self, events):
+        for attempt in range(ALERT_MAX_RETRIES + 1):
+            try:
+                self.sink.send(events)
+                return
+            except Exception as e:
+                if attempt == ALERT_MAX_RETRIES:
+                    print(f"Error delivering {len(events)} alerts to {self.sink.name}, giving up: {str(e)}")
+                    return
+                delay = min(ALERT_BACKOFF_SECONDS * 2 ** attempt, ALERT_BACKOFF_MAX_SECONDS)
+                print(f"Error delivering alerts to {self.sink.name}, retrying in {delay:.1f}s: {str(e)}")
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+class AlertDispatcher:
+    # Fans status transitions out to every configured sink. publish() never
+    # blocks: it only appends to each sink's bounded queue.
+
+    def __init__(self, sinks=None, queue_size=ALERT_QUEUE_SIZE, batch_size=ALERT_BATCH_SIZE,
+                 interval_ms=ALERT_BATCH_INTERVAL_MS):
+        sinks = build_sinks() if sinks is None else sinks
+        self.channels = [SinkChannel(sink, queue_size, batch_size, interval_ms / 1000.0)
+                         for sink in sinks]
+
+    def publish(self, event):
+        for channel in self.channels:
+            channel.put(event)
+
+    def start(self):
+        for channel in self.channels:
+            channel.start()
+        return self
+
+flap_detector = FlapDetector()
+alert_dispatcher = AlertDispatcher()
+
+metrics.gauge('monitor_alert_queue_depth', 'Transitions waiting for delivery, by sink', ('sink',),
+              lambda: {(channel.sink.name,): len(channel._events) for channel in alert_dispatcher.channels})
+metrics.gauge('monitor_alerts_dropped', 'Transitions dropped from full sink queues since startup', ('sink',),
+              lambda: {(channel.sink.name,): channel.dropped for channel in alert_dispatcher.channels})
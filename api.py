@@ -0,0 +1,179 @@
+import base64
+import json
+from flask import Blueprint, current_app, request
+from storage import get_db_connection
+from registry import registry, RECORDS
+from monitor_schedule import schedule_version
+from page_cache import cached_response
+from bulk import apply_bulk, BulkError
+
+api = Blueprint('api', __name__, url_prefix='/api')
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Per table: filter query args -> column, and the columns allowed as sort
+# keys. Nullable sort columns are compared through COALESCE(col, '') so keyset
+# comparisons stay total; the expression indexes in migrations.API_INDEXES
+# match those expressions exactly so SQLite can use them.
+RESOURCES = {
+    'monitors': {
+        'table': 'monitors',
+        'filters': {'status': 'Status', 'service_type': 'ServiceType'},
+        'sorts': {'AlertName': 'AlertName', 'Status': 'Status', 'ServiceType': 'ServiceType',
+                  'CheckTime': "COALESCE(CheckTime, '')", 'Frequency': 'Frequency'},
+    },
+    'services': {
+        'table': 'services',
+        'filters': {'status': 'CheckStatus', 'service_type': 'ServiceType', 'host_name': 'HostName'},
+        'sorts': {'AlertName': 'AlertName', 'CheckStatus': 'CheckStatus',
+                  'ServiceType': 'ServiceType', 'HostName': 'HostName'},
+    },
+    'monitor-schedule': {
+        'table': 'monitorSchedule',
+        'filters': {'status': 'Status', 'host_name': 'HostName'},
+        'sorts': {'AlertName': 'AlertName', 'Status': 'Status', 'HostName': 'HostName',
+                  'ScheduleTime': 'ScheduleTime', 'LastCheckTime': "COALESCE(LastCheckTime, '')"},
+    },
+}
+
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except ValueError:
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list) or len(values) != 2:
+        raise ValueError("Invalid cursor")
+    return values
+
+def page_args(resource, args):
+    spec = RESOURCES[resource]
+    sort = args.get('sort', 'AlertName')
+    if sort not in spec['sorts']:
+        raise ValueError(f"sort must be one of: {', '.join(spec['sorts'])}")
+    order = args.get('order', 'asc').lower()
+    if order not in ('asc', 'desc'):
+        raise ValueError("order must be asc or desc")
+    try:
+        limit = min(max(int(args.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+    except ValueError:
+        raise ValueError("limit must be a number")
+    filters = {}
+    for arg, column in spec['filters'].items():
+        values = [v for v in args.get(arg, '').split(',') if v]
+        if values:
+            filters[column] = values
+    cursor = args.get('cursor')
+    after = decode_cursor(cursor) if cursor else None
+    return sort, order, limit, filters, after
+
+def build_page_query(resource, args):
+    spec = RESOURCES[resource]
+    sort, order, limit, filters, after = page_args(resource, args)
+
+    where = []
+    params = []
+    for column, values in filters.items():
+        where.append(f"{column} IN ({','.join('?' for _ in values)})")
+        params.extend(values)
+
+    sort_expr = spec['sorts'][sort]
+    if after:
+        comparison = '>' if order == 'asc' else '<'
+        if sort == 'AlertName':
+            where.append(f"AlertName {comparison} ?")
+            params.append(after[1])
+        else:
+            where.append(f"({sort_expr}, AlertName) {comparison} (?, ?)")
+            params.extend(after)
+
+    direction = 'ASC' if order == 'asc' else 'DESC'
+    order_by = f"AlertName {direction}" if sort == 'AlertName' else f"{sort_expr} {direction}, AlertName {direction}"
+    sql = f"SELECT {spec['table']}.*, {sort_expr} AS _SortKey FROM {spec['table']}"
+    if where:
+        sql += ' WHERE ' + ' AND '.join(where)
+    # Fetch one extra row to know whether another page exists
+    sql += f" ORDER BY {order_by} LIMIT ?"
+    params.append(limit + 1)
+    return sql, params, limit
+
+def registry_page(resource, args):
+    # Monitors and services are served from the in-memory registry
+    sort, order, limit, filters, after = page_args(resource, args)
+    allowed = None
+    for column, values in filters.items():
+        names = registry.names_where(resource, column, values)
+        allowed = names if allowed is None else allowed & names
+    if resource == 'monitors' and args.get('host_name'):
+        # Monitors carry no host; it comes from the service with the same AlertName
+        names = registry.names_where('services', 'HostName', [v for v in args['host_name'].split(',') if v])
+        allowed = names if allowed is None else allowed & names
+    items = registry.page(resource, sort, order == 'desc', after, limit, allowed)
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        last = items[-1]
+        value = last[sort]
+        next_cursor = encode_cursor(['' if value is None else value, last['AlertName']])
+    return {'items': items, 'next_cursor': next_cursor}
+
+def fetch_page(resource, args):
+    if resource in RECORDS:
+        return registry_page(resource, args)
+    sql, params, limit = build_page_query(resource, args)
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute(sql, params)
+        rows = c.fetchall()
+    items = [dict(row) for row in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last = items[-1]
+        next_cursor = encode_cursor([last['_SortKey'], last['AlertName']])
+    for item in items:
+        del item['_SortKey']
+    return {'items': items, 'next_cursor': next_cursor}
+
+def data_version(resource):
+    if resource in RECORDS:
+        return registry.versions[resource]
+    return schedule_version()
+
+def paged_response(resource):
+    # Pages are cached per query string until their table changes; clients
+    # holding the current version get a 304
+    def render():
+        try:
+            return current_app.json.dumps(fetch_page(resource, request.args)), 200
+        except ValueError as e:
+            return current_app.json.dumps({'error': str(e)}), 400
+    key = (resource, tuple(sorted(request.args.items(multi=True))))
+    return cached_response(key, data_version(resource), render, 'application/json')
+
+@api.route('/monitors')
+def list_monitors():
+    return paged_response('monitors')
+
+@api.route('/services')
+def list_services():
+    return paged_response('services')
+
+@api.route('/monitor-schedule')
+def list_monitor_schedule():
+    return paged_response('monitor-schedule')
+
+@api.route('/bulk', methods=['POST'])
+def bulk_changes():
+    # Upserts and deletes of monitors and services in one transaction, with
+    # a result per item; see bulk.apply_bulk
+    try:
+        body, status = apply_bulk(request.get_json(silent=True))
+    except BulkError as e:
+        return {'error': str(e)}, 400
+    except Exception as e:
+        print(f"Error applying bulk changes: {str(e)}")
+        return {'error': f"Error applying bulk changes: {str(e)}"}, 500
+    return body, status
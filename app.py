@@ -1,141 +1,131 @@
 import os
-from flask import Flask, request, jsonify, render_template, redirect, url_for, send_file
+from flask import Blueprint, Flask, Response, current_app, g, request, jsonify, render_template, redirect, url_for, \
+    send_file, stream_with_context
 from dotenv import load_dotenv
-import requests
-import schedule
-import time
 from datetime import datetime
 import threading
-import csv
-import io
-from werkzeug.utils import secure_filename
-import sqlite3
-import pandas as pd
-from contextlib import contextmanager
-from monitor_schedule import init_db, get_monitor_schedules, export_monitor_schedules, run_schedule_updates
-
-# Load environment variables
+import time
+
+# Load environment variables before the modules below read their settings
 load_dotenv()
 
-app = Flask(__name__)
-app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
-app.config['UPLOAD_FOLDER'] = 'uploads'
+from storage import get_db_connection, IntegrityError
+from migrations import ensure_schema
+from monitor_schedule import run_schedule_updates, mark_schedule_dirty
+from checker import run_health_checks, parse_timeout
+from scheduler import check_scheduler, parse_frequency
+from history import get_uptime, run_history_maintenance
+from reports import uptime_report, REPORT_GROUPS
+from api import api
+from events import broadcaster
+from alerts import flap_detector
+from breakers import endpoint_stats
+from assertions import parse_assertions, assertion_cache
+from importer import import_monitors, import_services as import_service_rows, report_path
+from exporter import export_stream, check_format, has_rows
+from registry import registry
+from page_cache import cached_response
+from metrics import metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from worker import CHECKER_EMBEDDED, follow_changes, latest_change
 
-# Ensure upload directory exists
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# create_app() starts the checker (unless CHECKER_EMBEDDED=0), the
+# monitorSchedule updater and history maintenance, so they run under a WSGI
+# server as well. worker.py runs none but the checks, so at least one web
+# process must keep this on. Every web process follows monitorChanges to
+# keep its registry current, whatever this says.
+START_BACKGROUND_THREADS = os.getenv('START_BACKGROUND_THREADS', '1') == '1'
+_threads_lock = threading.Lock()
+_threads_started = False
+_follower_started = False
 
-@contextmanager
-def get_db_connection():
-    conn = sqlite3.connect('monitor.db', timeout=20)
-    conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-    finally:
-        conn.close()
+# Page and form routes; create_app() mounts them next to the JSON API
+web = Blueprint('web', __name__)
+
+request_duration = metrics.histogram('monitor_http_request_duration_seconds',
+                                     'Time to build each response, by route', ('endpoint', 'method', 'status'))
+
+@web.before_app_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
 
-def init_app_db():
+@web.after_app_request
+def record_request_time(response):
+    # Streamed responses (exports, /events) are timed up to their first byte
+    started = g.pop('request_started', None)
+    if started is not None:
+        request_duration.observe(time.perf_counter() - started, request.endpoint or 'unmatched',
+                                 request.method, str(response.status_code))
+    return response
+
+def create_app(start_threads=START_BACKGROUND_THREADS):
+    # Importing this module touches neither the database nor pandas; the
+    # schema check (one query once migrated), the registry load and the
+    # background threads run here
+    app = Flask(__name__)
+    # Uploads are parsed as a stream, so the cap only guards disk space
+    app.config['MAX_CONTENT_LENGTH'] = int(os.getenv('MAX_UPLOAD_MB', '1024')) * 1024 * 1024
+    app.config['UPLOAD_FOLDER'] = 'uploads'
+    app.register_blueprint(web)
+    app.register_blueprint(api)
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+    ensure_schema()
+    # Changes committed after this point are replayed onto the registry
     with get_db_connection() as conn:
-        c = conn.cursor()
-        # Create monitors table
-        c.execute('''CREATE TABLE IF NOT EXISTS monitors
-                     (AlertName TEXT PRIMARY KEY,
-                      Connection TEXT NOT NULL,
-                      ServiceType TEXT NOT NULL,
-                      HealthCheck TEXT NOT NULL,
-                      Response TEXT NOT NULL,
-                      Description TEXT NOT NULL,
-                      Status TEXT NOT NULL DEFAULT 'DOWN',
-                      CheckTime TEXT NOT NULL,
-                      ScheduleTime TEXT NOT NULL,
-                      Frequency INTEGER NOT NULL DEFAULT 1)''')
-        
-        # Create services table
-        c.execute('''CREATE TABLE IF NOT EXISTS services
-                     (AlertName TEXT PRIMARY KEY,
-                      ServiceType TEXT NOT NULL,
-                      HostName TEXT NOT NULL,
-                      CheckStatus TEXT NOT NULL DEFAULT 'DOWN')''')
-        
-        # Create monitorSchedule table
-        c.execute('''CREATE TABLE IF NOT EXISTS monitorSchedule
-                     (AlertName TEXT PRIMARY KEY,
-                      HealthCheck TEXT NOT NULL,
-                      ScheduleTime TEXT NOT NULL,
-                      Frequency INTEGER NOT NULL,
-                      HostName TEXT NOT NULL,
-                      LastCheckTime TEXT NOT NULL,
-                      Status TEXT NOT NULL DEFAULT 'DOWN')''')
-        conn.commit()
-
-# Initialize databases on startup
-init_app_db()
-init_db()
-
-def check_service(monitor):
-    try:
-        service_type = monitor['ServiceType'].upper()
-        if service_type in ['HTTP', 'HTTPS']:
-            response = requests.get(monitor['Connection'], timeout=5)
-            status = 'UP' if str(response.status_code) == monitor['Response'] else 'DOWN'
-        elif service_type in ['TCP', 'UDP']:
-            # Implement TCP/UDP check logic here
-            status = 'UP'  # Placeholder
-        else:
-            # For custom service types, try HTTP check by default
-            try:
-                response = requests.get(monitor['Connection'], timeout=5)
-                status = 'UP' if str(response.status_code) == monitor['Response'] else 'DOWN'
-            except:
-                status = 'DOWN'
-        
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute('UPDATE monitors SET Status=?, CheckTime=? WHERE AlertName=?',
-                     (status, datetime.now().isoformat(), monitor['AlertName']))
-            conn.commit()
-    except Exception as e:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute('UPDATE monitors SET Status=?, CheckTime=? WHERE AlertName=?',
-                     ('DOWN', datetime.now().isoformat(), monitor['AlertName']))
-            conn.commit()
+        seq = latest_change(conn)
+    registry.load()
+    if start_threads:
+        start_background_threads()
+    # Without a checker of its own, this process learns about status
+    # transitions and check times from the changelog only
+    start_change_follower(seq, relay_transitions=not (CHECKER_EMBEDDED and _threads_started))
+    return app
 
-def should_check_monitor(monitor):
-    if not monitor.get('CheckTime'):
-        return True
-    
-    last_check = datetime.fromisoformat(monitor['CheckTime'])
-    now = datetime.now()
-    
-    frequency_seconds = monitor['Frequency'] * 60
-    return (now - last_check).total_seconds() >= frequency_seconds
-
-def run_health_checks():
-    while True:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute('SELECT * FROM monitors')
-            monitors = [dict(zip(['AlertName', 'Connection', 'ServiceType', 'HealthCheck', 'Response', 'Description', 'Status', 'CheckTime', 'ScheduleTime', 'Frequency'], row)) 
-                        for row in c.fetchall()]
-        
-        for monitor in monitors:
-            if should_check_monitor(monitor):
-                check_service(monitor)
-        time.sleep(60)  # Check every minute
-
-@app.route('/')
+def start_change_follower(seq, relay_transitions):
+    # Once per process, like the background threads
+    global _follower_started
+    with _threads_lock:
+        if _follower_started:
+            return
+        _follower_started = True
+    threading.Thread(target=follow_changes, args=(seq, relay_transitions), name='change-follower',
+                     daemon=True).start()
+
+def start_background_threads():
+    # Once per process, however many apps are created
+    global _threads_started
+    with _threads_lock:
+        if _threads_started:
+            return
+        _threads_started = True
+    if CHECKER_EMBEDDED:
+        # Start health check thread
+        health_check_thread = threading.Thread(target=run_health_checks, daemon=True)
+        health_check_thread.start()
+
+    # Start schedule update thread
+    schedule_thread = threading.Thread(target=run_schedule_updates, daemon=True)
+    schedule_thread.start()
+
+    # Start history rollup/retention thread
+    history_thread = threading.Thread(target=run_history_maintenance, daemon=True)
+    history_thread.start()
+
+def page_response(template):
+    # Page shells carry no table data, only the template and the flash
+    # message, so they stay valid for the life of the process
+    message = request.args.get('message')
+    if current_app.jinja_env.auto_reload:
+        # Debug mode: templates may be edited while the server runs
+        return render_template(template, message=message)
+    return cached_response((template, message), 0,
+                           lambda: (render_template(template, message=message), 200))
+
+@web.route('/')
 def home():
-    try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute('SELECT * FROM monitors')
-            monitors = [dict(zip(['AlertName', 'Connection', 'ServiceType', 'HealthCheck', 'Response', 'Description', 'Status', 'CheckTime', 'ScheduleTime', 'Frequency'], row)) 
-                        for row in c.fetchall()]
-        return render_template('index.html', monitors=monitors)
-    except Exception as e:
-        return render_template('index.html', monitors=[], message=f"Error loading monitors: {str(e)}")
+    # Rows are loaded page by page from /api/monitors
+    return page_response('index.html')
 
-@app.route('/monitor', methods=['POST'])
+@web.route('/monitor', methods=['POST'])
 def create_monitor():
     try:
         data = request.form.to_dict()
@@ -150,31 +140,40 @@ def create_monitor():
             data['Frequency'] = 1  # Default frequency of 1 minute
         else:
             try:
-                data['Frequency'] = int(data['Frequency'])
-                if data['Frequency'] < 1:
-                    return "Frequency must be at least 1 minute", 400
-            except ValueError:
-                return "Frequency must be a number", 400
+                data['Frequency'] = parse_frequency(data['Frequency'])
+            except ValueError as e:
+                return str(e), 400
+        try:
+            for field in ('ConnectTimeout', 'ReadTimeout'):
+                data[field] = parse_timeout(data.get(field))
+            data['Assertions'] = parse_assertions(data.get('Assertions'))
+        except ValueError as e:
+            return str(e), 400
 
         with get_db_connection() as conn:
             c = conn.cursor()
             try:
                 c.execute('''INSERT INTO monitors 
                            (AlertName, Connection, ServiceType, HealthCheck, Response, 
-                            Description, Status, CheckTime, ScheduleTime, Frequency) 
-                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                            Description, Status, CheckTime, ScheduleTime, Frequency,
+                            ConnectTimeout, ReadTimeout, Assertions) 
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
                          (data['AlertName'], data['Connection'], data['ServiceType'],
                           data['HealthCheck'], data['Response'], data['Description'],
                           data['Status'], data['CheckTime'], data['ScheduleTime'],
-                          data['Frequency']))
+                          data['Frequency'], data['ConnectTimeout'], data['ReadTimeout'],
+                          data['Assertions']))
                 conn.commit()
-                return redirect(url_for('home', message="Monitor added successfully!"))
-            except sqlite3.IntegrityError:
-                return redirect(url_for('home', message="Error: Alert Name already exists!"))
+                registry.put('monitors', data)
+                check_scheduler.upsert(data)
+                mark_schedule_dirty([data['AlertName']])
+                return redirect(url_for('.home', message="Monitor added successfully!"))
+            except IntegrityError:
+                return redirect(url_for('.home', message="Error: Alert Name already exists!"))
     except Exception as e:
-        return redirect(url_for('home', message=f"Error adding monitor: {str(e)}"))
+        return redirect(url_for('.home', message=f"Error adding monitor: {str(e)}"))
 
-@app.route('/monitor/<AlertName>', methods=['POST', 'PUT'])
+@web.route('/monitor/<AlertName>', methods=['POST', 'PUT'])
 def update_monitor(AlertName):
     try:
         data = request.form.to_dict()
@@ -187,51 +186,110 @@ def update_monitor(AlertName):
                 return "Invalid ScheduleTime format. Use ISO format.", 400
         if 'Frequency' in data:
             try:
-                data['Frequency'] = int(data['Frequency'])
-                if data['Frequency'] < 1:
-                    return "Frequency must be at least 1 minute", 400
-            except ValueError:
-                return "Frequency must be a number", 400
+                data['Frequency'] = parse_frequency(data['Frequency'])
+            except ValueError as e:
+                return str(e), 400
+        try:
+            for field in ('ConnectTimeout', 'ReadTimeout'):
+                data[field] = parse_timeout(data.get(field))
+            data['Assertions'] = parse_assertions(data.get('Assertions'))
+        except ValueError as e:
+            return str(e), 400
 
         with get_db_connection() as conn:
             c = conn.cursor()
             c.execute('''UPDATE monitors 
                        SET Connection=?, ServiceType=?, HealthCheck=?, Response=?,
-                           Description=?, Status=?, CheckTime=?, ScheduleTime=?, Frequency=?
+                           Description=?, Status=?, CheckTime=?, ScheduleTime=?, Frequency=?,
+                           ConnectTimeout=?, ReadTimeout=?, Assertions=?
                        WHERE AlertName=?''',
                      (data['Connection'], data['ServiceType'], data['HealthCheck'],
                       data['Response'], data['Description'], data['Status'],
                       data['CheckTime'], data['ScheduleTime'], data['Frequency'],
-                      AlertName))
+                      data['ConnectTimeout'], data['ReadTimeout'], data['Assertions'], AlertName))
             conn.commit()
-        return redirect(url_for('home', message="Monitor updated successfully!"))
+            updated = c.rowcount
+        if updated:
+            registry.put('monitors', dict(data, AlertName=AlertName))
+            # The target may have changed; learn its latency afresh
+            endpoint_stats.forget(AlertName)
+            check_scheduler.upsert(dict(data, AlertName=AlertName))
+            mark_schedule_dirty([AlertName])
+        return redirect(url_for('.home', message="Monitor updated successfully!"))
     except Exception as e:
-        return redirect(url_for('home', message=f"Error updating monitor: {str(e)}"))
+        return redirect(url_for('.home', message=f"Error updating monitor: {str(e)}"))
 
-@app.route('/monitor/<AlertName>/delete', methods=['POST', 'DELETE'])
+@web.route('/monitor/<AlertName>/delete', methods=['POST', 'DELETE'])
 def delete_monitor(AlertName):
     try:
         with get_db_connection() as conn:
             c = conn.cursor()
             c.execute('DELETE FROM monitors WHERE AlertName=?', (AlertName,))
             conn.commit()
-        return redirect(url_for('home', message="Monitor deleted successfully!"))
+        registry.remove('monitors', AlertName)
+        check_scheduler.remove(AlertName)
+        flap_detector.forget(AlertName)
+        endpoint_stats.forget(AlertName)
+        assertion_cache.forget(AlertName)
+        mark_schedule_dirty([AlertName])
+        return redirect(url_for('.home', message="Monitor deleted successfully!"))
     except Exception as e:
-        return redirect(url_for('home', message=f"Error deleting monitor: {str(e)}"))
+        return redirect(url_for('.home', message=f"Error deleting monitor: {str(e)}"))
 
-@app.route('/services')
-def services():
+@web.route('/monitor/<AlertName>/uptime')
+def monitor_uptime(AlertName):
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute('SELECT * FROM services')
-            services = [dict(zip(['AlertName', 'ServiceType', 'HostName', 'CheckStatus'], row)) 
-                        for row in c.fetchall()]
-        return render_template('services.html', services=services)
-    except Exception as e:
-        return render_template('services.html', services=[], message=f"Error loading services: {str(e)}")
+        hours = float(request.args.get('hours', 24))
+    except ValueError:
+        return jsonify({'error': 'hours must be a number'}), 400
+    until = datetime.now().timestamp()
+    return jsonify(get_uptime(AlertName, until - hours * 3600, until))
+
+def report_time(value):
+    # Epoch seconds or an ISO 8601 date/time
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
 
-@app.route('/service', methods=['POST'])
+@web.route('/reports/uptime')
+def reports_uptime():
+    # ?since=&until= (epoch seconds or ISO), or ?hours= / ?days= back from
+    # until (default now); ?group=monitor|service|type
+    group = request.args.get('group', 'monitor')
+    if group not in REPORT_GROUPS:
+        return jsonify({'error': f"group must be one of: {', '.join(REPORT_GROUPS)}"}), 400
+    try:
+        until = report_time(request.args['until']) if 'until' in request.args else datetime.now().timestamp()
+        if 'since' in request.args:
+            since = report_time(request.args['since'])
+        else:
+            hours = float(request.args.get('days', 0)) * 24 or float(request.args.get('hours', 24))
+            since = until - hours * 3600
+    except ValueError:
+        return jsonify({'error': 'since and until must be epoch seconds or ISO dates; hours and days numbers'}), 400
+    if since >= until:
+        return jsonify({'error': 'since must be before until'}), 400
+    return jsonify({'since': since, 'until': until, 'group': group, 'rows': uptime_report(since, until, group)})
+
+@web.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+@web.route('/events')
+def events():
+    # Server-Sent Events stream of status transitions
+    last_event_id = request.headers.get('Last-Event-ID', type=int)
+    return Response(stream_with_context(broadcaster.stream(last_event_id)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@web.route('/services')
+def services():
+    # Rows are loaded page by page from /api/services
+    return page_response('services.html')
+
+@web.route('/service', methods=['POST'])
 def add_service():
     if request.method == 'POST':
         try:
@@ -246,15 +304,18 @@ def add_service():
                     c.execute('INSERT INTO services (AlertName, ServiceType, HostName, CheckStatus) VALUES (?, ?, ?, ?)',
                              (alert_name, service_type, host_name, check_status))
                     conn.commit()
+                    registry.put('services', {'AlertName': alert_name, 'ServiceType': service_type,
+                                              'HostName': host_name, 'CheckStatus': check_status})
+                    mark_schedule_dirty([alert_name])
                     message = "Service added successfully!"
-                except sqlite3.IntegrityError:
+                except IntegrityError:
                     message = "Error: Alert Name already exists!"
             
-            return redirect(url_for('services', message=message))
+            return redirect(url_for('.services', message=message))
         except Exception as e:
-            return redirect(url_for('services', message=f"Error adding service: {str(e)}"))
+            return redirect(url_for('.services', message=f"Error adding service: {str(e)}"))
 
-@app.route('/service/<alert_name>', methods=['POST'])
+@web.route('/service/<alert_name>', methods=['POST'])
 def update_service(alert_name):
     if request.method == 'POST':
         try:
@@ -264,14 +325,23 @@ def update_service(alert_name):
             
             with get_db_connection() as conn:
                 c = conn.cursor()
+                c.execute('SELECT CheckStatus FROM services WHERE AlertName=?', (alert_name,))
+                previous = c.fetchone()
                 c.execute('UPDATE services SET ServiceType=?, HostName=?, CheckStatus=? WHERE AlertName=?',
                          (service_type, host_name, check_status, alert_name))
                 conn.commit()
-            return redirect(url_for('services', message="Service updated successfully!"))
+            if previous:
+                registry.put('services', {'AlertName': alert_name, 'ServiceType': service_type,
+                                          'HostName': host_name, 'CheckStatus': check_status})
+            if previous and previous['CheckStatus'] != check_status:
+                broadcaster.publish('service', {'AlertName': alert_name, 'CheckStatus': check_status,
+                                                'PreviousStatus': previous['CheckStatus']})
+            mark_schedule_dirty([alert_name])
+            return redirect(url_for('.services', message="Service updated successfully!"))
         except Exception as e:
-            return redirect(url_for('services', message=f"Error updating service: {str(e)}"))
+            return redirect(url_for('.services', message=f"Error updating service: {str(e)}"))
 
-@app.route('/service/<alert_name>/delete', methods=['POST'])
+@web.route('/service/<alert_name>/delete', methods=['POST'])
 def delete_service(alert_name):
     if request.method == 'POST':
         try:
@@ -279,248 +349,105 @@ def delete_service(alert_name):
                 c = conn.cursor()
                 c.execute('DELETE FROM services WHERE AlertName=?', (alert_name,))
                 conn.commit()
-            return redirect(url_for('services', message="Service deleted successfully!"))
+            registry.remove('services', alert_name)
+            mark_schedule_dirty([alert_name])
+            return redirect(url_for('.services', message="Service deleted successfully!"))
         except Exception as e:
-            return redirect(url_for('services', message=f"Error deleting service: {str(e)}"))
+            return redirect(url_for('.services', message=f"Error deleting service: {str(e)}"))
 
-@app.route('/export', methods=['GET'])
-def export_csv():
+def export_response(name, endpoint, selected, label):
+    # Streams rows from the cursor; nothing is buffered beyond one fetch batch
     try:
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            c.execute('SELECT * FROM monitors')
-            monitors = [dict(zip(['AlertName', 'Connection', 'ServiceType', 'HealthCheck', 'Response', 'Description', 'Status', 'CheckTime', 'ScheduleTime', 'Frequency'], row)) 
-                        for row in c.fetchall()]
-        
-        # Check if specific monitors were requested
-        selected_monitors = request.args.get('monitors')
-        if selected_monitors:
-            selected_names = selected_monitors.split(',')
-            monitors = [m for m in monitors if m['AlertName'] in selected_names]
-        
-        if not monitors:
-            return redirect(url_for('home', message="No monitors to export"))
-        
-        # Create CSV in memory
-        si = io.StringIO()
-        writer = csv.writer(si)
-        
-        # Write header
-        writer.writerow(['AlertName', 'Connection', 'ServiceType', 'HealthCheck', 'Response', 
-                        'Description', 'Status', 'ScheduleTime', 'Frequency'])
-        
-        # Write data
-        for monitor in monitors:
-            writer.writerow([
-                monitor['AlertName'],
-                monitor['Connection'],
-                monitor['ServiceType'],
-                monitor['HealthCheck'],
-                monitor['Response'],
-                monitor['Description'],
-                monitor['Status'],
-                monitor['ScheduleTime'],
-                monitor['Frequency']
-            ])
-        
-        # Create response
-        output = si.getvalue()
-        si.close()
-        
-        return send_file(
-            io.BytesIO(output.encode('utf-8')),
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name='monitors.csv'
-        )
+        fmt = request.args.get('format', 'csv').lower()
+        check_format(fmt)
+        if not has_rows(name, selected):
+            return redirect(url_for(f'.{endpoint}', message=f"No {label} to export"))
+        chunks, mimetype, filename = export_stream(name, fmt, selected)
+        return Response(stream_with_context(chunks), mimetype=mimetype,
+                        headers={'Content-Disposition': f'attachment; filename={filename}'})
     except Exception as e:
-        return redirect(url_for('home', message=f"Error exporting monitors: {str(e)}"))
+        return redirect(url_for(f'.{endpoint}', message=f"Error exporting {label}: {str(e)}"))
 
-@app.route('/import', methods=['POST'])
-def import_csv():
+def selected_names(arg):
+    return [name for name in request.args.get(arg, '').split(',') if name]
+
+@web.route('/export', methods=['GET'])
+def export_csv():
+    return export_response('monitors', 'home', selected_names('monitors'), 'monitors')
+
+def import_response(endpoint, result):
+    # The upload dialogs post with Accept: application/json; plain form posts
+    # get the usual redirect
+    if result.get('report_id'):
+        result['report_url'] = url_for('.import_report', report_id=result['report_id'])
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify(result)
+    message = f"Import completed. Successfully processed: {result['imported']}"
+    if result['failed']:
+        message += f"\nFailed: {result['failed']} (error report: {result['report_url']})"
+    return redirect(url_for(f'.{endpoint}', message=message))
+
+def import_error(endpoint, message):
+    if request.accept_mimetypes.best == 'application/json':
+        return jsonify({'error': message}), 400
+    return redirect(url_for(f'.{endpoint}', message=message))
+
+def uploaded_csv(endpoint):
     if 'file' not in request.files:
-        return redirect(url_for('home', message="Error: No file uploaded"))
-    
+        return None, import_error(endpoint, "Error: No file uploaded")
     file = request.files['file']
     if file.filename == '':
-        return redirect(url_for('home', message="Error: No file selected"))
-    
+        return None, import_error(endpoint, "Error: No file selected")
     if not file.filename.endswith('.csv'):
-        return redirect(url_for('home', message="Error: Please upload a CSV file"))
-    
+        return None, import_error(endpoint, "Error: Please upload a CSV file")
+    return file, None
+
+@web.route('/import', methods=['POST'])
+def import_csv():
+    file, error = uploaded_csv('home')
+    if error:
+        return error
     try:
-        df = pd.read_csv(file)
-        required_columns = ['AlertName', 'Connection', 'ServiceType', 'HealthCheck', 
-                          'Response', 'Description', 'Status', 'ScheduleTime', 'Frequency']
-        
-        if not all(col in df.columns for col in required_columns):
-            return redirect(url_for('home', message=f"Error: CSV must contain columns: {', '.join(required_columns)}"))
-        
-        success_count = 0
-        error_count = 0
-        error_messages = []
-        
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            for _, row in df.iterrows():
-                try:
-                    # Convert ScheduleTime string to datetime
-                    if pd.notna(row.get('ScheduleTime')):
-                        try:
-                            datetime.fromisoformat(str(row['ScheduleTime']))
-                        except ValueError:
-                            error_messages.append(f"Invalid ScheduleTime format for {row.get('AlertName', 'Unknown')}: {row['ScheduleTime']}")
-                            error_count += 1
-                            continue
-                    
-                    # Convert Frequency to integer
-                    if pd.notna(row.get('Frequency')):
-                        try:
-                            frequency = int(row['Frequency'])
-                            if frequency < 1:
-                                error_messages.append(f"Invalid Frequency value for {row.get('AlertName', 'Unknown')}: {frequency}")
-                                error_count += 1
-                                continue
-                        except ValueError:
-                            error_messages.append(f"Invalid Frequency format for {row.get('AlertName', 'Unknown')}: {row['Frequency']}")
-                            error_count += 1
-                            continue
-                    else:
-                        row['Frequency'] = 1  # Default frequency
-                    
-                    c.execute('''INSERT OR REPLACE INTO monitors 
-                               (AlertName, Connection, ServiceType, HealthCheck, Response, 
-                                Description, Status, ScheduleTime, Frequency) 
-                               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                             (row['AlertName'], row['Connection'], row['ServiceType'],
-                              row['HealthCheck'], row['Response'], row['Description'],
-                              row['Status'], row['ScheduleTime'], row['Frequency']))
-                    success_count += 1
-                except Exception as e:
-                    error_count += 1
-                    error_messages.append(f"Error in row {_ + 1}: {str(e)}")
-            conn.commit()
-        
-        message = f"Import completed. Successfully processed: {success_count}"
-        if error_count > 0:
-            message += f"\nFailed: {error_count}\nErrors:\n" + "\n".join(error_messages)
-        
-        return redirect(url_for('home', message=message))
-    
+        return import_response('home', import_monitors(file))
     except Exception as e:
-        return redirect(url_for('home', message=f"Error processing CSV file: {str(e)}"))
+        return import_error('home', f"Error processing CSV file: {str(e)}")
 
-@app.route('/service/import', methods=['POST'])
+@web.route('/service/import', methods=['POST'])
 def import_services():
-    if 'file' not in request.files:
-        return redirect(url_for('services', message="Error: No file uploaded"))
-    
-    file = request.files['file']
-    if file.filename == '':
-        return redirect(url_for('services', message="Error: No file selected"))
-    
-    if not file.filename.endswith('.csv'):
-        return redirect(url_for('services', message="Error: Please upload a CSV file"))
-    
+    file, error = uploaded_csv('services')
+    if error:
+        return error
     try:
-        df = pd.read_csv(file)
-        required_columns = ['AlertName', 'ServiceType', 'HostName', 'CheckStatus']
-        
-        if not all(col in df.columns for col in required_columns):
-            return redirect(url_for('services', message="Error: CSV must contain columns: AlertName, ServiceType, HostName, CheckStatus"))
-        
-        success_count = 0
-        error_count = 0
-        error_messages = []
-        
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            for _, row in df.iterrows():
-                try:
-                    c.execute('INSERT OR REPLACE INTO services (AlertName, ServiceType, HostName, CheckStatus) VALUES (?, ?, ?, ?)',
-                             (row['AlertName'], row['ServiceType'], row['HostName'], row['CheckStatus']))
-                    success_count += 1
-                except Exception as e:
-                    error_count += 1
-                    error_messages.append(f"Error in row {_ + 1}: {str(e)}")
-            conn.commit()
-        
-        message = f"Import completed. Successfully processed: {success_count}"
-        if error_count > 0:
-            message += f"\nFailed: {error_count}\nErrors:\n" + "\n".join(error_messages)
-        
-        return redirect(url_for('services', message=message))
-    
+        return import_response('services', import_service_rows(file))
     except Exception as e:
-        return redirect(url_for('services', message=f"Error processing CSV file: {str(e)}"))
+        return import_error('services', f"Error processing CSV file: {str(e)}")
 
-@app.route('/service/export')
-def export_services():
+@web.route('/import/report/<report_id>')
+def import_report(report_id):
     try:
-        selected_services = request.args.get('services', '').split(',')
-        selected_services = [s for s in selected_services if s]
-        
-        with get_db_connection() as conn:
-            c = conn.cursor()
-            if selected_services:
-                placeholders = ','.join(['?' for _ in selected_services])
-                c.execute(f'SELECT * FROM services WHERE AlertName IN ({placeholders})', selected_services)
-            else:
-                c.execute('SELECT * FROM services')
-            
-            services = c.fetchall()
-        
-        if not services:
-            return redirect(url_for('services', message="No services to export"))
-        
-        df = pd.DataFrame(services, columns=['AlertName', 'ServiceType', 'HostName', 'CheckStatus'])
-        
-        output = io.BytesIO()
-        df.to_csv(output, index=False)
-        output.seek(0)
-        
-        return send_file(
-            output,
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name='services.csv'
-        )
-    except Exception as e:
-        return redirect(url_for('services', message=f"Error exporting services: {str(e)}"))
+        path = report_path(report_id)
+    except ValueError:
+        return "Invalid report id", 404
+    if not os.path.exists(path):
+        return "Report not found", 404
+    return send_file(os.path.abspath(path), mimetype='text/csv', as_attachment=True,
+                     download_name='import_errors.csv')
+
+@web.route('/service/export')
+def export_services():
+    return export_response('services', 'services', selected_names('services'), 'services')
 
-@app.route('/monitor-schedule')
+@web.route('/monitor-schedule')
 def monitor_schedule():
-    try:
-        schedules = get_monitor_schedules()
-        return render_template('monitor_schedule.html', schedules=schedules)
-    except Exception as e:
-        print(f"Error in monitor_schedule route: {str(e)}")
-        return render_template('monitor_schedule.html', schedules=[], 
-                             message=f"Error loading monitor schedules: {str(e)}")
+    # Rows are loaded page by page from /api/monitor-schedule
+    return page_response('monitor_schedule.html')
 
-@app.route('/monitor-schedule/export')
+@web.route('/monitor-schedule/export')
 def export_schedule():
-    try:
-        output, error = export_monitor_schedules()
-        if error:
-            return redirect(url_for('monitor_schedule', message=error))
-        
-        return send_file(
-            io.BytesIO(output.encode('utf-8')),
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name='monitor_schedule.csv'
-        )
-    except Exception as e:
-        return redirect(url_for('monitor_schedule', message=f"Error exporting schedules: {str(e)}"))
+    return export_response('monitor-schedule', 'monitor_schedule', selected_names('schedules'), 'schedules')
 
 if __name__ == '__main__':
-    # Start health check thread
-    health_check_thread = threading.Thread(target=run_health_checks, daemon=True)
-    health_check_thread.start()
-    
-    # Start schedule update thread
-    schedule_thread = threading.Thread(target=run_schedule_updates, daemon=True)
-    schedule_thread.start()
-    
+    # The debug reloader's outer process only watches files; the threads
+    # belong to the child that serves, which has WERKZEUG_RUN_MAIN set
+    app = create_app(start_threads=START_BACKGROUND_THREADS and os.environ.get('WERKZEUG_RUN_MAIN') == 'true')
     app.run(debug=True)
@@ -0,0 +1,444 @@
+import json
+import os
+import re
+import threading
+import time
+from string import Template
+from urllib.parse import urljoin
+from requests.cookies import RequestsCookieJar
+from metrics import metrics
+
+# Most of a response body a check reads. Body checks that have not matched
+# by then fail, and JSON checks need the whole body within it.
+CHECK_MAX_BODY_BYTES = int(os.getenv('CHECK_MAX_BODY_BYTES', '1048576'))
+# Once nothing needs more of the body, a remainder up to this size is still
+# read so the connection goes back to the pool; longer ones are cut off
+CHECK_DRAIN_BYTES = int(os.getenv('CHECK_DRAIN_BYTES', '65536'))
+# Requests in one multi-step check
+CHECK_MAX_STEPS = 5
+BODY_CHUNK_SIZE = 16384
+
+METHODS = {'GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'}
+STEP_KEYS = {'url', 'method', 'headers', 'body', 'json', 'expect', 'save'}
+# Allowed keys per check, keyed by the key that names the check
+CHECK_KEYS = {
+    'status': {'status'},
+    'body_contains': {'body_contains'},
+    'body_regex': {'body_regex'},
+    'json': {'json', 'equals'},
+    'header': {'header', 'equals', 'contains', 'regex'},
+    'max_ms': {'max_ms'},
+}
+MISSING = object()
+
+assertion_failures = metrics.counter('monitor_assertion_failures_total',
+                                     'HTTP checks answered DOWN by a failed assertion, by check', ('check',))
+body_bytes = metrics.counter('monitor_probe_body_bytes_total', 'Response body bytes read by HTTP checks')
+
+def json_path(path):
+    # 'data.items.0.status' -> ('data', 'items', '0', 'status')
+    if not isinstance(path, str) or not path:
+        raise ValueError("A JSON path must be a non-empty string such as data.status")
+    return tuple(path.split('.'))
+
+def lookup(document, keys):
+    for key in keys:
+        if isinstance(document, dict):
+            document = document.get(key, MISSING)
+        elif isinstance(document, list) and key.lstrip('-').isdigit() and -len(document) <= int(key) < len(document):
+            document = document[int(key)]
+        else:
+            return MISSING
+        if document is MISSING:
+            return MISSING
+    return document
+
+def saved_text(value):
+    return value if isinstance(value, str) else json.dumps(value)
+
+def compile_regex(pattern):
+    # Bodies are searched as bytes, so they are never decoded
+    if not isinstance(pattern, str) or not pattern:
+        raise ValueError("A regex must be a non-empty string")
+    try:
+        return re.compile(pattern.encode('utf-8'))
+    except re.error as e:
+        raise ValueError(f"Invalid regex {pattern!r}: {e}")
+
+def fill(value, variables):
+    # ${name} placeholders take the values saved by earlier steps
+    if isinstance(value, str):
+        return Template(value).safe_substitute(variables) if variables and '$' in value else value
+    if isinstance(value, dict):
+        return {key: fill(item, variables) for key, item in value.items()}
+    if isinstance(value, list):
+        return [fill(item, variables) for item in value]
+    return value
+
+class BodyMatch:
+    # A substring or regex the body must contain, or a regex whose first
+    # match (group 1 if it has one) is saved for later steps
+    __slots__ = ('check', 'needle', 'pattern', 'save')
+
+    def __init__(self, check, needle=None, pattern=None, save=None):
+        self.check = check
+        self.needle = needle
+        self.pattern = pattern
+        self.save = save
+
+    def search(self, buffer, scanned, variables):
+        # scanned: bytes of buffer already searched by earlier calls
+        if self.needle is not None:
+            return buffer.find(self.needle, max(0, scanned - len(self.needle) + 1)) >= 0
+        match = self.pattern.search(buffer)
+        if match is None:
+            return False
+        if self.save is not None:
+            variables[self.save] = match.group(1 if self.pattern.groups else 0).decode('utf-8', 'replace')
+        return True
+
+class Step:
+    # One request of a check and everything asserted on its response
+    __slots__ = ('method', 'url', 'headers', 'body', 'json', 'status', 'header_checks', 'body_matches',
+                 'json_checks', 'max_ms', 'header_saves', 'json_saves')
+
+    def __init__(self):
+        self.method = 'GET'
+        self.url = None
+        self.headers = None
+        self.body = None
+        self.json = None
+        # Accepted status codes; None means Response (last step) or below 400
+        self.status = None
+        self.header_checks = []
+        self.body_matches = []
+        self.json_checks = []
+        self.max_ms = None
+        self.header_saves = []
+        self.json_saves = []
+
+    @property
+    def needs_json(self):
+        return bool(self.json_checks or self.json_saves)
+
+    @property
+    def reads_head_only(self):
+        # A plain GET of Connection judged on its status line and headers
+        # alone; monitors with different expectations can share its response
+        return (self.method == 'GET' and self.url is None and self.headers is None and self.body is None
+                and self.json is None and not self.body_matches and not self.needs_json)
+
+    def check_head(self, status_code, headers, expected, variables):
+        # Status and headers, before any of the body is read; returns the
+        # failed check or None
+        if self.status is not None:
+            if status_code not in self.status:
+                return 'status'
+        elif expected is not None:
+            if str(status_code) != expected:
+                return 'status'
+        elif status_code >= 400:
+            return 'status'
+        for name, test in self.header_checks:
+            value = headers.get(name)
+            if value is None or not test(value):
+                return 'header'
+        for variable, name in self.header_saves:
+            value = headers.get(name)
+            if value is None:
+                return 'save'
+            variables[variable] = value
+        return None
+
+    def check_body(self, response, variables):
+        # Reads the body only while a check still needs it: substring and
+        # regex checks stop the download at their first match, JSON checks
+        # need all of it. Nothing is kept once the step is evaluated.
+        pending = self.body_matches
+        buffer = bytearray()
+        chunks = response.iter_content(BODY_CHUNK_SIZE)
+        complete = False
+        if pending or self.needs_json:
+            for chunk in chunks:
+                scanned = len(buffer)
+                buffer += chunk[:CHECK_MAX_BODY_BYTES - scanned]
+                pending = [match for match in pending if not match.search(buffer, scanned, variables)]
+                if len(buffer) >= CHECK_MAX_BODY_BYTES or not (pending or self.needs_json):
+                    break
+            else:
+                complete = True
+        read = len(buffer)
+        if not complete:
+            read += drain(response, chunks, read)
+        body_bytes.inc(amount=read)
+        if pending:
+            return pending[0].check
+        if not self.needs_json:
+            return None
+        if not complete:
+            return 'json'
+        try:
+            document = json.loads(buffer)
+        except ValueError:
+            return 'json'
+        for keys, expected in self.json_checks:
+            value = lookup(document, keys)
+            if value is MISSING or (expected is not MISSING and value != expected):
+                return 'json'
+        for variable, keys in self.json_saves:
+            value = lookup(document, keys)
+            if value is MISSING:
+                return 'save'
+            variables[variable] = saved_text(value)
+        return None
+
+def drain(response, chunks, read):
+    # Reading a short remainder lets the connection be reused;
+    # response.close() discards the connection of a longer one. Returns the
+    # bytes read.
+    length = response.headers.get('Content-Length')
+    if length is not None and length.isdigit() and int(length) - read > CHECK_DRAIN_BYTES:
+        return 0
+    drained = 0
+    for chunk in chunks:
+        drained += len(chunk)
+        if drained > CHECK_DRAIN_BYTES:
+            break
+    return drained
+
+def header_test(check):
+    tests = [key for key in ('equals', 'contains', 'regex') if key in check]
+    if len(tests) > 1:
+        raise ValueError("A header check takes one of equals, contains or regex")
+    if not tests:
+        return lambda value: True
+    expected = check[tests[0]]
+    if not isinstance(expected, str):
+        raise ValueError(f"Header {tests[0]} must be a string")
+    if tests[0] == 'equals':
+        return lambda value: value == expected
+    if tests[0] == 'contains':
+        return lambda value: expected in value
+    try:
+        pattern = re.compile(expected)
+    except re.error as e:
+        raise ValueError(f"Invalid regex {expected!r}: {e}")
+    return lambda value: pattern.search(value) is not None
+
+def compile_check(step, check):
+    if not isinstance(check, dict):
+        raise ValueError(f"A check must be an object, got {json.dumps(check)}")
+    names = [key for key in check if key in CHECK_KEYS]
+    if len(names) != 1:
+        raise ValueError(f"A check needs exactly one of {', '.join(CHECK_KEYS)}, got {json.dumps(check)}")
+    name = names[0]
+    unknown = set(check) - CHECK_KEYS[name]
+    if unknown:
+        raise ValueError(f"Unknown key {sorted(unknown)[0]!r} in {name} check")
+    value = check[name]
+    if name == 'status':
+        codes = value if isinstance(value, list) else [value]
+        if not codes or not all(isinstance(code, int) and 100 <= code <= 599 for code in codes):
+            raise ValueError("status must be an HTTP status code or a list of them")
+        step.status = frozenset(codes) | (step.status or frozenset())
+    elif name == 'body_contains':
+        if not isinstance(value, str) or not value:
+            raise ValueError("body_contains must be a non-empty string")
+        step.body_matches.append(BodyMatch(name, needle=value.encode('utf-8')))
+    elif name == 'body_regex':
+        step.body_matches.append(BodyMatch(name, pattern=compile_regex(value)))
+    elif name == 'json':
+        step.json_checks.append((json_path(value), check.get('equals', MISSING)))
+    elif name == 'header':
+        if not isinstance(value, str) or not value:
+            raise ValueError("header must be a header name")
+        step.header_checks.append((value, header_test(check)))
+    else:
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+            raise ValueError("max_ms must be a number of milliseconds greater than 0")
+        step.max_ms = value
+
+def compile_save(step, variable, extractor):
+    if not isinstance(extractor, dict) or len(extractor) != 1:
+        raise ValueError(f"save {variable!r} needs exactly one of json, header or regex")
+    (kind, value), = extractor.items()
+    if kind == 'json':
+        step.json_saves.append((variable, json_path(value)))
+    elif kind == 'header':
+        if not isinstance(value, str) or not value:
+            raise ValueError("header must be a header name")
+        step.header_saves.append((variable, value))
+    elif kind == 'regex':
+        step.body_matches.append(BodyMatch('save', pattern=compile_regex(value), save=variable))
+    else:
+        raise ValueError(f"save {variable!r} needs exactly one of json, header or regex")
+
+def compile_step(spec):
+    if not isinstance(spec, dict):
+        raise ValueError("A step must be an object")
+    unknown = set(spec) - STEP_KEYS
+    if unknown:
+        raise ValueError(f"Unknown step key {sorted(unknown)[0]!r}")
+    step = Step()
+    step.method = str(spec.get('method', 'GET')).upper()
+    if step.method not in METHODS:
+        raise ValueError(f"Unsupported method {spec['method']!r}")
+    step.url = spec.get('url')
+    if step.url is not None and not isinstance(step.url, str):
+        raise ValueError("url must be a string")
+    step.headers = spec.get('headers')
+    if step.headers is not None and not (isinstance(step.headers, dict)
+                                         and all(isinstance(value, str) for value in step.headers.values())):
+        raise ValueError("headers must be an object of strings")
+    if 'body' in spec and 'json' in spec:
+        raise ValueError("A step sends body or json, not both")
+    step.body = spec.get('body')
+    if step.body is not None and not isinstance(step.body, str):
+        raise ValueError("body must be a string")
+    step.json = spec.get('json')
+    checks = spec.get('expect', [])
+    if not isinstance(checks, list):
+        raise ValueError("expect must be a list of checks")
+    for check in checks:
+        compile_check(step, check)
+    saves = spec.get('save', {})
+    if not isinstance(saves, dict):
+        raise ValueError("save must be an object of variable names")
+    for variable, extractor in saves.items():
+        if not re.fullmatch(r'[A-Za-z_][A-Za-z0-9_]*', variable):
+            raise ValueError(f"Invalid variable name {variable!r}")
+        compile_save(step, variable, extractor)
+    return step
+
+def compile_assertions(text):
+    # Assertions column -> tuple of Steps. The column holds JSON: a list of
+    # checks on the monitor's Connection, or {"steps": [...]} for a flow.
+    if not text:
+        return DEFAULT_FLOW
+    try:
+        spec = json.loads(text)
+    except ValueError as e:
+        raise ValueError(f"Assertions must be JSON: {e}")
+    if isinstance(spec, list):
+        steps = [{'expect': spec}]
+    elif isinstance(spec, dict) and set(spec) == {'steps'}:
+        steps = spec['steps']
+    elif isinstance(spec, dict):
+        steps = [spec]
+    else:
+        raise ValueError("Assertions must be a list of checks or an object with steps")
+    if not isinstance(steps, list) or not steps:
+        raise ValueError("steps must be a non-empty list")
+    if len(steps) > CHECK_MAX_STEPS:
+        raise ValueError(f"At most {CHECK_MAX_STEPS} steps are allowed")
+    flow = []
+    for number, step in enumerate(steps, start=1):
+        try:
+            flow.append(compile_step(step))
+        except ValueError as e:
+            raise ValueError(f"Step {number}: {e}" if len(steps) > 1 else str(e))
+    return tuple(flow)
+
+DEFAULT_FLOW = (Step(),)
+
+def parse_assertions(value):
+    # Validates an Assertions value from a form or import; '' means none
+    if value is None or not str(value).strip():
+        return None
+    value = str(value).strip()
+    try:
+        compile_assertions(value)
+    except ValueError as e:
+        raise ValueError(f"Invalid Assertions: {e}")
+    return value
+
+class AssertionCache:
+    # Compiled checks per monitor, compiled again only when the monitor's
+    # Assertions text changes
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flows = {}
+
+    def get(self, monitor):
+        text = monitor.get('Assertions') or ''
+        entry = self._flows.get(monitor['AlertName'])
+        if entry is not None and entry[0] == text:
+            return entry[1]
+        flow = compile_assertions(text)
+        with self._lock:
+            self._flows[monitor['AlertName']] = (text, flow)
+        return flow
+
+    def forget(self, alert_name):
+        with self._lock:
+            self._flows.pop(alert_name, None)
+
+assertion_cache = AssertionCache()
+
+def run_step(session, step, monitor, timeout, phases, variables, cookies, expected):
+    url = monitor['Connection']
+    if step.url:
+        url = urljoin(url, fill(step.url, variables))
+    before = sum(phases.values())
+    started = time.perf_counter()
+    response = session.request(step.method, url, headers=fill(step.headers, variables),
+                               data=fill(step.body, variables), json=fill(step.json, variables),
+                               cookies=cookies, timeout=timeout, stream=True)
+    try:
+        # elapsed runs from sending the request to parsing the headers and
+        # includes setting up a new connection
+        spent = sum(phases.values()) - before
+        phases['first_byte'] = phases.get('first_byte', 0.0) + max(0.0, response.elapsed.total_seconds() - spent)
+        if cookies is not None:
+            cookies.update(response.cookies)
+        failed = step.check_head(response.status_code, response.headers, expected, variables)
+        read_started = time.perf_counter()
+        if failed is None:
+            failed = step.check_body(response, variables)
+        else:
+            body_bytes.inc(amount=drain(response, response.iter_content(BODY_CHUNK_SIZE), 0))
+        finished = time.perf_counter()
+        phases['body'] = phases.get('body', 0.0) + finished - read_started
+        if failed is None and step.max_ms is not None and (finished - started) * 1000 > step.max_ms:
+            failed = 'max_ms'
+        return response, failed
+    finally:
+        response.close()
+
+def run_http_check(session, monitor, timeout, phases):
+    # Runs the monitor's steps in order, stopping at the first failed
+    # assertion. Steps share cookies and saved values. Returns (status,
+    # status code of the last response).
+    flow = assertion_cache.get(monitor)
+    variables = {}
+    cookies = RequestsCookieJar() if len(flow) > 1 else None
+    status_code = None
+    for number, step in enumerate(flow, start=1):
+        expected = monitor.get('Response') if number == len(flow) else None
+        response, failed = run_step(session, step, monitor, timeout, phases, variables, cookies, expected)
+        status_code = response.status_code
+        if failed is not None:
+            assertion_failures.inc(failed)
+            return 'DOWN', status_code
+    return 'UP', status_code
+
+def reads_head_only(flow):
+    return len(flow) == 1 and flow[0].reads_head_only
+
+def fetch_head(session, monitor, timeout, phases):
+    # One plain GET of Connection for every monitor that reads_head_only;
+    # the body is drained, not read. Returns the (closed) response.
+    response, _ = run_step(session, DEFAULT_FLOW[0], monitor, timeout, phases, {}, None, None)
+    return response
+
+def judge_head(monitor, status_code, headers, latency_ms):
+    # This monitor's verdict on a response fetched by fetch_head
+    step = assertion_cache.get(monitor)[0]
+    failed = step.check_head(status_code, headers, monitor.get('Response'), {})
+    if failed is None and step.max_ms is not None and latency_ms > step.max_ms:
+        failed = 'max_ms'
+    if failed is not None:
+        assertion_failures.inc(failed)
+        return 'DOWN'
+    return 'UP'
@@ -0,0 +1,385 @@
+import argparse
+import io
+import json
+import math
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Fleet sizes, stand-in servers and result files for `python benchmark.py`.
+# Every run works on its own temporary SQLite database, so monitor.db is
+# never touched.
+DEFAULT_SIZES = '1000,10000'
+DEFAULT_HOSTS = 20
+DEFAULT_PAGE_REQUESTS = 200
+RESULTS_FOLDER = 'benchmark-results'
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # Answers every GET after the server's latency, with a 500 for the
+    # configured share of requests
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; with Nagle on, every
+    # request on a kept-alive connection waits out the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        server = self.server
+        delay = server.latency + random.uniform(-server.jitter, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        status = 500 if random.random() < server.error_rate else 200
+        body = b'ok'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency, jitter, error_rate):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+class StandInTCPServer:
+    # Accepts and immediately closes connections; the TCP probe only times
+    # the connect
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1024)
+        self.port = self.sock.getsockname()[1]
+
+    def serve_forever(self):
+        while True:
+            conn, _ = self.sock.accept()
+            conn.close()
+
+def closed_port():
+    # A port nothing listens on, for TCP monitors that should fail
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+def serve_stand_ins(pipe, hosts, latency, jitter, error_rate):
+    http_servers = [StandInHTTPServer(latency, jitter, error_rate) for _ in range(hosts)]
+    tcp_server = StandInTCPServer()
+    for server in http_servers:
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+    pipe.send(([server.port for server in http_servers], tcp_server.port))
+    tcp_server.serve_forever()
+
+def start_stand_ins(hosts, latency, jitter, error_rate):
+    # The servers run in their own process so they don't compete with the
+    # checker for the GIL. Returns (HTTP ports, TCP port).
+    parent, child = multiprocessing.Pipe()
+    multiprocessing.Process(target=serve_stand_ins, args=(child, hosts, latency, jitter, error_rate),
+                            daemon=True).start()
+    return parent.recv()
+
+def fleet_csv(size, http_ports, tcp_port, down_port, tcp_share, error_rate):
+    # Monitors and services CSVs in the import format, every monitor UP
+    monitors = io.StringIO()
+    services = io.StringIO()
+    monitors.write('AlertName,Connection,ServiceType,HealthCheck,Response,Description,Status,ScheduleTime,Frequency\n')
+    services.write('AlertName,ServiceType,HostName,CheckStatus\n')
+    rng = random.Random(size)
+    for i in range(size):
+        name = f'bench-{i:06d}'
+        if rng.random() < tcp_share:
+            port = down_port if rng.random() < error_rate else tcp_port
+            monitors.write(f'{name},127.0.0.1:{port},TCP,connect,open,benchmark,UP,,1\n')
+            service_type = 'TCP'
+        else:
+            port = http_ports[i % len(http_ports)]
+            monitors.write(f'{name},http://127.0.0.1:{port}/health/{i},HTTP,GET,200,benchmark,UP,,1\n')
+            service_type = 'HTTP'
+        services.write(f'{name},{service_type},host-{i % len(http_ports)},UP\n')
+    return monitors.getvalue().encode('utf-8'), services.getvalue().encode('utf-8')
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(math.ceil(fraction * len(values))) - 1)]
+
+def timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - started, result
+
+def reset_database():
+    from storage import get_db_connection
+    from registry import registry
+    from scheduler import check_scheduler
+    with get_db_connection() as conn:
+        for table in ('monitors', 'services', 'monitorSchedule', 'checkHistory', 'monitorChanges'):
+            conn.execute(f'DELETE FROM {table}')
+        conn.commit()
+    for name in check_scheduler.names():
+        check_scheduler.remove(name)
+    registry.load()
+
+def bench_import(client, metrics, size, monitors_csv, services_csv):
+    for label, url, data in (('monitors', '/import', monitors_csv), ('services', '/service/import', services_csv)):
+        seconds, response = timed(client.post, url,
+                                  data={'file': (io.BytesIO(data), f'{label}.csv')},
+                                  content_type='multipart/form-data')
+        if response.status_code >= 400:
+            raise RuntimeError(f"Import of {label} failed with HTTP {response.status_code}")
+        metrics[f'import_{label}_seconds'] = seconds
+        metrics[f'import_{label}_per_second'] = size / seconds
+
+# Assertions for the second sweep: a body, header and latency check on
+# every HTTP monitor, to compare with the status-only sweep
+SWEEP_ASSERTIONS = json.dumps([{'body_contains': 'ok'}, {'header': 'Content-Length'}, {'max_ms': 10000}])
+
+def bench_sweep(metrics, concurrency, assertions=None, prefix=''):
+    # One full pass over the fleet, the way run_health_checks does it: probe
+    # through the engine, record through the flap detector and result writer
+    from checker import ProbeCoalescer, ProbeEngine, run_probe, load_monitors, record_result, probes_coalesced
+    from scheduler import CheckScheduler
+    from result_writer import result_writer
+    monitors = load_monitors()
+    if assertions:
+        monitors = [dict(monitor, Assertions=assertions) if monitor['ServiceType'] == 'HTTP' else monitor
+                    for monitor in monitors]
+    engine = ProbeCoalescer(ProbeEngine(run_probe, max_workers=concurrency))
+    scheduler = CheckScheduler()
+    scheduler.load(monitors)
+    writer = result_writer.start()
+    recorded = queue.Queue()
+    coalesced = sum(value for _, _, value in probes_coalesced.samples())
+
+    def done(future, monitor):
+        record_result(monitor, future, scheduler, writer)
+        recorded.put(None if future.exception() else future.result())
+
+    started = time.perf_counter()
+    for monitor in monitors:
+        engine.submit(monitor).add_done_callback(lambda f, monitor=monitor: done(f, monitor))
+    results = [recorded.get() for _ in monitors]
+    probed = time.perf_counter()
+    writer.flush()
+    written = time.perf_counter()
+    engine.shutdown()
+
+    latencies = [r['LatencyMs'] for r in results if r and r['LatencyMs'] is not None]
+    metrics[f'{prefix}sweep_seconds'] = written - started
+    metrics[f'{prefix}probes_per_second'] = len(monitors) / (probed - started)
+    metrics[f'{prefix}result_drain_seconds'] = written - probed
+    metrics[f'{prefix}probe_p50_ms'] = percentile(latencies, 0.50)
+    metrics[f'{prefix}probe_p95_ms'] = percentile(latencies, 0.95)
+    metrics[f'{prefix}probes_down'] = sum(1 for r in results if not r or r['Status'] == 'DOWN')
+    metrics[f'{prefix}probes_coalesced'] = sum(value for _, _, value in probes_coalesced.samples()) - coalesced
+
+def bench_writes(metrics):
+    # Result writer throughput on its own: one synthetic result per monitor
+    from checker import check_result
+    from registry import registry
+    from result_writer import result_writer
+    results = [check_result(monitor, 'UP', 1.0, 200) for monitor in registry.dicts('monitors')]
+    writer = result_writer.start()
+    started = time.perf_counter()
+    for result in results:
+        result['ProbeStatus'] = result['Status']
+        writer.submit(result)
+    writer.flush()
+    metrics['result_writes_per_second'] = len(results) / (time.perf_counter() - started)
+
+def bench_schedule(metrics, size):
+    from monitor_schedule import update_monitor_schedule, apply_schedule_changes, take_schedule_dirty
+    take_schedule_dirty(0)
+    metrics['schedule_reconcile_seconds'] = timed(update_monitor_schedule)[0]
+    sample = [f'bench-{i:06d}' for i in random.Random(size).sample(range(size), max(1, size // 100))]
+    metrics['schedule_apply_1pct_seconds'] = timed(apply_schedule_changes, sample)[0]
+
+def bench_exports(metrics, size):
+    from exporter import export_stream, FORMATS, ExportError, check_format
+    for fmt in FORMATS:
+        try:
+            check_format(fmt)
+        except ExportError:
+            continue
+        started = time.perf_counter()
+        chunks, _, _ = export_stream('monitors', fmt)
+        total = sum(len(chunk) for chunk in chunks)
+        seconds = time.perf_counter() - started
+        metrics[f'export_{fmt}_rows_per_second'] = size / seconds
+        metrics[f'export_{fmt}_mb_per_second'] = total / 1e6 / seconds
+
+def bench_pages(client, metrics, requests_per_page):
+    # Latency of each page cold (nothing cached), warm (cached body) and
+    # revalidated (304)
+    from page_cache import page_cache
+    pages = {'home': '/', 'services': '/services', 'schedule': '/monitor-schedule',
+             'api_monitors': '/api/monitors?limit=100',
+             'api_monitors_by_status': '/api/monitors?limit=100&sort=Status&order=desc',
+             'api_services': '/api/services?limit=100&host_name=host-1',
+             'api_schedule': '/api/monitor-schedule?limit=100&sort=LastCheckTime'}
+    for label, url in pages.items():
+        timings = {'cold': [], 'warm': [], 'revalidate': []}
+        etag = client.get(url).headers.get('ETag')
+        for _ in range(requests_per_page):
+            page_cache.clear()
+            timings['cold'].append(timed(client.get, url)[0] * 1000)
+            timings['warm'].append(timed(client.get, url)[0] * 1000)
+            timings['revalidate'].append(timed(client.get, url, headers={'If-None-Match': etag})[0] * 1000)
+        for mode, values in timings.items():
+            metrics[f'page_{label}_{mode}_p50_ms'] = percentile(values, 0.50)
+            metrics[f'page_{label}_{mode}_p95_ms'] = percentile(values, 0.95)
+
+STARTUP_COMMANDS = {'web': 'from app import create_app; create_app(start_threads=False)',
+                    'worker': 'import worker'}
+
+def bench_startup(metrics):
+    # Cold start of a fresh interpreter against the current database: the
+    # web app up to a ready Flask app, a worker up to importing its modules
+    for label, code in STARTUP_COMMANDS.items():
+        started = time.perf_counter()
+        subprocess.run([sys.executable, '-c', code], check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        metrics[f'startup_{label}_seconds'] = time.perf_counter() - started
+
+def run_size(client, args, size, servers):
+    http_ports, tcp_port = servers
+    monitors_csv, services_csv = fleet_csv(size, http_ports, tcp_port, closed_port(),
+                                           args.tcp_share, args.error_rate)
+    reset_database()
+    metrics = {}
+    print(f"[{size} monitors] import")
+    bench_import(client, metrics, size, monitors_csv, services_csv)
+    print(f"[{size} monitors] sweep")
+    bench_sweep(metrics, args.concurrency)
+    print(f"[{size} monitors] sweep with assertions")
+    bench_sweep(metrics, args.concurrency, SWEEP_ASSERTIONS, prefix='assertions_')
+    print(f"[{size} monitors] result writes")
+    bench_writes(metrics)
+    print(f"[{size} monitors] schedule")
+    bench_schedule(metrics, size)
+    print(f"[{size} monitors] exports")
+    bench_exports(metrics, size)
+    print(f"[{size} monitors] pages")
+    bench_pages(client, metrics, args.page_requests)
+    print(f"[{size} monitors] startup")
+    bench_startup(metrics)
+    return {'monitors': size, 'metrics': metrics}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def slowdown(name, before, after):
+    # >1 means worse. Rates are better higher, durations better lower;
+    # counts are not compared.
+    if not before or not after:
+        return None
+    if name.endswith('_per_second'):
+        return before / after
+    if name.endswith('_seconds') or name.endswith('_ms'):
+        return after / before
+    return None
+
+def compare(results, baseline_path, tolerance):
+    # Prints every metric that moved against the baseline; returns the
+    # number that got worse by more than the tolerance
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = {run['monitors']: run['metrics'] for run in json.load(f)['runs']}
+    regressions = 0
+    for run in results['runs']:
+        before = baseline.get(run['monitors'])
+        if before is None:
+            print(f"[{run['monitors']} monitors] not in baseline")
+            continue
+        for name, value in sorted(run['metrics'].items()):
+            ratio = slowdown(name, before.get(name), value)
+            if ratio is None:
+                continue
+            regressed = ratio > 1 + tolerance
+            regressions += regressed
+            if regressed or ratio < 1 - tolerance:
+                label = 'REGRESSED' if regressed else 'improved'
+                print(f"[{run['monitors']} monitors] {name}: {before[name]:.4g} -> {value:.4g} ({label}, x{ratio:.2f})")
+    return regressions
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the checker, database writes, imports, exports and pages against synthetic fleets")
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help="comma-separated fleet sizes (default %(default)s)")
+    parser.add_argument('--hosts', type=int, default=DEFAULT_HOSTS, help="stand-in HTTP servers (default %(default)s)")
+    parser.add_argument('--latency-ms', type=float, default=20, help="stand-in response latency (default %(default)s)")
+    parser.add_argument('--jitter-ms', type=float, default=10, help="random +/- added to the latency (default %(default)s)")
+    parser.add_argument('--error-rate', type=float, default=0.05, help="share of HTTP 500s and refused TCP connects (default %(default)s)")
+    parser.add_argument('--tcp-share', type=float, default=0.2, help="share of TCP monitors (default %(default)s)")
+    parser.add_argument('--concurrency', type=int, default=None, help="probe workers (default CHECK_CONCURRENCY)")
+    parser.add_argument('--page-requests', type=int, default=DEFAULT_PAGE_REQUESTS, help="requests per page and mode (default %(default)s)")
+    parser.add_argument('--output', help=f"results file (default {RESULTS_FOLDER}/<timestamp>.json)")
+    parser.add_argument('--compare', metavar='BASELINE', help="results file to compare against; exits 1 on regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed slowdown before a metric counts as regressed (default %(default)s)")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    workdir = tempfile.mkdtemp(prefix='monitor-bench-')
+    # Settings are read at import time, so the database must be chosen before
+    # the application modules are loaded
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+    from app import create_app
+    from checker import CHECK_CONCURRENCY
+    args.concurrency = args.concurrency or CHECK_CONCURRENCY
+
+    servers = start_stand_ins(args.hosts, args.latency_ms / 1000, args.jitter_ms / 1000, args.error_rate)
+    client = create_app(start_threads=False).test_client()
+    started_at = datetime.now(timezone.utc)
+    results = {'format': 1,
+               'started_at': started_at.isoformat(),
+               'git_commit': git_commit(),
+               'python': platform.python_version(),
+               'platform': platform.platform(),
+               'cpus': os.cpu_count(),
+               'settings': {key: value for key, value in vars(args).items() if key not in ('output', 'compare')},
+               'runs': [run_size(client, args, size, servers) for size in sizes]}
+
+    output = args.output or os.path.join(RESULTS_FOLDER, started_at.strftime('%Y%m%dT%H%M%SZ') + '.json')
+    os.makedirs(os.path.dirname(output) or '.', exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    for run in results['runs']:
+        m = run['metrics']
+        print(f"[{run['monitors']} monitors] sweep {m['sweep_seconds']:.2f}s, "
+              f"{m['probes_per_second']:.0f} probes/s, {m['result_writes_per_second']:.0f} writes/s, "
+              f"import {m['import_monitors_per_second']:.0f} rows/s")
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        print(f"{regressions} regression(s) against {args.compare}")
+        sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+import os
+import threading
+import time
+from metrics import metrics
+
+# Consecutive transport failures (refused, reset, timed out, unresolvable)
+# against one host before its circuit opens; 0 disables circuit breaking
+BREAKER_FAILURES = int(os.getenv('BREAKER_FAILURES', '5'))
+# An open circuit lets one trial probe through after this long, doubling
+# after every failed trial up to the maximum
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', '30'))
+BREAKER_MAX_OPEN_SECONDS = float(os.getenv('BREAKER_MAX_OPEN_SECONDS', '600'))
+
+# Per-monitor timeouts follow observed latency (smoothed latency plus four
+# deviations, as TCP does for retransmits), never above the configured
+# timeouts and never below ADAPTIVE_TIMEOUT_MIN
+ADAPTIVE_TIMEOUTS = os.getenv('ADAPTIVE_TIMEOUTS', '1') == '1'
+ADAPTIVE_TIMEOUT_MIN = float(os.getenv('ADAPTIVE_TIMEOUT_MIN', '1'))
+# Successful probes needed before a monitor's timeout adapts
+ADAPTIVE_TIMEOUT_SAMPLES = 5
+# A timed-out probe doubles the adaptive timeout for the next one, up to this
+ADAPTIVE_TIMEOUT_BACKOFF_MAX = 8
+
+breaker_trips = metrics.counter('monitor_breaker_trips_total', 'Times a host circuit opened')
+short_circuits = metrics.counter('monitor_probes_short_circuited_total',
+                                 'Checks answered DOWN without probing because their host circuit was open')
+
+class HostBreakers:
+    # One circuit per probe host. Closed: every probe runs. Open: probes are
+    # answered without touching the network. Once the open period is over
+    # the circuit is half-open: a single trial probe runs, and its outcome
+    # closes the circuit or re-opens it for twice as long.
+
+    def __init__(self, failures=BREAKER_FAILURES, open_seconds=BREAKER_OPEN_SECONDS,
+                 max_open_seconds=BREAKER_MAX_OPEN_SECONDS):
+        self.failures = failures
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self._lock = threading.Lock()
+        # host -> [consecutive failures, open until, open seconds, trial started]
+        self._hosts = {}
+
+    def allow(self, host, now=None):
+        if self.failures <= 0:
+            return True
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            state = self._hosts.get(host)
+            if state is None or state[1] is None:
+                return True
+            if now < state[1]:
+                return False
+            # Half-open; a trial that never reported back (e.g. the process
+            # lost it) is replaced after another open period
+            if state[3] is not None and now - state[3] < state[2]:
+                return False
+            state[3] = now
+            return True
+
+    def record(self, host, ok, now=None):
+        if self.failures <= 0:
+            return
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            state = self._hosts.get(host)
+            if ok:
+                if state is not None:
+                    del self._hosts[host]
+                return
+            if state is None:
+                state = self._hosts[host] = [0, None, self.open_seconds, None]
+            state[0] += 1
+            if state[1] is None:
+                if state[0] >= self.failures:
+                    state[1] = now + state[2]
+                    breaker_trips.inc()
+            elif state[3] is not None:
+                # The trial failed
+                state[2] = min(state[2] * 2, self.max_open_seconds)
+                state[1] = now + state[2]
+                state[3] = None
+
+    def open_hosts(self):
+        with self._lock:
+            return sum(1 for state in self._hosts.values() if state[1] is not None)
+
+class EndpointStats:
+    # Per-monitor latency estimate and run of transport failures; drives the
+    # adaptive timeouts and how far the scheduler backs off
+
+    def __init__(self, adaptive=ADAPTIVE_TIMEOUTS, minimum=ADAPTIVE_TIMEOUT_MIN):
+        self.adaptive = adaptive
+        self.minimum = minimum
+        self._lock = threading.Lock()
+        # AlertName -> [smoothed latency, deviation, samples, timeout multiplier, failures]
+        self._stats = {}
+
+    def record(self, alert_name, outcome, latency=None):
+        # outcome: 'ok' (any answer, with latency in seconds), 'timeout' or
+        # 'error'
+        with self._lock:
+            stats = self._stats.get(alert_name)
+            if stats is None:
+                stats = self._stats[alert_name] = [None, 0.0, 0, 1, 0]
+            if outcome == 'ok':
+                if stats[0] is None:
+                    stats[0], stats[1] = latency, latency / 2
+                else:
+                    stats[1] = 0.75 * stats[1] + 0.25 * abs(stats[0] - latency)
+                    stats[0] = 0.875 * stats[0] + 0.125 * latency
+                stats[2] += 1
+                stats[3] = 1
+                stats[4] = 0
+                return
+            if outcome == 'timeout':
+                stats[3] = min(stats[3] * 2, ADAPTIVE_TIMEOUT_BACKOFF_MAX)
+            stats[4] += 1
+
+    def short_circuited(self, alert_name):
+        with self._lock:
+            stats = self._stats.setdefault(alert_name, [None, 0.0, 0, 1, 0])
+            stats[4] += 1
+
+    def failures(self, alert_name):
+        stats = self._stats.get(alert_name)
+        return 0 if stats is None else stats[4]
+
+    def timeout(self, alert_name, configured):
+        # configured: (connect, read) seconds; each is only ever lowered
+        if not self.adaptive:
+            return configured
+        stats = self._stats.get(alert_name)
+        if stats is None or stats[2] < ADAPTIVE_TIMEOUT_SAMPLES:
+            return configured
+        limit = max(self.minimum, stats[0] + 4 * stats[1]) * stats[3]
+        return tuple(min(value, limit) for value in configured)
+
+    def forget(self, alert_name):
+        with self._lock:
+            self._stats.pop(alert_name, None)
+
+host_breakers = HostBreakers()
+endpoint_stats = EndpointStats()
+
+metrics.gauge('monitor_breakers_open', 'Hosts whose circuit is open or half-open',
+              function=host_breakers.open_hosts)
@@ -0,0 +1,203 @@
+import json
+import os
+from datetime import datetime
+from storage import get_db_connection, in_list
+from registry import registry
+from scheduler import check_scheduler
+from monitor_schedule import mark_schedule_dirty
+from alerts import flap_detector
+from breakers import endpoint_stats
+from assertions import assertion_cache
+from events import broadcaster
+from importer import MONITOR_COLUMNS, MONITOR_OPTIONAL_COLUMNS, MONITOR_UPSERT, MONITOR_UPSERT_COLUMNS, \
+    SERVICE_COLUMNS, SERVICE_UPSERT, validate_monitors, validate_services
+
+# Upserts plus deletes accepted in one request
+BULK_MAX_ITEMS = int(os.getenv('BULK_MAX_ITEMS', '50000'))
+
+# Per resource: the fields an upsert takes (in the importer's row order) and
+# the current values read before writing, for per-item results and
+# incremental updates
+BULK_RESOURCES = {
+    'monitors': {'fields': MONITOR_COLUMNS + MONITOR_OPTIONAL_COLUMNS, 'current': 'CheckTime'},
+    'services': {'fields': SERVICE_COLUMNS, 'current': 'CheckStatus'},
+}
+
+class BulkError(ValueError):
+    pass
+
+def cell(value):
+    # JSON values to the strings the CSV validators expect; Assertions may
+    # be given as JSON rather than as a string holding it
+    if value is None:
+        return ''
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+def parse_changes(payload):
+    # {"monitors": {"upsert": [...], "delete": [...]}, "services": {...},
+    #  "atomic": true} -> ({resource: (upserts, deletes)}, atomic)
+    if not isinstance(payload, dict):
+        raise BulkError("Body must be a JSON object")
+    unknown = set(payload) - set(BULK_RESOURCES) - {'atomic'}
+    if unknown:
+        raise BulkError(f"Unknown key {sorted(unknown)[0]!r}; expected monitors, services or atomic")
+    atomic = payload.get('atomic', True)
+    if not isinstance(atomic, bool):
+        raise BulkError("atomic must be true or false")
+    changes = {}
+    total = 0
+    for resource in BULK_RESOURCES:
+        spec = payload.get(resource, {})
+        if not isinstance(spec, dict) or set(spec) - {'upsert', 'delete'}:
+            raise BulkError(f"{resource} must be an object with upsert and/or delete lists")
+        upserts = spec.get('upsert', [])
+        deletes = spec.get('delete', [])
+        if not isinstance(upserts, list) or not isinstance(deletes, list):
+            raise BulkError(f"{resource} upsert and delete must be lists")
+        changes[resource] = (upserts, deletes)
+        total += len(upserts) + len(deletes)
+    if total > BULK_MAX_ITEMS:
+        raise BulkError(f"At most {BULK_MAX_ITEMS} changes per request, got {total}")
+    return changes, atomic
+
+def validate_upserts(resource, upserts, check_time, seen):
+    # Returns ({index: valid row}, {index: error}); rows are shaped for the
+    # importer's upsert statements
+    fields = BULK_RESOURCES[resource]['fields']
+    chunk = []
+    errors = {}
+    for index, item in enumerate(upserts):
+        if not isinstance(item, dict) or not isinstance(item.get('AlertName'), str) or not item['AlertName']:
+            errors[index] = "Each upsert must be an object with an AlertName"
+            continue
+        unknown = set(item) - set(fields)
+        if unknown:
+            errors[index] = f"Unknown field {sorted(unknown)[0]!r}"
+        elif item['AlertName'] in seen:
+            errors[index] = "AlertName appears more than once in this batch"
+        else:
+            chunk.append((index, tuple(cell(item.get(field)) for field in fields)))
+        seen.add(item['AlertName'])
+    if resource == 'monitors':
+        valid, invalid = validate_monitors(chunk, check_time)
+    else:
+        valid, invalid = validate_services(chunk)
+    for index, _, message in invalid:
+        errors[index] = message
+    indexes = [index for index, _ in chunk if index not in errors]
+    return dict(zip(indexes, valid)), errors
+
+def validate_deletes(deletes, seen):
+    errors = {}
+    for index, name in enumerate(deletes):
+        if not isinstance(name, str) or not name:
+            # Not necessarily hashable, so never added to seen
+            errors[index] = "Each delete must be an AlertName"
+            continue
+        if name in seen:
+            errors[index] = "AlertName appears more than once in this batch"
+        seen.add(name)
+    return errors
+
+def current_values(conn, resource, names):
+    # AlertName -> CheckTime (monitors) or CheckStatus (services) of the rows
+    # that exist now
+    if not names:
+        return {}
+    column = BULK_RESOURCES[resource]['current']
+    condition, param = in_list('AlertName', names)
+    c = conn.execute(f'SELECT AlertName, {column} FROM {resource} WHERE {condition}', (param,))
+    return {row['AlertName']: row[column] for row in c}
+
+def apply_changes(changes):
+    # One transaction for every change; returns {resource: (rows upserted,
+    # names deleted, current values before the change)}
+    applied = {}
+    with get_db_connection() as conn:
+        with conn:
+            for resource, (rows, deletes) in changes.items():
+                names = [row[0] for row in rows] + deletes
+                current = current_values(conn, resource, names)
+                if rows:
+                    conn.executemany(MONITOR_UPSERT if resource == 'monitors' else SERVICE_UPSERT, rows)
+                if deletes:
+                    condition, param = in_list('AlertName', deletes)
+                    conn.execute(f'DELETE FROM {resource} WHERE {condition}', (param,))
+                applied[resource] = (rows, deletes, current)
+    return applied
+
+def update_monitors(rows, deletes, current):
+    # Registry, scheduler and per-monitor state, as the single-row routes
+    # and the importer do it, for the whole batch at once
+    monitors = [dict(zip(MONITOR_UPSERT_COLUMNS, row)) for row in rows]
+    registry.put_many('monitors', monitors, preserve=('CheckTime',))
+    # Existing monitors stay on their schedule; new ones are due now
+    check_scheduler.upsert_many([dict(monitor, CheckTime=current.get(monitor['AlertName']))
+                                 for monitor in monitors])
+    for monitor in monitors:
+        if monitor['AlertName'] in current:
+            # The target may have changed; learn its latency afresh
+            endpoint_stats.forget(monitor['AlertName'])
+    for name in deletes:
+        registry.remove('monitors', name)
+        check_scheduler.remove(name)
+        flap_detector.forget(name)
+        endpoint_stats.forget(name)
+        assertion_cache.forget(name)
+
+def update_services(rows, deletes, current):
+    registry.put_many('services', [dict(zip(SERVICE_COLUMNS, row)) for row in rows])
+    for name, _, _, check_status in rows:
+        previous = current.get(name)
+        if previous is not None and previous != check_status:
+            broadcaster.publish('service', {'AlertName': name, 'CheckStatus': check_status,
+                                            'PreviousStatus': previous})
+    for name in deletes:
+        registry.remove('services', name)
+
+def apply_bulk(payload):
+    # Validates every item, then applies the valid ones in one transaction.
+    # With atomic (the default) a single invalid item means nothing is
+    # applied. Returns (response body, HTTP status).
+    changes, atomic = parse_changes(payload)
+    check_time = datetime.now().isoformat()
+    results = []
+    valid = {}
+    failed = 0
+    for resource, (upserts, deletes) in changes.items():
+        seen = set()
+        rows, upsert_errors = validate_upserts(resource, upserts, check_time, seen)
+        delete_errors = validate_deletes(deletes, seen)
+        for action, items, errors in (('upsert', upserts, upsert_errors), ('delete', deletes, delete_errors)):
+            for index, item in enumerate(items):
+                name = item.get('AlertName') if isinstance(item, dict) else item
+                result = {'resource': resource, 'action': action, 'index': index, 'AlertName': name}
+                if index in errors:
+                    result.update(result='invalid', error=errors[index])
+                    failed += 1
+                results.append(result)
+        valid[resource] = ([rows[index] for index in sorted(rows)],
+                           [name for index, name in enumerate(deletes) if index not in delete_errors])
+
+    if failed and atomic:
+        for result in results:
+            result.setdefault('result', 'skipped')
+        return {'applied': 0, 'failed': failed, 'results': results}, 422
+
+    applied = apply_changes(valid)
+    update_monitors(*applied['monitors'])
+    update_services(*applied['services'])
+    mark_schedule_dirty([row[0] for rows, _, _ in applied.values() for row in rows]
+                        + [name for _, deletes, _ in applied.values() for name in deletes])
+
+    for result in results:
+        if 'result' in result:
+            continue
+        existed = result['AlertName'] in applied[result['resource']][2]
+        if result['action'] == 'upsert':
+            result['result'] = 'updated' if existed else 'created'
+        else:
+            result['result'] = 'deleted' if existed else 'not_found'
+    return {'applied': len(results) - failed, 'failed': failed, 'results': results}, 200
@@ -0,0 +1,481 @@
+import errno
+import os
+import selectors
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from datetime import datetime
+from urllib.parse import urlsplit
+from http.cookiejar import DefaultCookiePolicy
+import requests
+from requests.adapters import HTTPAdapter
+from registry import registry
+from scheduler import check_scheduler
+from result_writer import result_writer
+from events import broadcaster
+from alerts import flap_detector, alert_dispatcher
+from metrics import metrics, LAG_BUCKETS
+from breakers import host_breakers, endpoint_stats, short_circuits
+from resolver import dns_cache, POOL_CLASSES, reset_timings, record_phase
+from assertions import assertion_cache, run_http_check, reads_head_only, fetch_head, judge_head
+
+# Upper bound on probes in flight across all hosts
+CHECK_CONCURRENCY = int(os.getenv('CHECK_CONCURRENCY', '100'))
+# Upper bound on probes in flight against a single host
+CHECK_PER_HOST_LIMIT = int(os.getenv('CHECK_PER_HOST_LIMIT', '8'))
+# Number of per-host connection pools kept alive between checks
+HTTP_POOL_HOSTS = int(os.getenv('HTTP_POOL_HOSTS', '1000'))
+# Default timeouts (seconds), overridable per monitor via ConnectTimeout/ReadTimeout
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', '3'))
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', '5'))
+# Checks that would send the same request share one probe while it is in
+# flight and for this many seconds after it started; 0 probes every check
+# on its own
+PROBE_COALESCE_SECONDS = float(os.getenv('PROBE_COALESCE_SECONDS', '5'))
+
+def probe_host(monitor):
+    connection = monitor.get('Connection') or ''
+    if '://' in connection:
+        return urlsplit(connection).netloc.lower() or connection
+    return connection.split('/', 1)[0].lower()
+
+def parse_timeout(value):
+    if value in (None, ''):
+        return None
+    try:
+        timeout = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("Timeout must be a number")
+    if timeout <= 0:
+        raise ValueError("Timeout must be greater than 0 seconds")
+    return timeout
+
+def probe_timeout(monitor):
+    # Configured (connect, read) timeouts, lowered to what the monitor's
+    # observed latency suggests once there is enough history
+    return endpoint_stats.timeout(monitor['AlertName'],
+                                  (monitor.get('ConnectTimeout') or HTTP_CONNECT_TIMEOUT,
+                                   monitor.get('ReadTimeout') or HTTP_READ_TIMEOUT))
+
+def probe_failure(error):
+    # 'timeout' or 'error' when the target could not be reached at all, None
+    # for errors that say nothing about the target (e.g. a malformed URL)
+    if isinstance(error, (requests.Timeout, TimeoutError)):
+        return 'timeout'
+    if isinstance(error, requests.ConnectionError):
+        return 'error'
+    if isinstance(error, OSError) and not isinstance(error, requests.RequestException):
+        return 'error'
+    return None
+
+class CachedDNSAdapter(HTTPAdapter):
+    # New connections resolve through the shared DNS cache
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = POOL_CLASSES
+
+def create_http_session():
+    # One keep-alive pool per host, each capped at the per-host probe limit.
+    # pool_block makes extra requests wait for a pooled connection instead of
+    # opening (and then discarding) one more.
+    session = requests.Session()
+    adapter = CachedDNSAdapter(pool_connections=HTTP_POOL_HOSTS,
+                               pool_maxsize=CHECK_PER_HOST_LIMIT,
+                               pool_block=True,
+                               max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    # Probes must not leak cookies from one monitor into another
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+http_session = create_http_session()
+
+probe_duration = metrics.histogram('monitor_probe_duration_seconds',
+                                   'Probe latency by service type and probe outcome',
+                                   ('service_type', 'status'))
+probe_errors = metrics.counter('monitor_probe_errors_total',
+                               'Probes that raised instead of returning a status, by exception type',
+                               ('service_type', 'error'))
+check_lag = metrics.histogram('monitor_check_lag_seconds',
+                              'Time from when a check was due to when its probe started',
+                              buckets=LAG_BUCKETS)
+status_transitions = metrics.counter('monitor_status_transitions_total',
+                                     'Monitor status changes, by new status', ('status',))
+checks_scheduled = metrics.gauge('monitor_checks_scheduled', 'Monitors on the check schedule')
+checks_overdue = metrics.gauge('monitor_checks_overdue', 'Checks past due and not yet started')
+probe_queue_depth = metrics.gauge('monitor_probe_queue_depth', 'Due checks waiting for a probe worker')
+probes_in_flight = metrics.gauge('monitor_probes_in_flight', 'Probes currently running')
+probes_coalesced = metrics.counter('monitor_probes_coalesced_total',
+                                   'Checks answered by an identical probe instead of a request of their own',
+                                   ('service_type',))
+probe_phases = metrics.histogram('monitor_probe_phase_seconds',
+                                 'Probe time by phase: dns, connect, tls, first_byte and body',
+                                 ('service_type', 'phase'))
+
+class ProbeEngine:
+    # Bounded worker pool that runs probes concurrently while keeping any one
+    # host from taking more than its share of the workers. Pending probes are
+    # queued per host and handed to the pool round-robin, so a handful of slow
+    # hosts only ever hold CHECK_PER_HOST_LIMIT workers each.
+
+    def __init__(self, probe, max_workers=CHECK_CONCURRENCY, per_host_limit=CHECK_PER_HOST_LIMIT):
+        self.probe = probe
+        self.max_workers = max(1, max_workers)
+        self.per_host_limit = max(1, per_host_limit)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers,
+                                            thread_name_prefix='probe')
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._in_flight = {}
+        self._runnable = deque()
+        self._runnable_set = set()
+        self._active = 0
+
+    def submit(self, monitor):
+        future = Future()
+        host = probe_host(monitor)
+        with self._lock:
+            self._pending.setdefault(host, deque()).append((monitor, future))
+            self._mark_runnable(host)
+            self._pump()
+        return future
+
+    def sweep(self, monitors):
+        futures = [self.submit(monitor) for monitor in monitors]
+        return [future.result() for future in futures]
+
+    def pending(self):
+        with self._lock:
+            return sum(len(queue) for queue in self._pending.values())
+
+    def active(self):
+        return self._active
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+    def _mark_runnable(self, host):
+        if (host not in self._runnable_set and self._pending.get(host)
+                and self._in_flight.get(host, 0) < self.per_host_limit):
+            self._runnable.append(host)
+            self._runnable_set.add(host)
+
+    def _pump(self):
+        # Caller holds self._lock
+        while self._active < self.max_workers and self._runnable:
+            host = self._runnable.popleft()
+            self._runnable_set.discard(host)
+            queue = self._pending[host]
+            monitor, future = queue.popleft()
+            if not queue:
+                del self._pending[host]
+            self._in_flight[host] = self._in_flight.get(host, 0) + 1
+            self._active += 1
+            self._mark_runnable(host)
+            self._executor.submit(self._run, host, monitor, future)
+
+    def _run(self, host, monitor, future):
+        try:
+            future.set_result(self.probe(monitor))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._active -= 1
+                self._in_flight[host] -= 1
+                if not self._in_flight[host]:
+                    del self._in_flight[host]
+                self._mark_runnable(host)
+                self._pump()
+
+def parse_host_port(connection):
+    # Accepts host:port, [v6]:port or scheme://host:port
+    parts = urlsplit(connection if '://' in connection else '//' + connection)
+    if not parts.hostname or parts.port is None:
+        raise ValueError(f"Connection must be host:port, got {connection!r}")
+    return parts.hostname, parts.port
+
+def open_socket(host, port, sock_type):
+    started = time.perf_counter()
+    family, _, proto, _, address = dns_cache.resolve(host, port, type=sock_type)[0]
+    record_phase('dns', time.perf_counter() - started)
+    sock = socket.socket(family, sock_type, proto)
+    sock.setblocking(False)
+    return sock, address
+
+def wait_for(sock, event, timeout):
+    # select.select() cannot watch descriptors >= FD_SETSIZE (1024), which a
+    # busy checker soon hands out; the default selector (epoll/kqueue/poll)
+    # has no such limit
+    with selectors.DefaultSelector() as selector:
+        selector.register(sock, event)
+        return bool(selector.select(timeout))
+
+def tcp_probe(monitor):
+    # Non-blocking connect, then wait for writability; latency is the
+    # connect time. Returns (status, latency_ms); a failed or timed-out
+    # connect raises.
+    host, port = parse_host_port(monitor['Connection'])
+    timeout = probe_timeout(monitor)[0]
+    sock, address = open_socket(host, port, socket.SOCK_STREAM)
+    try:
+        started = time.perf_counter()
+        err = sock.connect_ex(address)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            raise OSError(err, os.strerror(err))
+        if not wait_for(sock, selectors.EVENT_WRITE, timeout):
+            raise TimeoutError("TCP connect timed out")
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            raise OSError(err, os.strerror(err))
+        return 'UP', (time.perf_counter() - started) * 1000
+    finally:
+        sock.close()
+
+def udp_probe(monitor):
+    # Sends HealthCheck as the datagram and waits for a reply. Returns
+    # (reply, latency_ms); no reply or a refusal raises.
+    host, port = parse_host_port(monitor['Connection'])
+    timeout = probe_timeout(monitor)[1]
+    sock, address = open_socket(host, port, socket.SOCK_DGRAM)
+    try:
+        started = time.perf_counter()
+        sock.connect(address)
+        sock.send((monitor.get('HealthCheck') or '').encode('utf-8'))
+        if not wait_for(sock, selectors.EVENT_READ, timeout):
+            raise TimeoutError("No UDP reply")
+        reply = sock.recv(65535)
+        return reply, (time.perf_counter() - started) * 1000
+    finally:
+        sock.close()
+
+class ProbeExchange:
+    # What one network probe saw. Coalesced monitors share it and each
+    # judges it against its own expectations.
+    __slots__ = ('service_type', 'status', 'latency', 'outcome', 'status_code', 'headers', 'reply')
+
+    def __init__(self, service_type):
+        self.service_type = service_type
+        # Set when the answer is the same for every monitor sharing the
+        # probe; None when each monitor's Response or assertions decide
+        self.status = None
+        self.latency = None
+        # 'ok', 'timeout' or 'error' as for endpoint_stats, 'short' when the
+        # host circuit was open, None when the probe said nothing about the
+        # target
+        self.outcome = 'ok'
+        self.status_code = None
+        self.headers = None
+        self.reply = None
+
+def service_type_of(monitor):
+    return str(monitor.get('ServiceType') or '').upper()
+
+def run_probe(monitor):
+    # The network side of a check, done once for every monitor coalesced
+    # with this one
+    exchange = ProbeExchange(service_type_of(monitor))
+    host = probe_host(monitor)
+    if '_due' in monitor:
+        check_lag.observe(max(0.0, time.time() - monitor['_due']))
+    if not host_breakers.allow(host):
+        # The host has been unreachable; don't spend a timeout finding out again
+        short_circuits.inc()
+        exchange.status, exchange.outcome = 'DOWN', 'short'
+        return exchange
+    phases = reset_timings()
+    service_type = exchange.service_type
+    started = time.perf_counter()
+    try:
+        if service_type == 'TCP':
+            exchange.status, exchange.latency = tcp_probe(monitor)
+            phases['connect'] = exchange.latency / 1000.0
+        elif service_type == 'UDP':
+            exchange.reply, exchange.latency = udp_probe(monitor)
+            phases['first_byte'] = exchange.latency / 1000.0
+        elif reads_head_only(assertion_cache.get(monitor)):
+            # HTTP and HTTPS, and the default for custom service types. The
+            # status must match Response unless Assertions says otherwise.
+            response = fetch_head(http_session, monitor, probe_timeout(monitor), phases)
+            exchange.status_code, exchange.headers = response.status_code, response.headers
+        else:
+            exchange.status, exchange.status_code = run_http_check(http_session, monitor,
+                                                                   probe_timeout(monitor), phases)
+    except Exception as e:
+        probe_errors.inc(service_type, type(e).__name__)
+        exchange.outcome = probe_failure(e)
+        exchange.status = 'DOWN'
+    for phase, seconds in phases.items():
+        probe_phases.observe(seconds, service_type, phase)
+    if exchange.latency is None:
+        exchange.latency = (time.perf_counter() - started) * 1000
+    if exchange.outcome is not None:
+        host_breakers.record(host, exchange.outcome == 'ok')
+    return exchange
+
+def judge(monitor, exchange):
+    # This monitor's result from a probe it may share with others
+    if exchange.outcome == 'short':
+        endpoint_stats.short_circuited(monitor['AlertName'])
+        return check_result(monitor, 'DOWN')
+    status = exchange.status
+    if status is None and exchange.reply is not None:
+        expected = (monitor.get('Response') or '').encode('utf-8')
+        status = 'UP' if expected in exchange.reply else 'DOWN'
+    elif status is None:
+        status = judge_head(monitor, exchange.status_code, exchange.headers, exchange.latency)
+    if exchange.outcome is not None:
+        endpoint_stats.record(monitor['AlertName'], exchange.outcome, exchange.latency / 1000.0)
+    return check_result(monitor, status, exchange.latency, exchange.status_code)
+
+def check_service(monitor):
+    return judge(monitor, run_probe(monitor))
+
+def probe_key(monitor):
+    # Monitors with equal keys would send the same request: TCP to the same
+    # address, UDP with the same payload, HTTP to the same URL when only the
+    # status and headers are judged, and otherwise only with identical
+    # Assertions and Response. Configured timeouts are part of the key.
+    timeouts = (monitor.get('ConnectTimeout'), monitor.get('ReadTimeout'))
+    connection = (monitor.get('Connection') or '').strip()
+    service_type = service_type_of(monitor)
+    if service_type == 'TCP':
+        return ('TCP', connection.lower(), timeouts)
+    if service_type == 'UDP':
+        return ('UDP', connection.lower(), monitor.get('HealthCheck'), timeouts)
+    try:
+        flow = assertion_cache.get(monitor)
+    except ValueError:
+        # Probed alone so the error is reported against this monitor
+        return None
+    if reads_head_only(flow):
+        return ('HTTP', connection, timeouts)
+    return ('HTTP', connection, timeouts, monitor.get('Assertions'), monitor.get('Response'))
+
+class SharedProbe:
+    __slots__ = ('started', 'future')
+
+    def __init__(self, started, future):
+        self.started = started
+        self.future = future
+
+class ProbeCoalescer:
+    # Sits in front of a ProbeEngine. A check whose probe_key matches a probe
+    # still in flight, or one started less than PROBE_COALESCE_SECONDS ago,
+    # sends no request of its own: the shared ProbeExchange is judged for it
+    # once available. Same interface as ProbeEngine for the checker loop.
+
+    def __init__(self, engine=None, window=PROBE_COALESCE_SECONDS):
+        self.engine = engine or ProbeEngine(run_probe)
+        self.window = window
+        self._lock = threading.Lock()
+        self._probes = {}
+        self._pruned = time.monotonic()
+
+    def submit(self, monitor):
+        key = probe_key(monitor) if self.window > 0 else None
+        if key is None:
+            return self._judged(monitor, self.engine.submit(monitor))
+        now = time.monotonic()
+        with self._lock:
+            if now - self._pruned > self.window:
+                self._prune(now)
+            shared = self._probes.get(key)
+            fresh = shared is not None and (not shared.future.done() or now - shared.started <= self.window)
+            if not fresh:
+                shared = self._probes[key] = SharedProbe(now, self.engine.submit(monitor))
+        if fresh:
+            probes_coalesced.inc(service_type_of(monitor))
+            if '_due' in monitor:
+                check_lag.observe(max(0.0, time.time() - monitor['_due']))
+        return self._judged(monitor, shared.future)
+
+    def sweep(self, monitors):
+        futures = [self.submit(monitor) for monitor in monitors]
+        return [future.result() for future in futures]
+
+    def pending(self):
+        return self.engine.pending()
+
+    def active(self):
+        return self.engine.active()
+
+    def shutdown(self, wait=True):
+        self.engine.shutdown(wait=wait)
+
+    def _prune(self, now):
+        # Caller holds self._lock
+        self._probes = {key: shared for key, shared in self._probes.items()
+                        if not shared.future.done() or now - shared.started <= self.window}
+        self._pruned = now
+
+    def _judged(self, monitor, probe):
+        future = Future()
+
+        def done(probe):
+            try:
+                future.set_result(judge(monitor, probe.result()))
+            except Exception as e:
+                future.set_exception(e)
+
+        probe.add_done_callback(done)
+        return future
+
+def check_result(monitor, status, latency_ms=None, status_code=None):
+    checked_at = time.time()
+    return {'AlertName': monitor['AlertName'], 'Status': status,
+            'CheckTime': datetime.fromtimestamp(checked_at).isoformat(),
+            'CheckedAt': checked_at, 'LatencyMs': latency_ms, 'StatusCode': status_code}
+
+def load_monitors():
+    return registry.ensure_loaded().dicts('monitors')
+
+def record_result(monitor, future, scheduler, writer):
+    if future.exception():
+        result = check_result(monitor, 'DOWN')
+    else:
+        result = future.result()
+    # History keeps every probe outcome; the monitor's Status only moves once
+    # the flap thresholds are met
+    previous = monitor.get('Status')
+    if result['LatencyMs'] is not None:
+        probe_duration.observe(result['LatencyMs'] / 1000.0, service_type_of(monitor), result['Status'])
+    result['ProbeStatus'] = result['Status']
+    result['Status'] = flap_detector.observe(result['AlertName'], previous, result['Status'])
+    # The writer marks transitions for monitorSchedule once they are committed
+    result['PreviousStatus'] = previous
+    writer.submit(result)
+    scheduler.reschedule(monitor, result['Status'], endpoint_stats.failures(result['AlertName']))
+    if result['Status'] != previous:
+        status_transitions.inc(result['Status'])
+        event = {'AlertName': result['AlertName'], 'Status': result['Status'],
+                 'PreviousStatus': previous, 'CheckTime': result['CheckTime']}
+        broadcaster.publish('monitor', event)
+        alert_dispatcher.publish(dict(event, LatencyMs=result['LatencyMs'],
+                                      StatusCode=result['StatusCode']))
+
+def instrument_checker(engine, scheduler):
+    # Queue depths are read when /metrics is scraped, not tracked per probe
+    checks_scheduled.set_function(lambda: len(scheduler))
+    checks_overdue.set_function(scheduler.overdue)
+    probe_queue_depth.set_function(engine.pending)
+    probes_in_flight.set_function(engine.active)
+
+def run_health_checks(engine=None, scheduler=None, writer=None):
+    engine = engine or ProbeCoalescer()
+    scheduler = scheduler or check_scheduler
+    instrument_checker(engine, scheduler)
+    writer = (writer or result_writer).start()
+    alert_dispatcher.start()
+    dns_cache.start()
+    # The table is read once; afterwards the /monitor routes keep the
+    # scheduler current through check_scheduler.upsert/remove
+    scheduler.load(load_monitors())
+    while True:
+        for monitor in scheduler.wait_due():
+            future = engine.submit(monitor)
+            future.add_done_callback(
+                lambda f, monitor=monitor: record_result(monitor, f, scheduler, writer))
@@ -0,0 +1,85 @@
+import json
+import os
+import queue
+import threading
+from collections import deque
+from metrics import metrics
+
+# Events kept for clients that reconnect with Last-Event-ID
+EVENTS_BACKLOG = int(os.getenv('EVENTS_BACKLOG', '1000'))
+# Events buffered per connected client before it is told to resync
+EVENTS_CLIENT_QUEUE = int(os.getenv('EVENTS_CLIENT_QUEUE', '1000'))
+EVENTS_HEARTBEAT = 15
+
+class Subscriber:
+    def __init__(self, maxsize):
+        self.queue = queue.Queue(maxsize)
+        self.overflowed = False
+
+class EventBroadcaster:
+    # Fans status transitions out to every connected Server-Sent Events
+    # client. Memory is bounded per client: a client that falls too far
+    # behind gets a single 'resync' event instead of an ever-growing queue.
+
+    def __init__(self, backlog=EVENTS_BACKLOG, client_queue=EVENTS_CLIENT_QUEUE):
+        self.client_queue = client_queue
+        self._lock = threading.Lock()
+        self._backlog = deque(maxlen=backlog)
+        self._subscribers = set()
+        self._next_id = 1
+
+    def publish(self, event_type, data):
+        with self._lock:
+            event = (self._next_id, event_type, data)
+            self._next_id += 1
+            self._backlog.append(event)
+            for subscriber in self._subscribers:
+                try:
+                    subscriber.queue.put_nowait(event)
+                except queue.Full:
+                    subscriber.overflowed = True
+
+    def subscribe(self, last_event_id=None):
+        subscriber = Subscriber(self.client_queue)
+        with self._lock:
+            replay = []
+            if last_event_id is not None:
+                if (last_event_id >= self._next_id or
+                        (self._backlog and self._backlog[0][0] > last_event_id + 1)):
+                    # The events the client missed are no longer buffered, or
+                    # the client is from before a restart
+                    subscriber.overflowed = True
+                else:
+                    replay = [event for event in self._backlog if event[0] > last_event_id]
+            for event in replay[-self.client_queue:]:
+                subscriber.queue.put_nowait(event)
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def stream(self, last_event_id=None):
+        subscriber = self.subscribe(last_event_id)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                if subscriber.overflowed:
+                    subscriber.overflowed = False
+                    with subscriber.queue.mutex:
+                        subscriber.queue.queue.clear()
+                    yield "event: resync\ndata: {}\n\n"
+                try:
+                    event_id, event_type, data = subscriber.queue.get(timeout=EVENTS_HEARTBEAT)
+                except queue.Empty:
+                    # Comment line keeps proxies from closing an idle stream
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data)}\n\n"
+        finally:
+            self.unsubscribe(subscriber)
+
+broadcaster = EventBroadcaster()
+metrics.gauge('monitor_event_subscribers', 'Connected /events clients',
+              function=lambda: len(broadcaster._subscribers))
@@ -0,0 +1,128 @@
+import csv
+import importlib.util
+import io
+import json
+import os
+import tempfile
+from storage import get_db_connection, in_list
+from registry import registry, RECORDS
+
+# Rows fetched from the cursor and encoded per chunk of the response
+EXPORT_FETCH_SIZE = int(os.getenv('EXPORT_FETCH_SIZE', '5000'))
+
+# Columns per export and their Parquet types; anything not listed is a string
+EXPORTS = {
+    'monitors': {
+        'table': 'monitors',
+        'columns': ['AlertName', 'Connection', 'ServiceType', 'HealthCheck', 'Response',
+                    'Description', 'Status', 'ScheduleTime', 'Frequency',
+                    'ConnectTimeout', 'ReadTimeout', 'Assertions'],
+        'numeric': {'Frequency', 'ConnectTimeout', 'ReadTimeout'},
+    },
+    'services': {
+        'table': 'services',
+        'columns': ['AlertName', 'ServiceType', 'HostName', 'CheckStatus'],
+        'numeric': set(),
+    },
+    'monitor-schedule': {
+        'table': 'monitorSchedule',
+        'columns': ['AlertName', 'HealthCheck', 'ScheduleTime', 'Frequency',
+                    'HostName', 'LastCheckTime', 'Status'],
+        'numeric': {'Frequency'},
+    },
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+class ExportError(ValueError):
+    pass
+
+def export_query(name, selected=None):
+    spec = EXPORTS[name]
+    sql = f"SELECT {', '.join(spec['columns'])} FROM {spec['table']}"
+    params = []
+    if selected:
+        # One bound parameter however many names were selected
+        condition, param = in_list('AlertName', selected)
+        sql += f' WHERE {condition}'
+        params.append(param)
+    return sql + ' ORDER BY AlertName', params
+
+def has_rows(name, selected=None):
+    if name in RECORDS:
+        return registry.count(name, selected) > 0
+    sql, params = export_query(name, selected)
+    with get_db_connection() as conn:
+        return conn.execute(f'SELECT EXISTS ({sql})', params).fetchone()[0] == 1
+
+def fetch_batches(name, selected=None):
+    if name in RECORDS:
+        # Monitors and services come from the in-memory registry
+        yield from registry.rows(name, EXPORTS[name]['columns'], selected, EXPORT_FETCH_SIZE)
+        return
+    sql, params = export_query(name, selected)
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute(sql, params)
+        while True:
+            rows = c.fetchmany(EXPORT_FETCH_SIZE)
+            if not rows:
+                return
+            yield rows
+
+def csv_chunks(name, batches):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORTS[name]['columns'])
+    for rows in batches:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+def jsonl_chunks(name, batches):
+    columns = EXPORTS[name]['columns']
+    for rows in batches:
+        yield ''.join(json.dumps(dict(zip(columns, row))) + '\n' for row in rows).encode('utf-8')
+
+def parquet_chunks(name, batches):
+    # Parquet needs its footer written last, so row groups are spooled to a
+    # temporary file (one batch in memory at a time) and then streamed out
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    spec = EXPORTS[name]
+    schema = pa.schema([(col, pa.float64() if col in spec['numeric'] else pa.string())
+                        for col in spec['columns']])
+    with tempfile.TemporaryFile() as spool:
+        with pq.ParquetWriter(spool, schema) as writer:
+            for rows in batches:
+                columns = list(zip(*rows))
+                writer.write_table(pa.table(
+                    [pa.array(values, type=field.type) for values, field in zip(columns, schema)],
+                    schema=schema))
+        spool.seek(0)
+        while True:
+            data = spool.read(1024 * 1024)
+            if not data:
+                return
+            yield data
+
+ENCODERS = {'csv': csv_chunks, 'jsonl': jsonl_chunks, 'parquet': parquet_chunks}
+
+def check_format(fmt):
+    if fmt not in FORMATS:
+        raise ExportError(f"Unsupported export format: {fmt}. Use one of: {', '.join(FORMATS)}")
+    if fmt == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        raise ExportError("Parquet export requires the pyarrow package")
+
+def export_stream(name, fmt, selected=None):
+    # Returns (iterator of bytes, mimetype, download file name)
+    check_format(fmt)
+    filename = f"{name.replace('-', '_')}.{fmt}"
+    return ENCODERS[fmt](name, fetch_batches(name, selected)), FORMATS[fmt], filename
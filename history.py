@@ -0,0 +1,144 @@
+import math
+import os
+import time
+from storage import get_db_connection, upsert_sql, chunked_delete_sql, write_transaction, count_lock_error
+from reports import build_summaries
+from latency_histogram import count_latencies, pack_bins, merge_histograms, histogram_percentiles
+
+# Raw probe rows older than this are deleted; rollups keep the long view
+HISTORY_RETENTION_DAYS = float(os.getenv('HISTORY_RETENTION_DAYS', '7'))
+ROLLUP_1M_RETENTION_DAYS = float(os.getenv('ROLLUP_1M_RETENTION_DAYS', '30'))
+ROLLUP_1H_RETENTION_DAYS = float(os.getenv('ROLLUP_1H_RETENTION_DAYS', '400'))
+HISTORY_MAINTENANCE_INTERVAL = 60
+# Buckets are rolled up only once they closed this long ago, so results still
+# sitting in the writer's batch are not missed
+ROLLUP_GRACE_SECONDS = 10
+# Rows deleted per statement when enforcing retention
+HISTORY_DELETE_CHUNK = 50000
+# monitorChanges rows are kept long enough for every worker and the web
+# process to have read them
+CHANGELOG_RETENTION_SECONDS = 3600
+
+ROLLUPS = {'checkRollup1m': 60, 'checkRollup1h': 3600}
+ROLLUP_COLUMNS = ['AlertName', 'BucketStart', 'Checks', 'Failures', 'LatencyP50', 'LatencyP95', 'LatencyP99',
+                  'LatencyHistogram']
+ROLLUP_STATE_UPSERT = upsert_sql('rollupState', ['RollupTable', 'RolledUntil'], ['RollupTable'])
+
+def history_row(result):
+    # ProbeStatus is the raw outcome; Status may be held back by flap damping
+    status = result.get('ProbeStatus', result['Status'])
+    return (result['AlertName'], result['CheckedAt'], result.get('LatencyMs'),
+            result.get('StatusCode'), 1 if status == 'UP' else 0)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    # Nearest-rank percentile
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+def rollup(conn, table, bucket_seconds, now=None):
+    now = time.time() if now is None else now
+    closed_until = int((now - ROLLUP_GRACE_SECONDS) // bucket_seconds) * bucket_seconds
+    row = conn.execute('SELECT RolledUntil FROM rollupState WHERE RollupTable=?', (table,)).fetchone()
+    if row:
+        start = row[0]
+    else:
+        first = conn.execute('SELECT MIN(CheckedAt) FROM checkHistory').fetchone()[0]
+        if first is None:
+            return 0
+        start = int(first // bucket_seconds) * bucket_seconds
+    if start >= closed_until:
+        return 0
+
+    buckets = {}
+    c = conn.execute('''SELECT AlertName, CheckedAt, LatencyMs, Up FROM checkHistory
+                        WHERE CheckedAt >= ? AND CheckedAt < ?''', (start, closed_until))
+    for alert_name, checked_at, latency, up in c:
+        key = (alert_name, int(checked_at // bucket_seconds) * bucket_seconds)
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = [0, 0, []]
+        bucket[0] += 1
+        bucket[1] += 0 if up else 1
+        if latency is not None:
+            bucket[2].append(latency)
+
+    rows = []
+    for (alert_name, bucket_start), (checks, failures, latencies) in buckets.items():
+        latencies.sort()
+        rows.append((alert_name, bucket_start, checks, failures, percentile(latencies, 0.50),
+                     percentile(latencies, 0.95), percentile(latencies, 0.99),
+                     pack_bins(count_latencies(latencies))))
+    with write_transaction(conn, 'history'):
+        conn.executemany(upsert_sql(table, ROLLUP_COLUMNS, ['AlertName', 'BucketStart']), rows)
+        conn.execute(ROLLUP_STATE_UPSERT, (table, closed_until))
+    return len(rows)
+
+def delete_before(conn, table, column, cutoff):
+    # Chunked so a large backlog of expired rows never holds the write lock
+    # for long
+    deleted = 0
+    while True:
+        with write_transaction(conn, 'history'):
+            c = conn.execute(chunked_delete_sql(table, column), (cutoff, HISTORY_DELETE_CHUNK))
+        deleted += c.rowcount
+        if c.rowcount < HISTORY_DELETE_CHUNK:
+            return deleted
+
+def run_history_maintenance_once(now=None):
+    now = time.time() if now is None else now
+    with get_db_connection() as conn:
+        for table, bucket_seconds in ROLLUPS.items():
+            rollup(conn, table, bucket_seconds, now)
+        # Summarized before the minute rollups they are built from expire
+        build_summaries(conn)
+        # Never drop raw rows that the hourly rollup hasn't consumed yet
+        cutoff = now - HISTORY_RETENTION_DAYS * 86400
+        rolled = conn.execute("SELECT RolledUntil FROM rollupState WHERE RollupTable='checkRollup1h'").fetchone()
+        cutoff = min(cutoff, rolled[0]) if rolled else cutoff
+        delete_before(conn, 'checkHistory', 'CheckedAt', cutoff)
+        delete_before(conn, 'checkRollup1m', 'BucketStart', now - ROLLUP_1M_RETENTION_DAYS * 86400)
+        delete_before(conn, 'checkRollup1h', 'BucketStart', now - ROLLUP_1H_RETENTION_DAYS * 86400)
+        for table in ('uptimeHourly', 'latencyHourly'):
+            delete_before(conn, table, 'SegmentStart', now - ROLLUP_1M_RETENTION_DAYS * 86400)
+        for table in ('uptimeDaily', 'latencyDaily'):
+            delete_before(conn, table, 'SegmentStart', now - ROLLUP_1H_RETENTION_DAYS * 86400)
+        # The triggers log every edit and status change whether or not any
+        # worker reads them, so the changelog is trimmed here as well
+        delete_before(conn, 'monitorChanges', 'ChangedAt', now - CHANGELOG_RETENTION_SECONDS)
+
+def run_history_maintenance():
+    while True:
+        try:
+            run_history_maintenance_once()
+        except Exception as e:
+            count_lock_error('history', e)
+            print(f"Error maintaining check history: {str(e)}")
+        time.sleep(HISTORY_MAINTENANCE_INTERVAL)
+
+def get_uptime(alert_name, since, until=None):
+    # Reads only rollups: hourly buckets for long windows, minute buckets
+    # otherwise. Window percentiles come from the buckets' latency
+    # histograms added together.
+    until = time.time() if until is None else until
+    table = 'checkRollup1h' if until - since >= 2 * 86400 else 'checkRollup1m'
+    with get_db_connection() as conn:
+        c = conn.cursor()
+        c.execute(f'''SELECT Checks, Failures, LatencyHistogram FROM {table}
+                      WHERE AlertName = ? AND BucketStart >= ? AND BucketStart < ?''',
+                  (alert_name, since, until))
+        rows = c.fetchall()
+    checks = sum(row[0] for row in rows)
+    failures = sum(row[1] for row in rows)
+    histogram = merge_histograms([0] * len(rows), [row[2] for row in rows], 1)
+    p50, p95, p99 = histogram_percentiles(histogram, (0.50, 0.95, 0.99))
+    return {
+        'AlertName': alert_name,
+        'Checks': checks,
+        'Failures': failures,
+        'Uptime': round(100.0 * (checks - failures) / checks, 3) if checks else None,
+        'LatencyP50': p50[0],
+        'LatencyP95': p95[0],
+        'LatencyP99': p99[0],
+    }
@@ -0,0 +1,178 @@
+import csv
+import io
+import itertools
+import operator
+import os
+import re
+import uuid
+from datetime import datetime
+from storage import get_db_connection, upsert_sql
+from monitor_schedule import mark_schedule_dirty
+from registry import registry
+from scheduler import check_scheduler, parse_frequency
+from checker import parse_timeout
+from assertions import parse_assertions
+
+# Rows validated and written per transaction
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', '5000'))
+IMPORT_REPORT_FOLDER = os.path.join('uploads', 'import-reports')
+
+# ConnectTimeout/ReadTimeout/Assertions columns are optional
+MONITOR_COLUMNS = ['AlertName', 'Connection', 'ServiceType', 'HealthCheck',
+                   'Response', 'Description', 'Status', 'ScheduleTime', 'Frequency']
+MONITOR_OPTIONAL_COLUMNS = ['ConnectTimeout', 'ReadTimeout', 'Assertions']
+SERVICE_COLUMNS = ['AlertName', 'ServiceType', 'HostName', 'CheckStatus']
+
+# New monitors get CheckTime=now; existing ones keep their CheckTime so an
+# import doesn't reset when they are next due
+MONITOR_UPSERT_COLUMNS = (MONITOR_COLUMNS[:7] + ['CheckTime'] + MONITOR_COLUMNS[7:]
+                          + MONITOR_OPTIONAL_COLUMNS)
+MONITOR_UPSERT = upsert_sql('monitors', MONITOR_UPSERT_COLUMNS, ['AlertName'],
+                            [col for col in MONITOR_UPSERT_COLUMNS if col not in ('AlertName', 'CheckTime')])
+SERVICE_UPSERT = upsert_sql('services', SERVICE_COLUMNS, ['AlertName'])
+
+REPORT_ID = re.compile(r'^[0-9a-f]{32}$')
+
+class CSVImportError(ValueError):
+    pass
+
+def open_csv(file):
+    # Parse straight off the upload stream; werkzeug spools large uploads to
+    # disk, so memory stays bounded by the chunk size
+    return csv.reader(io.TextIOWrapper(file.stream, encoding='utf-8-sig', newline=''))
+
+def chunks(reader, columns, size):
+    # Yields lists of (row number, tuple of the wanted columns, '' if absent)
+    header = next(reader, [])
+    index = {name: position for position, name in enumerate(header)}
+    # Absent optional columns read from a padding cell past the header
+    positions = [index.get(column, len(header)) for column in columns]
+    width = max(positions) + 1
+    pick = operator.itemgetter(*positions)
+    chunk = []
+    for row_number, row in enumerate(reader, start=2):
+        if len(row) < width:
+            row += [''] * (width - len(row))
+        chunk.append((row_number, pick(row)))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def validate_monitors(chunk, check_time):
+    valid = []
+    errors = []
+    for row_number, row in chunk:
+        (name, connection, service_type, health_check, response, description, status,
+         schedule_time, frequency, connect_timeout, read_timeout, assertions) = row
+        try:
+            if not (name and connection and service_type and health_check
+                    and response and description and status):
+                missing = [col for col, value in zip(MONITOR_COLUMNS, row) if not value
+                           and col not in ('ScheduleTime', 'Frequency')]
+                raise ValueError(f"Missing value for {', '.join(missing)}")
+            if schedule_time:
+                try:
+                    datetime.fromisoformat(schedule_time)
+                except ValueError:
+                    raise ValueError(f"Invalid ScheduleTime format: {schedule_time}")
+            frequency = parse_frequency(frequency) if frequency else 1
+            connect_timeout = parse_timeout(connect_timeout)
+            read_timeout = parse_timeout(read_timeout)
+            assertions = parse_assertions(assertions)
+        except ValueError as e:
+            errors.append((row_number, name, str(e)))
+            continue
+        valid.append((name, connection, service_type, health_check, response, description,
+                      status, check_time, schedule_time, frequency, connect_timeout, read_timeout, assertions))
+    return valid, errors
+
+def validate_services(chunk):
+    valid = []
+    errors = []
+    for row_number, row in chunk:
+        if not all(row):
+            missing = [col for col, value in zip(SERVICE_COLUMNS, row) if not value]
+            errors.append((row_number, row[0], f"Missing value for {', '.join(missing)}"))
+            continue
+        valid.append(row)
+    return valid, errors
+
+class ImportReport:
+    # Per-row error report written as the import runs, downloadable afterwards
+    def __init__(self):
+        self.report_id = uuid.uuid4().hex
+        self.count = 0
+        self._file = None
+
+    @property
+    def path(self):
+        return report_path(self.report_id)
+
+    def add(self, errors):
+        if not errors:
+            return
+        if self._file is None:
+            os.makedirs(IMPORT_REPORT_FOLDER, exist_ok=True)
+            self._file = open(self.path, 'w', newline='', encoding='utf-8')
+            self._writer = csv.writer(self._file)
+            self._writer.writerow(['RowNumber', 'AlertName', 'Error'])
+        self._writer.writerows(errors)
+        self.count += len(errors)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+
+def report_path(report_id):
+    if not REPORT_ID.match(report_id):
+        raise ValueError("Invalid report id")
+    return os.path.join(IMPORT_REPORT_FOLDER, f'{report_id}.csv')
+
+def import_rows(file, required_columns, optional_columns, validate, upsert_sql, after_chunk):
+    reader = open_csv(file)
+    # Peek at the header to reject files with missing columns up front
+    header = next(reader, [])
+    missing = [col for col in required_columns if col not in header]
+    if missing:
+        raise CSVImportError(f"CSV must contain columns: {', '.join(required_columns)}")
+
+    imported = 0
+    report = ImportReport()
+    try:
+        with get_db_connection() as conn:
+            rows = chunks(itertools.chain([header], reader), required_columns + optional_columns,
+                          IMPORT_CHUNK_SIZE)
+            for chunk in rows:
+                valid, errors = validate(chunk)
+                report.add(errors)
+                if valid:
+                    with conn:
+                        conn.executemany(upsert_sql, valid)
+                    after_chunk(valid)
+                    imported += len(valid)
+    finally:
+        report.close()
+    return {'imported': imported, 'failed': report.count,
+            'report_id': report.report_id if report.count else None}
+
+def import_monitors(file):
+    check_time = datetime.now().isoformat()
+
+    def after_chunk(rows):
+        # CheckTime None makes the scheduler treat imported monitors as due
+        monitors = [dict(zip(MONITOR_UPSERT_COLUMNS, row)) for row in rows]
+        registry.put_many('monitors', monitors, preserve=('CheckTime',))
+        check_scheduler.upsert_many([dict(monitor, CheckTime=None) for monitor in monitors])
+        mark_schedule_dirty([row[0] for row in rows])
+
+    return import_rows(file, MONITOR_COLUMNS, MONITOR_OPTIONAL_COLUMNS,
+                       lambda chunk: validate_monitors(chunk, check_time), MONITOR_UPSERT, after_chunk)
+
+def import_services(file):
+    def after_chunk(rows):
+        registry.put_many('services', [dict(zip(SERVICE_COLUMNS, row)) for row in rows])
+        mark_schedule_dirty([row[0] for row in rows])
+
+    return import_rows(file, SERVICE_COLUMNS, [], validate_services, SERVICE_UPSERT, after_chunk)
@@ -0,0 +1,131 @@
+import math
+import struct
+
+# Latencies are counted in logarithmic bins, each LATENCY_BIN_GROWTH times
+# as wide as the one below, so a percentile read back from the bins is
+# within about 1% of the latency it stands for. Unlike percentiles, the
+# counts of several buckets (or monitors) simply add up.
+LATENCY_BIN_GROWTH = 1.02
+# Latencies (ms) at or below this share the lowest bin
+LATENCY_BIN_FLOOR = 0.01
+_LOG_GROWTH = math.log(LATENCY_BIN_GROWTH)
+# A histogram is stored as (bin, count) pairs in ascending bin order, each a
+# little-endian uint16 and uint32 with no padding, so any number of them
+# are read with one numpy.frombuffer over their concatenation
+PAIR = struct.Struct('<HI')
+LATENCY_BIN_LAST = 0xFFFF
+# Cells of the dense (group, bin) table merge_pairs adds into at once
+MERGE_CELLS = 1 << 22
+
+def latency_bin(latency):
+    index = math.floor(math.log(max(latency, LATENCY_BIN_FLOOR) / LATENCY_BIN_FLOOR) / _LOG_GROWTH)
+    return min(max(0, index), LATENCY_BIN_LAST)
+
+def bin_latency(index):
+    # The value whose relative error is the same to both edges of the bin
+    return LATENCY_BIN_FLOOR * LATENCY_BIN_GROWTH ** index * 2 * LATENCY_BIN_GROWTH / (LATENCY_BIN_GROWTH + 1)
+
+def count_latencies(latencies):
+    bins = {}
+    for latency in latencies:
+        index = latency_bin(latency)
+        bins[index] = bins.get(index, 0) + 1
+    return bins
+
+def pack_bins(bins):
+    # {bin: count} -> stored form; None when nothing was measured
+    if not bins:
+        return None
+    return b''.join(PAIR.pack(index, bins[index]) for index in sorted(bins))
+
+def unpack_bins(packed):
+    return dict(PAIR.iter_unpack(packed)) if packed else {}
+
+def _pair_dtype():
+    import numpy as np
+    return np.dtype([('bin', '<u2'), ('count', '<u4')])
+
+def read_pairs(histograms):
+    # Packed histograms -> (pairs per histogram, all their pairs); anything
+    # but bytes (None, NaN) is empty
+    import numpy as np
+    histograms = [packed if isinstance(packed, (bytes, memoryview)) else b'' for packed in histograms]
+    sizes = np.fromiter(map(len, histograms), dtype=np.int64, count=len(histograms)) // PAIR.size
+    return sizes, np.frombuffer(b''.join(histograms), dtype=_pair_dtype())
+
+def pack_segment(histograms):
+    # Packed histograms of many monitors -> (sizes, bins, counts) as stored
+    # for a whole summarized segment: pairs per monitor, then the bins and
+    # the counts of all pairs, each a plain little-endian array (uint32,
+    # uint16, uint32) that numpy reads without copying
+    sizes, pairs = read_pairs(histograms)
+    return sizes.astype('<u4').tobytes(), pairs['bin'].tobytes(), pairs['count'].tobytes()
+
+def read_segment(sizes, bins, counts):
+    import numpy as np
+    return np.frombuffer(sizes, dtype='<u4'), np.frombuffer(bins, dtype='<u2'), np.frombuffer(counts, dtype='<u4')
+
+def merge_pairs(owners, bins, counts, size):
+    # Adds up (bin, count) pairs by group: pair i belongs to owners[i],
+    # 0 <= owner < size; pairs owned by a negative group are dropped.
+    # Returns one packed histogram (or None) per group.
+    import numpy as np
+    # Cells are numbered within a slice of at most MERGE_CELLS, so 32 bits
+    # do, and halve the memory traffic
+    owners = np.asarray(owners, dtype=np.int32)
+    if len(bins) and owners.min() < 0:
+        kept = owners >= 0
+        owners, bins, counts = owners[kept], bins[kept], counts[kept]
+    if not len(bins):
+        return [None] * size
+    span = int(bins.max()) + 1
+    # A dense table of counts per (group, bin), a slice of groups at a time
+    step = max(1, MERGE_CELLS // span)
+    merged_owners, merged = [], []
+    for low in range(0, size, step):
+        if step >= size:
+            cells = owners * np.int32(span) + bins
+            weights = counts
+        else:
+            chosen = (owners >= low) & (owners < low + step)
+            cells = (owners[chosen] - np.int32(low)) * np.int32(span) + bins[chosen]
+            weights = counts[chosen]
+        totals = np.bincount(cells, weights=weights)
+        filled = np.flatnonzero(totals)
+        chunk = np.empty(len(filled), dtype=_pair_dtype())
+        chunk['bin'] = filled % span
+        chunk['count'] = totals[filled]
+        merged_owners.append(filled // span + low)
+        merged.append(chunk)
+    owners = np.concatenate(merged_owners)
+    packed = np.concatenate(merged).tobytes()
+    offsets = (np.searchsorted(owners, np.arange(size + 1)) * PAIR.size).tolist()
+    return [packed[offsets[group]:offsets[group + 1]] or None for group in range(size)]
+
+def merge_histograms(groups, histograms, size):
+    # Adds up packed histograms by group: histograms[i] belongs to groups[i]
+    import numpy as np
+    sizes, pairs = read_pairs(list(histograms))
+    return merge_pairs(np.repeat(np.asarray(groups, dtype=np.int32), sizes), pairs['bin'], pairs['count'], size)
+
+def histogram_percentiles(histograms, fractions):
+    # Nearest-rank percentiles, as history.percentile takes them from raw
+    # latencies, of each packed histogram: one list per fraction, None for
+    # empty histograms
+    import numpy as np
+    sizes, pairs = read_pairs(list(histograms))
+    seen = np.zeros(len(pairs) + 1, dtype=np.int64)
+    np.cumsum(pairs['count'], out=seen[1:])
+    ends = np.cumsum(sizes)
+    before = seen[ends - sizes]
+    totals = seen[ends] - before
+    values = []
+    for fraction in fractions:
+        rank = np.maximum(1, np.ceil(fraction * totals)).astype(np.int64)
+        # The first pair that reaches the rank; seen[i + 1] counts pairs 0..i
+        found = np.minimum(np.searchsorted(seen, before + rank) - 1, max(len(pairs) - 1, 0))
+        latencies = (bin_latency(pairs['bin'][found].astype(float)) if len(pairs)
+                     else np.zeros(len(totals)))
+        values.append([round(float(latency), 3) if total else None
+                       for latency, total in zip(latencies, totals)])
+    return values
@@ -0,0 +1,176 @@
+import bisect
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Port for a worker process's own /metrics endpoint; the web process serves
+# /metrics from the Flask app
+WORKER_METRICS_PORT = int(os.getenv('WORKER_METRICS_PORT', '0'))
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Seconds; probe, write and request latencies
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Seconds a check started after it was due
+LAG_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+# Rows per database batch
+BATCH_BUCKETS = (1, 10, 50, 100, 250, 500, 1000, 2500, 5000)
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def label_text(names, values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    # Monotonic count per label set. inc() takes the label values in the
+    # order the labels were declared.
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, label_text(self.labels, key), value) for key, value in values]
+
+class Gauge:
+    # Current value per label set; either set() on change, or read from a
+    # function when scraped, which costs nothing on the hot path. The
+    # function may return a number or a {label values: number} dict.
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                value = self.function()
+            except Exception as e:
+                print(f"Error reading metric {self.name}: {str(e)}")
+                return []
+            values = value.items() if isinstance(value, dict) else [((), value)]
+        else:
+            with self._lock:
+                values = list(self._values.items())
+        return [(self.name, label_text(self.labels, key), value) for key, value in values]
+
+class Histogram:
+    # Bucketed observations per label set, plus their sum and count
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, *labels):
+        position = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                # Per-bucket (not cumulative) counts, then sum
+                state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[position] += 1
+            state[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(state)) for key, state in self._values.items()]
+        samples = []
+        for key, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state):
+                cumulative += count
+                samples.append((f'{self.name}_bucket', label_text(self.labels, key, f'le="{number(bound)}"'),
+                                cumulative))
+            labels = label_text(self.labels, key)
+            samples.append((f'{self.name}_sum', labels, state[-1]))
+            samples.append((f'{self.name}_count', labels, cumulative))
+        return samples
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, metric):
+        with self._lock:
+            # Re-importing a module (e.g. the Flask reloader) reuses the
+            # metric instead of failing
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=(), function=None):
+        return self.register(Gauge(name, help, labels, function))
+
+    def histogram(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name}{labels} {number(value)}' for name, labels, value in metric.samples())
+        return '\n'.join(lines) + '\n'
+
+metrics = MetricsRegistry()
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve_metrics(port):
+    # /metrics for processes without the Flask app (checker workers)
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,413 @@
+import argparse
+import json
+import os
+import time
+from dotenv import load_dotenv
+
+# Settings below and in storage.py are read at import time
+load_dotenv()
+
+from storage import get_db_connection, column_names, create_index, IntegrityError, NUMBER, AUTO_ID, DIALECT, \
+    EPOCH_NOW, SQLITE, BINARY, LONG_TEXT
+from latency_histogram import pack_bins, pack_segment
+
+# Apply pending migrations when the web app or a worker starts (the
+# default). Set to 0 to have processes refuse to start on an outdated schema
+# and run `python migrations.py` once per deploy instead.
+AUTO_MIGRATE = os.getenv('AUTO_MIGRATE', '1') == '1'
+
+# Every schema change lives here, in order, and is recorded in
+# schemaMigrations once applied. Steps only create what is missing, so a
+# database created before migrations were versioned (or a step interrupted
+# half way) is brought up to date by running them again.
+
+def create_core_tables(c):
+    # Keyed and indexed text columns are VARCHAR so MySQL can index them
+    c.execute(f'''CREATE TABLE IF NOT EXISTS monitors
+                 (AlertName VARCHAR(255) PRIMARY KEY,
+                  Connection TEXT NOT NULL,
+                  ServiceType VARCHAR(255) NOT NULL,
+                  HealthCheck TEXT NOT NULL,
+                  Response TEXT NOT NULL,
+                  Description TEXT NOT NULL,
+                  Status VARCHAR(255) NOT NULL DEFAULT 'DOWN',
+                  CheckTime VARCHAR(255) NOT NULL,
+                  ScheduleTime VARCHAR(255) NOT NULL,
+                  Frequency {NUMBER} NOT NULL DEFAULT 1)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS services
+                 (AlertName VARCHAR(255) PRIMARY KEY,
+                  ServiceType VARCHAR(255) NOT NULL,
+                  HostName VARCHAR(255) NOT NULL,
+                  CheckStatus VARCHAR(255) NOT NULL DEFAULT 'DOWN')''')
+    c.execute(f'''CREATE TABLE IF NOT EXISTS monitorSchedule
+                 (AlertName VARCHAR(255) PRIMARY KEY,
+                  HealthCheck TEXT NOT NULL,
+                  ScheduleTime VARCHAR(255) NOT NULL,
+                  Frequency {NUMBER} NOT NULL,
+                  HostName VARCHAR(255) NOT NULL,
+                  LastCheckTime VARCHAR(255),
+                  Status VARCHAR(255) NOT NULL)''')
+
+def add_monitor_timeouts(c):
+    existing = column_names('monitors')
+    for column in ('ConnectTimeout', 'ReadTimeout'):
+        if column.lower() not in existing:
+            c.execute(f'ALTER TABLE monitors ADD COLUMN {column} DOUBLE PRECISION')
+
+ROLLUPS = ('checkRollup1m', 'checkRollup1h')
+
+def create_history_tables(c):
+    # Append-only raw results; CheckedAt is epoch seconds
+    c.execute('''CREATE TABLE IF NOT EXISTS checkHistory
+                 (AlertName VARCHAR(255) NOT NULL,
+                  CheckedAt DOUBLE PRECISION NOT NULL,
+                  LatencyMs DOUBLE PRECISION,
+                  StatusCode INTEGER,
+                  Up INTEGER NOT NULL)''')
+    create_index(c, 'idx_checkHistory_alert_time', 'checkHistory', 'AlertName, CheckedAt')
+    create_index(c, 'idx_checkHistory_time', 'checkHistory', 'CheckedAt')
+    for table in ROLLUPS:
+        c.execute(f'''CREATE TABLE IF NOT EXISTS {table}
+                     (AlertName VARCHAR(255) NOT NULL,
+                      BucketStart BIGINT NOT NULL,
+                      Checks INTEGER NOT NULL,
+                      Failures INTEGER NOT NULL,
+                      LatencyP50 DOUBLE PRECISION,
+                      LatencyP95 DOUBLE PRECISION,
+                      LatencyP99 DOUBLE PRECISION,
+                      PRIMARY KEY (AlertName, BucketStart))''')
+        create_index(c, f'idx_{table}_bucket', table, 'BucketStart')
+    # Highest bucket end already rolled up, per rollup table
+    c.execute('''CREATE TABLE IF NOT EXISTS rollupState
+                 (RollupTable VARCHAR(255) PRIMARY KEY,
+                  RolledUntil BIGINT NOT NULL)''')
+
+# (name, table, key columns) for the API's sort keys and filters; the
+# expressions match api.RESOURCES exactly and are parenthesised for MySQL
+API_INDEXES = [
+    ('idx_monitors_status', 'monitors', 'Status, AlertName'),
+    ('idx_monitors_service_type', 'monitors', 'ServiceType, AlertName'),
+    ('idx_monitors_check_time_key', 'monitors', "(COALESCE(CheckTime, '')), AlertName"),
+    ('idx_monitors_frequency', 'monitors', 'Frequency, AlertName'),
+    ('idx_services_status', 'services', 'CheckStatus, AlertName'),
+    ('idx_services_service_type', 'services', 'ServiceType, AlertName'),
+    ('idx_services_host_name', 'services', 'HostName, AlertName'),
+    ('idx_monitorSchedule_status', 'monitorSchedule', 'Status, AlertName'),
+    ('idx_monitorSchedule_host_name', 'monitorSchedule', 'HostName, AlertName'),
+    ('idx_monitorSchedule_schedule_time', 'monitorSchedule', 'ScheduleTime, AlertName'),
+    ('idx_monitorSchedule_last_check_key', 'monitorSchedule', "(COALESCE(LastCheckTime, '')), AlertName"),
+]
+# Earlier IFNULL() versions, which the COALESCE() sort keys no longer match
+OBSOLETE_API_INDEXES = ['idx_monitors_check_time', 'idx_monitorSchedule_last_check']
+
+def create_api_indexes(c):
+    if SQLITE:
+        for name in OBSOLETE_API_INDEXES:
+            c.execute(f'DROP INDEX IF EXISTS {name}')
+    for name, table, columns in API_INDEXES:
+        create_index(c, name, table, columns)
+
+# Monitor columns whose edits workers must pick up. Migration 5 created the
+# triggers with the first list; a migration that adds a column recreates
+# them with the longer one.
+CONFIG_COLUMNS_V5 = ['Connection', 'ServiceType', 'HealthCheck', 'Response', 'Description',
+                     'ScheduleTime', 'Frequency', 'ConnectTimeout', 'ReadTimeout']
+CONFIG_COLUMNS = CONFIG_COLUMNS_V5 + ['Assertions']
+
+def changelog_sql(kind, row='NEW'):
+    if kind == 'status':
+        return f'''INSERT INTO monitorChanges (AlertName, Kind, Status, PreviousStatus, ChangedAt)
+                   VALUES (NEW.AlertName, 'status', NEW.Status, OLD.Status, {EPOCH_NOW})'''
+    return f"INSERT INTO monitorChanges (AlertName, Kind, ChangedAt) VALUES ({row}.AlertName, '{kind}', {EPOCH_NOW})"
+
+def changelog_triggers(columns=CONFIG_COLUMNS):
+    # Trigger syntax is the least portable part of the schema
+    if DIALECT == 'postgresql':
+        return [f'''CREATE OR REPLACE FUNCTION monitor_changes_log() RETURNS trigger AS $$
+                   BEGIN
+                     IF TG_OP = 'DELETE' THEN
+                       {changelog_sql('delete', 'OLD')};
+                       RETURN OLD;
+                     ELSIF TG_ARGV[0] = 'status' THEN
+                       {changelog_sql('status')};
+                     ELSE
+                       {changelog_sql('config')};
+                     END IF;
+                     RETURN NEW;
+                   END
+                   $$ LANGUAGE plpgsql''',
+                'DROP TRIGGER IF EXISTS trg_monitors_insert ON monitors',
+                "CREATE TRIGGER trg_monitors_insert AFTER INSERT ON monitors FOR EACH ROW EXECUTE FUNCTION monitor_changes_log('config')",
+                'DROP TRIGGER IF EXISTS trg_monitors_update ON monitors',
+                f"CREATE TRIGGER trg_monitors_update AFTER UPDATE OF {', '.join(columns)} ON monitors FOR EACH ROW EXECUTE FUNCTION monitor_changes_log('config')",
+                'DROP TRIGGER IF EXISTS trg_monitors_delete ON monitors',
+                "CREATE TRIGGER trg_monitors_delete AFTER DELETE ON monitors FOR EACH ROW EXECUTE FUNCTION monitor_changes_log('delete')",
+                'DROP TRIGGER IF EXISTS trg_monitors_status ON monitors',
+                '''CREATE TRIGGER trg_monitors_status AFTER UPDATE OF Status ON monitors FOR EACH ROW
+                   WHEN (OLD.Status IS DISTINCT FROM NEW.Status) EXECUTE FUNCTION monitor_changes_log('status')''']
+    if DIALECT == 'mysql':
+        # No UPDATE OF <columns>, so compare old and new values instead
+        unchanged = ' AND '.join(f'OLD.{col} <=> NEW.{col}' for col in columns)
+        return [f"CREATE TRIGGER IF NOT EXISTS trg_monitors_insert AFTER INSERT ON monitors FOR EACH ROW {changelog_sql('config')}",
+                f'''CREATE TRIGGER IF NOT EXISTS trg_monitors_update AFTER UPDATE ON monitors FOR EACH ROW
+                   BEGIN
+                     IF NOT ({unchanged}) THEN {changelog_sql('config')}; END IF;
+                     IF NOT (OLD.Status <=> NEW.Status) THEN {changelog_sql('status')}; END IF;
+                   END''',
+                f"CREATE TRIGGER IF NOT EXISTS trg_monitors_delete AFTER DELETE ON monitors FOR EACH ROW {changelog_sql('delete', 'OLD')}"]
+    return [f'''CREATE TRIGGER IF NOT EXISTS trg_monitors_insert AFTER INSERT ON monitors
+               BEGIN {changelog_sql('config')}; END''',
+            f'''CREATE TRIGGER IF NOT EXISTS trg_monitors_update AFTER UPDATE OF {', '.join(columns)} ON monitors
+               BEGIN {changelog_sql('config')}; END''',
+            f'''CREATE TRIGGER IF NOT EXISTS trg_monitors_delete AFTER DELETE ON monitors
+               BEGIN {changelog_sql('delete', 'OLD')}; END''',
+            f'''CREATE TRIGGER IF NOT EXISTS trg_monitors_status AFTER UPDATE OF Status ON monitors
+               WHEN OLD.Status IS NOT NEW.Status
+               BEGIN {changelog_sql('status')}; END''']
+
+def service_changelog_triggers():
+    # Services only feed the registries and monitorSchedule, so a single
+    # kind covers inserts, updates and deletes
+    insert = "INSERT INTO monitorChanges (AlertName, Kind, ChangedAt) VALUES ({}.AlertName, 'service', " + EPOCH_NOW + ")"
+    if DIALECT == 'postgresql':
+        return [f'''CREATE OR REPLACE FUNCTION service_changes_log() RETURNS trigger AS $$
+                   BEGIN
+                     IF TG_OP = 'DELETE' THEN
+                       {insert.format('OLD')};
+                       RETURN OLD;
+                     END IF;
+                     {insert.format('NEW')};
+                     RETURN NEW;
+                   END
+                   $$ LANGUAGE plpgsql''',
+                'DROP TRIGGER IF EXISTS trg_services_change ON services',
+                '''CREATE TRIGGER trg_services_change AFTER INSERT OR UPDATE OR DELETE ON services
+                   FOR EACH ROW EXECUTE FUNCTION service_changes_log()''']
+    if DIALECT == 'mysql':
+        return [f"CREATE TRIGGER IF NOT EXISTS trg_services_insert AFTER INSERT ON services FOR EACH ROW {insert.format('NEW')}",
+                f"CREATE TRIGGER IF NOT EXISTS trg_services_update AFTER UPDATE ON services FOR EACH ROW {insert.format('NEW')}",
+                f"CREATE TRIGGER IF NOT EXISTS trg_services_delete AFTER DELETE ON services FOR EACH ROW {insert.format('OLD')}"]
+    return [f'''CREATE TRIGGER IF NOT EXISTS trg_services_insert AFTER INSERT ON services
+               BEGIN {insert.format('NEW')}; END''',
+            f'''CREATE TRIGGER IF NOT EXISTS trg_services_update AFTER UPDATE ON services
+               BEGIN {insert.format('NEW')}; END''',
+            f'''CREATE TRIGGER IF NOT EXISTS trg_services_delete AFTER DELETE ON services
+               BEGIN {insert.format('OLD')}; END''']
+
+def create_worker_tables(c):
+    # One lease row per live worker
+    c.execute('''CREATE TABLE IF NOT EXISTS checkerWorkers
+                 (WorkerId VARCHAR(255) PRIMARY KEY,
+                  HostName VARCHAR(255) NOT NULL,
+                  StartedAt DOUBLE PRECISION NOT NULL,
+                  HeartbeatAt DOUBLE PRECISION NOT NULL)''')
+    # Filled by triggers, so every writer (routes, imports, workers) is
+    # covered. Kind is 'config' or 'delete' for edits, which workers apply
+    # to their schedulers, 'status' for transitions, which the web
+    # process turns into page events, and (from migration 9) 'service' for
+    # any change to a services row. Web processes replay them all onto
+    # their registries.
+    c.execute(f'''CREATE TABLE IF NOT EXISTS monitorChanges
+                 (Seq {AUTO_ID},
+                  AlertName VARCHAR(255) NOT NULL,
+                  Kind VARCHAR(16) NOT NULL,
+                  Status VARCHAR(255),
+                  PreviousStatus VARCHAR(255),
+                  ChangedAt DOUBLE PRECISION NOT NULL)''')
+    create_index(c, 'idx_monitorChanges_time', 'monitorChanges', 'ChangedAt')
+    for statement in changelog_triggers(CONFIG_COLUMNS_V5):
+        c.execute(statement)
+
+SUMMARIES = ('uptimeHourly', 'uptimeDaily')
+
+def create_uptime_summaries(c):
+    # Closed hours and UTC days summarized for reports.py
+    for table in SUMMARIES:
+        c.execute(f'''CREATE TABLE IF NOT EXISTS {table}
+                     (AlertName VARCHAR(255) NOT NULL,
+                      SegmentStart BIGINT NOT NULL,
+                      Checks INTEGER NOT NULL,
+                      Failures INTEGER NOT NULL,
+                      DownSeconds DOUBLE PRECISION NOT NULL,
+                      Outages INTEGER NOT NULL,
+                      StartsDown INTEGER NOT NULL,
+                      EndsDown INTEGER NOT NULL,
+                      LatencyChecks INTEGER NOT NULL,
+                      P50Sum DOUBLE PRECISION NOT NULL,
+                      P95Sum DOUBLE PRECISION NOT NULL,
+                      P99Sum DOUBLE PRECISION NOT NULL,
+                      PRIMARY KEY (AlertName, SegmentStart))''')
+        create_index(c, f'idx_{table}_segment', table, 'SegmentStart')
+
+def add_monitor_assertions(c):
+    # JSON checks on HTTP responses, see assertions.py
+    if 'assertions' not in column_names('monitors'):
+        c.execute('ALTER TABLE monitors ADD COLUMN Assertions TEXT')
+    # Edits to Assertions must reach the workers too
+    if DIALECT != 'postgresql':
+        c.execute('DROP TRIGGER IF EXISTS trg_monitors_update')
+    for statement in changelog_triggers(CONFIG_COLUMNS):
+        c.execute(statement)
+
+def add_latency_histograms(c):
+    # Percentiles of different buckets cannot be combined, so rollups and
+    # summaries keep a latency histogram (latency_histogram.py) instead
+    for table in ROLLUPS:
+        if 'latencybins' in column_names(table):
+            continue
+        c.execute(f'ALTER TABLE {table} ADD COLUMN LatencyBins TEXT')
+        # Roll up again from the first whole bucket of the raw history still
+        # kept, so recent buckets get their histogram
+        bucket = 60 if table == 'checkRollup1m' else 3600
+        c.execute('SELECT MIN(CheckedAt) FROM checkHistory')
+        first = c.fetchone()[0]
+        if first is not None:
+            resume = int(-(-first // bucket)) * bucket
+            c.execute('UPDATE rollupState SET RolledUntil = ? WHERE RollupTable = ? AND RolledUntil > ?',
+                      (resume, table, resume))
+    # Summaries are derived from the rollups: rebuild them with the new
+    # layout rather than carry the old percentile sums over
+    for table in SUMMARIES:
+        if 'latencybins' in column_names(table):
+            continue
+        c.execute(f'DROP TABLE IF EXISTS {table}')
+        c.execute(f'''CREATE TABLE {table}
+                     (AlertName VARCHAR(255) NOT NULL,
+                      SegmentStart BIGINT NOT NULL,
+                      Checks INTEGER NOT NULL,
+                      Failures INTEGER NOT NULL,
+                      DownSeconds DOUBLE PRECISION NOT NULL,
+                      Outages INTEGER NOT NULL,
+                      StartsDown INTEGER NOT NULL,
+                      EndsDown INTEGER NOT NULL,
+                      LatencyBins TEXT,
+                      PRIMARY KEY (AlertName, SegmentStart))''')
+        create_index(c, f'idx_{table}_segment', table, 'SegmentStart')
+        c.execute('DELETE FROM rollupState WHERE RollupTable = ?', (table,))
+
+# Rows converted per statement by pack_latency_histograms
+CONVERT_BATCH = 5000
+# Per-segment histograms of each summary table
+SUMMARY_LATENCY = {'uptimeHourly': 'latencyHourly', 'uptimeDaily': 'latencyDaily'}
+
+def decode_json_bins(text):
+    return {int(index): count for index, count in json.loads(text).items()}
+
+def pack_latency_histograms(c):
+    # LatencyBins JSON text, parsed row by row by reports, becomes packed
+    # (bin, count) pairs (latency_histogram.py) that numpy adds up in bulk.
+    # Rollups keep one histogram per row; summaries keep every monitor's
+    # histogram of a segment in one latencyHourly/latencyDaily row, so a
+    # report reads one row per day instead of one per monitor and day.
+    for table in ROLLUPS:
+        existing = column_names(table)
+        if 'latencyhistogram' not in existing:
+            c.execute(f'ALTER TABLE {table} ADD COLUMN LatencyHistogram {BINARY}')
+        if 'latencybins' not in existing:
+            continue
+        while True:
+            c.execute(f'''SELECT AlertName, BucketStart, LatencyBins FROM {table}
+                          WHERE LatencyBins IS NOT NULL LIMIT {CONVERT_BATCH}''')
+            rows = c.fetchall()
+            if not rows:
+                break
+            c.executemany(f'''UPDATE {table} SET LatencyHistogram = ?, LatencyBins = NULL
+                             WHERE AlertName = ? AND BucketStart = ?''',
+                          [(pack_bins(decode_json_bins(text)), name, start) for name, start, text in rows])
+        c.execute(f'ALTER TABLE {table} DROP COLUMN LatencyBins')
+    for table, latency_table in SUMMARY_LATENCY.items():
+        # AlertNames: JSON list; Sizes, Bins, Counts: arrays written by
+        # latency_histogram.pack_segment, in AlertNames order
+        c.execute(f'''CREATE TABLE IF NOT EXISTS {latency_table}
+                     (SegmentStart BIGINT PRIMARY KEY,
+                      AlertNames {LONG_TEXT} NOT NULL,
+                      Sizes {BINARY} NOT NULL,
+                      Bins {BINARY} NOT NULL,
+                      Counts {BINARY} NOT NULL)''')
+        if 'latencybins' not in column_names(table):
+            continue
+        c.execute(f'SELECT DISTINCT SegmentStart FROM {table} WHERE LatencyBins IS NOT NULL')
+        for (start,) in c.fetchall():
+            c.execute(f'SELECT AlertName, LatencyBins FROM {table} WHERE SegmentStart = ? AND LatencyBins IS NOT NULL',
+                      (start,))
+            rows = c.fetchall()
+            c.execute(f'DELETE FROM {latency_table} WHERE SegmentStart = ?', (start,))
+            c.execute(f'INSERT INTO {latency_table} (SegmentStart, AlertNames, Sizes, Bins, Counts) VALUES (?, ?, ?, ?, ?)',
+                      (start, json.dumps([name for name, _ in rows]),
+                       *pack_segment([pack_bins(decode_json_bins(text)) for _, text in rows])))
+        c.execute(f'ALTER TABLE {table} DROP COLUMN LatencyBins')
+
+def add_service_changelog(c):
+    for statement in service_changelog_triggers():
+        c.execute(statement)
+
+# (version, description, step); append only, never renumber
+MIGRATIONS = [
+    (1, 'monitors, services and monitorSchedule', create_core_tables),
+    (2, 'per-monitor connect and read timeouts', add_monitor_timeouts),
+    (3, 'check history and rollups', create_history_tables),
+    (4, 'API sort and filter indexes', create_api_indexes),
+    (5, 'checker worker leases and monitor changelog', create_worker_tables),
+    (6, 'hourly and daily uptime summaries', create_uptime_summaries),
+    (7, 'HTTP response assertions', add_monitor_assertions),
+    (8, 'mergeable latency histograms', add_latency_histograms),
+    (9, 'service changelog triggers', add_service_changelog),
+    (10, 'packed latency histograms', pack_latency_histograms),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def current_version(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS schemaMigrations
+                 (Version INTEGER PRIMARY KEY,
+                  Description VARCHAR(255) NOT NULL,
+                  AppliedAt DOUBLE PRECISION NOT NULL)''')
+    conn.commit()
+    c.execute('SELECT MAX(Version) FROM schemaMigrations')
+    return c.fetchone()[0] or 0
+
+def migrate(verbose=False):
+    # Applies every pending step, each committed with its schemaMigrations
+    # row. Returns the versions applied.
+    applied = []
+    with get_db_connection() as conn:
+        version = current_version(conn)
+        for number, description, step in MIGRATIONS:
+            if number <= version:
+                continue
+            c = conn.cursor()
+            step(c)
+            try:
+                c.execute('INSERT INTO schemaMigrations (Version, Description, AppliedAt) VALUES (?, ?, ?)',
+                          (number, description, time.time()))
+                conn.commit()
+            except IntegrityError:
+                # Another process applied it at the same time; the steps are
+                # safe to repeat
+                conn.rollback()
+            applied.append(number)
+            if verbose:
+                print(f"Applied migration {number}: {description}")
+    return applied
+
+def ensure_schema():
+    # Called as a process starts: one query when the schema is current
+    with get_db_connection() as conn:
+        version = current_version(conn)
+    if version >= LATEST_VERSION:
+        return
+    if not AUTO_MIGRATE:
+        raise RuntimeError(f"Database schema is at version {version}, this code needs {LATEST_VERSION}; "
+                           f"run `python migrations.py`")
+    migrate(verbose=True)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Bring the database schema up to date')
+    parser.add_argument('--status', action='store_true', help='show the schema version and exit')
+    args = parser.parse_args()
+    if args.status:
+        with get_db_connection() as conn:
+            version = current_version(conn)
+        print(f"Schema version {version} of {LATEST_VERSION}")
+    elif not migrate(verbose=True):
+        print(f"Schema is up to date (version {LATEST_VERSION})")
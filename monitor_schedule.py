@@ -1,108 +1,135 @@
-import sqlite3
-import time
 from datetime import datetime
 import threading
-from contextlib import contextmanager
-import pandas as pd
-import io
-import csv
-import os
+import time
+from events import broadcaster
+from storage import get_db_connection, upsert_sql, count_lock_error, write_transaction
+from metrics import metrics
 
-@contextmanager
-def get_db_connection():
-    conn = sqlite3.connect('monitor.db', timeout=20)
-    conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-    finally:
-        conn.close()
+# AlertNames whose schedule row may need to change, fed by status transitions
+# from the checker and by edits in the monitor/service routes
+_dirty = set()
+_dirty_cond = threading.Condition()
+# SQLite's default limit on bound parameters per statement is 999
+SCHEDULE_BATCH = 500
+SCHEDULE_COLUMNS = ['AlertName', 'HealthCheck', 'ScheduleTime', 'Frequency',
+                    'HostName', 'LastCheckTime', 'Status']
+SCHEDULE_UPSERT = upsert_sql('monitorSchedule', SCHEDULE_COLUMNS, ['AlertName'])
+# Pause before retrying names whose update failed
+SCHEDULE_RETRY_SECONDS = 1
+# Bumped after every committed change to monitorSchedule; cached schedule
+# pages are keyed by it
+_version = 0
+_version_lock = threading.Lock()
 
-def init_db():
-    with get_db_connection() as conn:
-        c = conn.cursor()
-        # Create monitorSchedule table
-        c.execute('''CREATE TABLE IF NOT EXISTS monitorSchedule
-                     (AlertName TEXT PRIMARY KEY,
-                      HealthCheck TEXT NOT NULL,
-                      ScheduleTime TEXT NOT NULL,
-                      Frequency INTEGER NOT NULL,
-                      HostName TEXT NOT NULL,
-                      LastCheckTime TEXT,
-                      Status TEXT NOT NULL)''')
-        conn.commit()
+def schedule_changed():
+    global _version
+    with _version_lock:
+        _version += 1
 
-def update_monitor_schedule():
+def schedule_version():
+    return _version
+
+schedule_duration = metrics.histogram('monitor_schedule_update_duration_seconds',
+                                      'Time to apply one round of monitorSchedule changes', ('kind',))
+schedule_errors = metrics.counter('monitor_schedule_update_errors_total', 'Failed monitorSchedule updates')
+metrics.gauge('monitor_schedule_dirty', 'Monitors waiting for their monitorSchedule row to be updated',
+              function=lambda: len(_dirty))
+
+def mark_schedule_dirty(alert_names):
+    with _dirty_cond:
+        _dirty.update(alert_names)
+        _dirty_cond.notify()
+
+def take_schedule_dirty(timeout=None):
+    with _dirty_cond:
+        _dirty_cond.wait_for(lambda: _dirty, timeout)
+        names = list(_dirty)
+        _dirty.clear()
+        return names
+
+def schedule_rows(c, alert_names=None):
+    # Desired monitorSchedule rows: monitors and services that are both UP
+    query = '''
+        SELECT m.AlertName, m.HealthCheck, m.ScheduleTime, m.Frequency, s.HostName,
+               COALESCE(m.CheckTime, ?) AS LastCheckTime
+        FROM monitors m
+        JOIN services s ON m.AlertName = s.AlertName
+        WHERE m.Status = 'UP' AND s.CheckStatus = 'UP'
+    '''
+    params = [datetime.now().isoformat()]
+    if alert_names is not None:
+        query += f" AND m.AlertName IN ({','.join('?' for _ in alert_names)})"
+        params.extend(alert_names)
+    c.execute(query, params)
+    return [tuple(row) + ('UP',) for row in c.fetchall()]
+
+def write_schedule_changes(c, upserts, deletes):
+    if upserts:
+        c.executemany(SCHEDULE_UPSERT, upserts)
+    if deletes:
+        c.execute(f"DELETE FROM monitorSchedule WHERE AlertName IN ({','.join('?' for _ in deletes)})",
+                  deletes)
+
+def publish_schedule_changes(upserts, deletes):
+    # Only once committed, so pages never see a change that is rolled back
+    for row in upserts:
+        broadcaster.publish('schedule', dict(zip(SCHEDULE_COLUMNS, row)))
+    for alert_name in deletes:
+        broadcaster.publish('schedule', {'AlertName': alert_name, 'Deleted': True})
+
+def apply_schedule_changes(alert_names):
+    # Re-derive only the given rows; rows whose monitor or service is gone or
+    # no longer UP are deleted. Returns False when the update failed; the
+    # names are then queued again.
+    started = time.perf_counter()
+    changes = []
     try:
-        with get_db_connection() as conn:
+        with get_db_connection() as conn, write_transaction(conn, 'monitor_schedule'):
             c = conn.cursor()
-            # Get all monitors and services with UP status
-            c.execute('''
-                SELECT m.AlertName, m.HealthCheck, m.ScheduleTime, m.Frequency, s.HostName
-                FROM monitors m
-                JOIN services s ON m.AlertName = s.AlertName
-                WHERE m.Status = 'UP' AND s.CheckStatus = 'UP'
-            ''')
-            active_monitors = c.fetchall()
-            
-            # Update monitorSchedule table
-            for monitor in active_monitors:
-                c.execute('''
-                    INSERT OR REPLACE INTO monitorSchedule 
-                    (AlertName, HealthCheck, ScheduleTime, Frequency, HostName, LastCheckTime, Status)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (monitor['AlertName'], monitor['HealthCheck'], monitor['ScheduleTime'],
-                      monitor['Frequency'], monitor['HostName'], datetime.now().isoformat(), 'UP'))
-            conn.commit()
+            for i in range(0, len(alert_names), SCHEDULE_BATCH):
+                batch = alert_names[i:i + SCHEDULE_BATCH]
+                upserts = schedule_rows(c, batch)
+                active = {row[0] for row in upserts}
+                deletes = [name for name in batch if name not in active]
+                write_schedule_changes(c, upserts, deletes)
+                changes.append((upserts, deletes))
     except Exception as e:
+        # take_schedule_dirty already cleared these names; without this a
+        # lock timeout would leave their rows stale until the next restart
+        mark_schedule_dirty(alert_names)
+        schedule_errors.inc()
+        count_lock_error('monitor_schedule', e)
         print(f"Error updating monitor schedule: {str(e)}")
+        return False
+    schedule_changed()
+    for upserts, deletes in changes:
+        publish_schedule_changes(upserts, deletes)
+    schedule_duration.observe(time.perf_counter() - started, 'incremental')
+    return True
 
-def get_monitor_schedules():
+def update_monitor_schedule():
+    # Full reconcile; run once at startup; afterwards apply_schedule_changes
+    # keeps the table current
+    started = time.perf_counter()
     try:
-        with get_db_connection() as conn:
+        with get_db_connection() as conn, write_transaction(conn, 'monitor_schedule'):
             c = conn.cursor()
-            c.execute('SELECT * FROM monitorSchedule')
-            return [dict(zip(['AlertName', 'HealthCheck', 'ScheduleTime', 'Frequency', 
-                            'HostName', 'LastCheckTime', 'Status'], row)) 
-                    for row in c.fetchall()]
+            upserts = schedule_rows(c)
+            active = {row[0] for row in upserts}
+            c.execute('SELECT AlertName FROM monitorSchedule')
+            stale = [row[0] for row in c.fetchall() if row[0] not in active]
+            for i in range(0, len(stale), SCHEDULE_BATCH):
+                write_schedule_changes(c, [], stale[i:i + SCHEDULE_BATCH])
+            write_schedule_changes(c, upserts, [])
+        schedule_changed()
+        schedule_duration.observe(time.perf_counter() - started, 'full')
     except Exception as e:
-        print(f"Error getting monitor schedules: {str(e)}")
-        return []
-
-def export_monitor_schedules():
-    try:
-        schedules = get_monitor_schedules()
-        if not schedules:
-            return None, "No schedules to export"
-        
-        # Create CSV in memory
-        si = io.StringIO()
-        writer = csv.writer(si)
-        
-        # Write header
-        writer.writerow(['AlertName', 'HealthCheck', 'ScheduleTime', 'Frequency', 
-                        'HostName', 'LastCheckTime', 'Status'])
-        
-        # Write data
-        for schedule in schedules:
-            writer.writerow([
-                schedule['AlertName'],
-                schedule['HealthCheck'],
-                schedule['ScheduleTime'],
-                schedule['Frequency'],
-                schedule['HostName'],
-                schedule['LastCheckTime'],
-                schedule['Status']
-            ])
-        
-        # Create response
-        output = si.getvalue()
-        si.close()
-        
-        return output, None
-    except Exception as e:
-        return None, f"Error exporting schedules: {str(e)}"
+        schedule_errors.inc()
+        count_lock_error('monitor_schedule', e)
+        print(f"Error updating monitor schedule: {str(e)}")
 
 def run_schedule_updates():
+    update_monitor_schedule()
     while True:
-        update_monitor_schedule()
-        time.sleep(60)  # Update every minute 
\ No newline at end of file
+        if not apply_schedule_changes(take_schedule_dirty()):
+            time.sleep(SCHEDULE_RETRY_SECONDS)
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import threading
+import uuid
+from collections import OrderedDict
+from flask import Response, request
+from metrics import metrics
+
+# Rendered pages and API responses kept in memory, least recently used
+# dropped first
+PAGE_CACHE_SIZE = int(os.getenv('PAGE_CACHE_SIZE', '256'))
+
+# Versions restart at zero with the process; this keeps a browser's ETag
+# from an earlier run from matching by accident
+BOOT_ID = uuid.uuid4().hex[:8]
+
+cache_lookups = metrics.counter('monitor_page_cache_lookups_total', 'Rendered-body cache lookups, by result',
+                                ('result',))
+
+class PageCache:
+    # Rendered bodies keyed by (request key, data version). A body is only
+    # stored against the version read before it was rendered, so an entry
+    # can be newer than its version but never older.
+
+    def __init__(self, size=PAGE_CACHE_SIZE):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                cache_lookups.inc('miss')
+                return None
+            self._entries.move_to_end(key)
+            cache_lookups.inc('hit')
+            return entry[1]
+
+    def put(self, key, version, body):
+        with self._lock:
+            self._entries[key] = (version, body)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+page_cache = PageCache()
+
+def make_etag(key, version):
+    digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:12]
+    return f'{BOOT_ID}-{version}-{digest}'
+
+def cached_response(key, version, render, mimetype='text/html'):
+    # Answers 304 when the client already holds this version, otherwise
+    # serves the cached body or renders and caches it. render() must return
+    # (body, status); only 200 responses are cached.
+    etag = make_etag(key, version)
+    if request.if_none_match.contains(etag):
+        cache_lookups.inc('not_modified')
+        response = Response(status=304)
+    else:
+        body = page_cache.get(key, version)
+        status = 200
+        if body is None:
+            body, status = render()
+            if status == 200:
+                page_cache.put(key, version, body)
+        response = Response(body, status=status, mimetype=mimetype)
+        if status != 200:
+            return response
+    response.set_etag(etag)
+    # Browsers keep the body but revalidate it on every load
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
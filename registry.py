@@ -0,0 +1,234 @@
+import bisect
+import operator
+import sys
+import threading
+from storage import get_db_connection
+
+MONITOR_FIELDS = ('AlertName', 'Connection', 'ServiceType', 'HealthCheck', 'Response', 'Description',
+                  'Status', 'CheckTime', 'ScheduleTime', 'Frequency', 'ConnectTimeout', 'ReadTimeout',
+                  'Assertions')
+SERVICE_FIELDS = ('AlertName', 'ServiceType', 'HostName', 'CheckStatus')
+# Columns listed so rows are keyed the same way on every database backend
+MONITOR_SELECT = f"SELECT {', '.join(MONITOR_FIELDS)} FROM monitors"
+SERVICE_SELECT = f"SELECT {', '.join(SERVICE_FIELDS)} FROM services"
+
+# Low-cardinality values: one shared string object instead of a copy per record
+INTERNED = {'ServiceType', 'Status', 'HostName', 'CheckStatus', 'Response', 'ScheduleTime'}
+# Secondary indexes: field -> value -> set of AlertNames
+INDEXED = {'monitors': ('ServiceType', 'Status'),
+           'services': ('ServiceType', 'HostName', 'CheckStatus')}
+
+def compact(field, value):
+    return sys.intern(value) if field in INTERNED and isinstance(value, str) else value
+
+class MonitorRecord:
+    __slots__ = MONITOR_FIELDS
+
+class ServiceRecord:
+    __slots__ = SERVICE_FIELDS
+
+RECORDS = {'monitors': (MonitorRecord, MONITOR_FIELDS), 'services': (ServiceRecord, SERVICE_FIELDS)}
+
+def to_dict(record):
+    return {field: getattr(record, field) for field in record.__slots__}
+
+def sort_value(value):
+    # Matches the SQL order of COALESCE(column, ''): numbers before text
+    if value is None:
+        return (1, '')
+    if isinstance(value, (int, float)):
+        return (0, value)
+    return (1, value)
+
+class Registry:
+    # Process-wide copy of the monitors and services tables, loaded once and
+    # kept current by write-through from every code path that changes them.
+    # `version` moves on every change, and `versions` on every change to one
+    # table, so readers can tell whether a snapshot they built is still
+    # current without locking.
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self.loaded = False
+        self.version = 0
+        self.versions = {'monitors': 0, 'services': 0}
+        self._reset()
+
+    def _reset(self):
+        self._records = {'monitors': {}, 'services': {}}
+        self._indexes = {resource: {field: {} for field in fields} for resource, fields in INDEXED.items()}
+        # Per (resource, field) change counters; sorted views are rebuilt
+        # only when their sort field (or the set of records) changed
+        self._field_versions = {}
+        self._membership = {'monitors': 0, 'services': 0}
+        self._views = {}
+
+    def load(self):
+        with get_db_connection() as conn:
+            monitors = [dict(row) for row in conn.execute(MONITOR_SELECT)]
+            services = [dict(row) for row in conn.execute(SERVICE_SELECT)]
+        with self._lock:
+            self._reset()
+            self.put_many('monitors', monitors)
+            self.put_many('services', services)
+            self.loaded = True
+        return self
+
+    def ensure_loaded(self):
+        if not self.loaded:
+            self.load()
+        return self
+
+    def put(self, resource, data, preserve=()):
+        self.put_many(resource, [data], preserve)
+
+    def put_many(self, resource, rows, preserve=()):
+        # preserve: fields an existing record keeps (the import upsert leaves
+        # CheckTime alone in the table too)
+        record_class, fields = RECORDS[resource]
+        with self._lock:
+            records = self._records[resource]
+            for data in rows:
+                name = data['AlertName']
+                record = records.get(name)
+                if record is None:
+                    record = record_class()
+                    for field in fields:
+                        setattr(record, field, compact(field, data.get(field)))
+                    records[name] = record
+                    self._index(resource, record)
+                    self._membership[resource] += 1
+                    continue
+                for field in fields:
+                    if field in preserve or field not in data:
+                        continue
+                    self._set(resource, record, field, compact(field, data[field]))
+            self._bump(resource)
+
+    def remove(self, resource, alert_name):
+        with self._lock:
+            record = self._records[resource].pop(alert_name, None)
+            if record is None:
+                return
+            self._unindex(resource, record)
+            self._membership[resource] += 1
+            self._bump(resource)
+
+    def update_results(self, results):
+        # (Status, CheckTime, AlertName) tuples as written by the result writer
+        if not self.loaded:
+            return
+        with self._lock:
+            records = self._records['monitors']
+            for status, check_time, alert_name in results:
+                record = records.get(alert_name)
+                if record is not None:
+                    self._set('monitors', record, 'Status', compact('Status', status))
+                    self._set('monitors', record, 'CheckTime', check_time)
+            self._bump('monitors')
+
+    def get(self, resource, alert_name):
+        with self._lock:
+            record = self._records[resource].get(alert_name)
+            return None if record is None else to_dict(record)
+
+    def dicts(self, resource):
+        with self._lock:
+            return [to_dict(record) for record in self._records[resource].values()]
+
+    def count(self, resource, selected=None):
+        with self._lock:
+            if not selected:
+                return len(self._records[resource])
+            return sum(1 for name in selected if name in self._records[resource])
+
+    def names_where(self, resource, field, values):
+        with self._lock:
+            index = self._indexes[resource][field]
+            return set().union(*(index.get(value, ()) for value in values))
+
+    def rows(self, resource, columns, selected=None, batch_size=5000):
+        # Tuples of the given columns in AlertName order, in batches. Each
+        # batch is taken under the lock, so writers are never held up long.
+        names = [name for _, name in self.view(resource, 'AlertName')]
+        if selected:
+            wanted = set(selected)
+            names = [name for name in names if name in wanted]
+        pick = operator.attrgetter(*columns)
+        for i in range(0, len(names), batch_size):
+            with self._lock:
+                records = self._records[resource]
+                batch = [pick(records[name]) for name in names[i:i + batch_size] if name in records]
+            if batch:
+                yield batch
+
+    def page(self, resource, sort, descending, after, limit, allowed=None):
+        # Keyset page over the records sorted by (sort field, AlertName).
+        # after is the [sort value, AlertName] of the last row already seen.
+        with self._lock:
+            records = self._records[resource]
+            if allowed is not None and len(allowed) * 8 < len(records):
+                # Few matches: sorting just those beats walking the full view
+                view = sorted((sort_value(getattr(records[name], sort)), name)
+                              for name in allowed if name in records)
+                allowed = None
+            else:
+                view = self.view(resource, sort)
+            if descending:
+                position = len(view) if after is None else bisect.bisect_left(view, (sort_value(after[0]), after[1]))
+                candidates = (view[i][1] for i in range(position - 1, -1, -1))
+            else:
+                position = 0 if after is None else bisect.bisect_right(view, (sort_value(after[0]), after[1]))
+                candidates = (view[i][1] for i in range(position, len(view)))
+            items = []
+            for name in candidates:
+                if allowed is not None and name not in allowed:
+                    continue
+                items.append(to_dict(records[name]))
+                if len(items) > limit:
+                    break
+            return items
+
+    def view(self, resource, field):
+        with self._lock:
+            stamp = (self._membership[resource], self._field_versions.get((resource, field), 0))
+            cached = self._views.get((resource, field))
+            if cached is not None and cached[0] == stamp:
+                return cached[1]
+            view = sorted((sort_value(getattr(record, field)), name)
+                          for name, record in self._records[resource].items())
+            self._views[(resource, field)] = (stamp, view)
+            return view
+
+    def _bump(self, resource):
+        self.versions[resource] += 1
+        self.version += 1
+
+    def _set(self, resource, record, field, value):
+        old = getattr(record, field)
+        if old == value and type(old) is type(value):
+            return
+        indexed = field in self._indexes.get(resource, {})
+        if indexed:
+            self._unindex(resource, record, (field,))
+        setattr(record, field, value)
+        if indexed:
+            self._index(resource, record, (field,))
+        key = (resource, field)
+        self._field_versions[key] = self._field_versions.get(key, 0) + 1
+
+    def _index(self, resource, record, fields=None):
+        for field in fields or INDEXED[resource]:
+            self._indexes[resource][field].setdefault(getattr(record, field), set()).add(record.AlertName)
+
+    def _unindex(self, resource, record, fields=None):
+        for field in fields or INDEXED[resource]:
+            index = self._indexes[resource][field]
+            value = getattr(record, field)
+            names = index.get(value)
+            if names is not None:
+                names.discard(record.AlertName)
+                if not names:
+                    del index[value]
+
+registry = Registry()
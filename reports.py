@@ -0,0 +1,336 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from storage import get_db_connection, upsert_sql, write_transaction
+from registry import registry
+from metrics import metrics
+from latency_histogram import merge_histograms, merge_pairs, histogram_percentiles, pack_segment, read_segment
+
+# Summaries of closed segments (days, hours and the odd minutes at the edges
+# of a window) kept in memory, least recently used dropped first
+REPORT_CACHE_SEGMENTS = int(os.getenv('REPORT_CACHE_SEGMENTS', '128'))
+
+HOUR = 3600
+DAY = 86400
+MINUTE = 60
+# Closed segments summarized by the history maintenance thread, so reports
+# never re-read minute rollups for them. Days are UTC days.
+SUMMARY_TABLES = {'uptimeHourly': HOUR, 'uptimeDaily': DAY}
+# Latency histograms of every monitor in a summarized segment, one row per
+# segment, so a report adds up one array per hour or day
+SUMMARY_LATENCY = {'uptimeHourly': 'latencyHourly', 'uptimeDaily': 'latencyDaily'}
+LATENCY_COLUMNS = ['SegmentStart', 'AlertNames', 'Sizes', 'Bins', 'Counts']
+# Added up when segments are combined; StartsDown/EndsDown say whether a
+# segment began or ended mid-outage, so an outage spanning two segments is
+# counted once. LatencyHistogram histograms are merged, and window
+# percentiles read from the merged histogram.
+SUM_COLUMNS = ['Checks', 'Failures', 'DownSeconds', 'Outages', 'Seconds']
+SUMMARY_COLUMNS = ['AlertName', 'SegmentStart', 'Checks', 'Failures', 'DownSeconds', 'Outages', 'StartsDown',
+                   'EndsDown']
+ROLLUP_STATE_UPSERT = upsert_sql('rollupState', ['RollupTable', 'RolledUntil'], ['RollupTable'])
+# Rollup buckets read as segments: a bucket is down when most of its checks
+# failed, and an outage is a run of down buckets
+BUCKET_DOWN = 'CASE WHEN Failures * 2 > Checks THEN 1 ELSE 0 END'
+BUCKET_SOURCE = {'SegmentStart': 'BucketStart', 'Checks': 'Checks', 'Failures': 'Failures', 'DownSeconds': '0',
+                 'Outages': BUCKET_DOWN, 'StartsDown': BUCKET_DOWN, 'EndsDown': BUCKET_DOWN}
+SOURCES = {'checkRollup1m': BUCKET_SOURCE, 'checkRollup1h': BUCKET_SOURCE}
+SOURCES.update((table, {column: column for column in SUMMARY_COLUMNS[1:]}) for table in SUMMARY_TABLES)
+# Report rows per monitor, per service host or per service type
+REPORT_GROUPS = {'monitor': None, 'service': ('services', 'HostName'), 'type': ('monitors', 'ServiceType')}
+
+report_duration = metrics.histogram('monitor_report_duration_seconds', 'Time to build an uptime report')
+report_segments = metrics.counter('monitor_report_segments_total', 'Report segments by where they were read from',
+                                  ('source',))
+
+# pandas and numpy are imported inside the functions that use them, so only
+# processes that build reports pay for loading them
+
+def empty_summary():
+    import pandas as pd
+    return pd.DataFrame({column: pd.Series(dtype=object if column in ('AlertName', 'LatencyHistogram') else float)
+                         for column in ['AlertName', 'SegmentStart'] + SUM_COLUMNS
+                         + ['StartsDown', 'EndsDown', 'LatencyHistogram']})
+
+def combine(frames):
+    # Per-segment summaries (AlertName, SegmentStart, SUM_COLUMNS,
+    # StartsDown, EndsDown, LatencyHistogram) -> one row per AlertName covering
+    # all of them
+    import numpy as np
+    import pandas as pd
+    frames = [frame for frame in frames if len(frame)]
+    if not frames:
+        return empty_summary()
+    frame = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0]
+    frame = frame.sort_values(['AlertName', 'SegmentStart'], kind='stable')
+    names = frame['AlertName'].to_numpy()
+    same = np.zeros(len(frame), dtype=bool)
+    same[1:] = names[1:] == names[:-1]
+    ends_down = frame['EndsDown'].to_numpy(dtype=bool)
+    starts_down = frame['StartsDown'].to_numpy(dtype=bool)
+    # The previous segment of the same monitor ended down and this one starts
+    # down: one outage, not two
+    continued = same & starts_down & np.roll(ends_down, 1)
+    frame = frame.assign(Outages=frame['Outages'].to_numpy() - continued)
+    grouped = frame.groupby('AlertName', sort=False)
+    result = grouped[SUM_COLUMNS].sum()
+    result['StartsDown'] = grouped['StartsDown'].first()
+    result['EndsDown'] = grouped['EndsDown'].last()
+    result['LatencyHistogram'] = merge_histograms(grouped.ngroup(), frame['LatencyHistogram'], len(result))
+    return result.reset_index()
+
+def read_frame(conn, sql, params, columns):
+    import pandas as pd
+    rows = conn.execute(sql, params).fetchall()
+    return pd.DataFrame.from_records([tuple(row) for row in rows], columns=columns)
+
+def rolled_until(conn, table):
+    row = conn.execute('SELECT RolledUntil FROM rollupState WHERE RollupTable=?', (table,)).fetchone()
+    return row[0] if row else None
+
+def first_minute_bucket(conn):
+    return conn.execute('SELECT MIN(BucketStart) FROM checkRollup1m').fetchone()[0]
+
+def summarize(conn, table, start, end):
+    # Rows of a rollup or summary table in [start, end) combined in the
+    # database into one summary row per monitor. Only rows that start or end
+    # down come back individually, to join outages across rows: an outage
+    # continues when the monitor's previous row ended down.
+    import pandas as pd
+    columns = SOURCES[table]
+    when = columns['SegmentStart']
+    summary = read_frame(conn, f'''SELECT AlertName, MIN({when}), MAX({when}), SUM({columns['Checks']}),
+                                           SUM({columns['Failures']}), SUM({columns['DownSeconds']}),
+                                           SUM({columns['Outages']}), COUNT(*)
+                                    FROM {table} WHERE {when} >= ? AND {when} < ?
+                                    GROUP BY AlertName''', (start, end),
+                         ['AlertName', 'SegmentStart', 'LastStart'] + SUM_COLUMNS)
+    edges = read_frame(conn, f'''SELECT AlertName, {when}, {columns['StartsDown']}, {columns['EndsDown']},
+                                         (SELECT {columns['EndsDown']} FROM {table} p
+                                          WHERE p.AlertName = u.AlertName AND p.{when} >= ? AND p.{when} < u.{when}
+                                          ORDER BY p.{when} DESC LIMIT 1)
+                                  FROM {table} u
+                                  WHERE u.{when} >= ? AND u.{when} < ?
+                                        AND ({columns['StartsDown']} = 1 OR {columns['EndsDown']} = 1)''',
+                       (start, start, end), ['AlertName', 'SegmentStart', 'StartsDown', 'EndsDown', 'PreviousEndsDown'])
+    continued = edges[(edges['StartsDown'] == 1) & (edges['PreviousEndsDown'] == 1)].groupby('AlertName').size()
+    first = pd.MultiIndex.from_frame(edges.loc[edges['StartsDown'] == 1, ['AlertName', 'SegmentStart']])
+    last = pd.MultiIndex.from_frame(edges.loc[edges['EndsDown'] == 1, ['AlertName', 'SegmentStart']])
+    summary[SUM_COLUMNS] = summary[SUM_COLUMNS].astype(float)
+    summary['Outages'] -= summary['AlertName'].map(continued).fillna(0)
+    summary['StartsDown'] = pd.MultiIndex.from_frame(summary[['AlertName', 'SegmentStart']]).isin(first)
+    summary['EndsDown'] = pd.MultiIndex.from_frame(summary[['AlertName', 'LastStart']]).isin(last)
+    # Histograms are added up here rather than in SQL, all rows at once
+    monitors = pd.Index(summary['AlertName'])
+    if table in SUMMARY_TABLES:
+        summary['LatencyHistogram'] = segment_histograms(conn, SUMMARY_LATENCY[table], start, end, monitors)
+    else:
+        rows = conn.execute(f'''SELECT AlertName, LatencyHistogram FROM {table}
+                                WHERE {when} >= ? AND {when} < ? AND LatencyHistogram IS NOT NULL''',
+                            (start, end)).fetchall()
+        names, histograms = zip(*rows) if rows else ((), ())
+        summary['LatencyHistogram'] = merge_histograms(monitors.get_indexer(names), histograms, len(summary))
+    if table in SUMMARY_TABLES:
+        summary['Seconds'] *= SUMMARY_TABLES[table]
+    else:
+        # Downtime is the failed share of checks over the whole span, which
+        # holds whatever the check interval
+        summary['Seconds'] = float(end - start)
+        summary['DownSeconds'] = summary['Seconds'] * summary['Failures'] / summary['Checks']
+    return summary.drop(columns=['LastStart'])
+
+def segment_histograms(conn, table, start, end, monitors):
+    # Histograms of the summarized segments in [start, end) added up per
+    # monitor, in the order of monitors (a pandas Index)
+    import numpy as np
+    owners, bins, counts = [], [], []
+    seen = None
+    for names, *segment in conn.execute(f'''SELECT AlertNames, Sizes, Bins, Counts FROM {table}
+                                             WHERE SegmentStart >= ? AND SegmentStart < ?''', (start, end)):
+        # Consecutive segments mostly list the same monitors
+        if names != seen:
+            seen = names
+            positions = monitors.get_indexer(json.loads(names)).astype(np.int32)
+        sizes, segment_bins, segment_counts = read_segment(*segment)
+        owners.append(np.repeat(positions, sizes))
+        bins.append(segment_bins)
+        counts.append(segment_counts)
+    if not bins:
+        return [None] * len(monitors)
+    return merge_pairs(np.concatenate(owners), np.concatenate(bins), np.concatenate(counts), len(monitors))
+
+def summarize_rollups(conn, start, end, first_minute=None):
+    # Minute rollups where they are still kept, hourly ones before that
+    table = 'checkRollup1m'
+    if first_minute is None or start < first_minute:
+        table = 'checkRollup1h'
+    return summarize(conn, table, start, end)
+
+def write_summary(conn, table, start, summary):
+    rows = list(summary.assign(SegmentStart=start)[SUMMARY_COLUMNS].itertuples(index=False, name=None))
+    rows = [(name, int(segment), int(checks), int(failures), float(down), int(outages), int(bool(starts)),
+             int(bool(ends)))
+            for name, segment, checks, failures, down, outages, starts, ends in rows]
+    conn.executemany(upsert_sql(table, SUMMARY_COLUMNS, ['AlertName', 'SegmentStart']), rows)
+    measured = summary['LatencyHistogram'].notna()
+    if measured.any():
+        conn.execute(upsert_sql(SUMMARY_LATENCY[table], LATENCY_COLUMNS, ['SegmentStart']),
+                     (start, json.dumps(summary.loc[measured, 'AlertName'].tolist()),
+                      *pack_segment(summary.loc[measured, 'LatencyHistogram'])))
+
+def build_summaries(conn):
+    # Run by the history maintenance thread after the rollups: summarizes
+    # every closed hour from minute rollups, then every closed day from its
+    # hours. Returns the number of segments written.
+    written = 0
+    closed = rolled_until(conn, 'checkRollup1m')
+    if closed is None:
+        return written
+    first_minute = first_minute_bucket(conn)
+    start = rolled_until(conn, 'uptimeHourly')
+    if start is None:
+        if first_minute is None:
+            return written
+        start = int(first_minute // HOUR) * HOUR
+    while start + HOUR <= closed:
+        summary = summarize_rollups(conn, start, start + HOUR, first_minute)
+        with write_transaction(conn, 'history'):
+            write_summary(conn, 'uptimeHourly', start, summary)
+            conn.execute(ROLLUP_STATE_UPSERT, ('uptimeHourly', start + HOUR))
+        start += HOUR
+        written += 1
+
+    hours_until = rolled_until(conn, 'uptimeHourly')
+    start = rolled_until(conn, 'uptimeDaily')
+    if start is None:
+        first = conn.execute('SELECT MIN(SegmentStart) FROM uptimeHourly').fetchone()[0]
+        if first is None:
+            return written
+        start = int(first // DAY) * DAY
+    while start + DAY <= hours_until:
+        summary = summarize(conn, 'uptimeHourly', start, start + DAY)
+        with write_transaction(conn, 'history'):
+            write_summary(conn, 'uptimeDaily', start, summary)
+            conn.execute(ROLLUP_STATE_UPSERT, ('uptimeDaily', start + DAY))
+        start += DAY
+        written += 1
+    return written
+
+def split_window(since, until, stored):
+    # [since, until) -> (start, end, table) pieces: runs of whole UTC days,
+    # then of whole hours, already summarized in `table`; anything else
+    # (edges, and hours or days not summarized yet) is read from the rollups
+    # with table None
+    pieces = []
+    start = since
+    while start < until:
+        if start % DAY == 0 and start + DAY <= min(until, stored['uptimeDaily']):
+            end, table = start + DAY, 'uptimeDaily'
+        elif start % HOUR == 0 and start + HOUR <= min(until, stored['uptimeHourly']):
+            end, table = start + HOUR, 'uptimeHourly'
+        else:
+            end, table = min(until, (start // HOUR + 1) * HOUR), None
+        if table is not None and pieces and pieces[-1][2] == table:
+            pieces[-1] = (pieces[-1][0], end, table)
+        else:
+            pieces.append((start, end, table))
+        start = end
+    return pieces
+
+class SegmentCache:
+    # Summaries of closed pieces of a window keyed by (start, end); they can
+    # no longer change, so entries never go stale
+    def __init__(self, size=REPORT_CACHE_SEGMENTS):
+        self.size = size
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            frame = self._entries.get(key)
+            if frame is not None:
+                self._entries.move_to_end(key)
+            return frame
+
+    def put(self, key, frame):
+        with self._lock:
+            self._entries[key] = frame
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+segment_cache = SegmentCache()
+
+def window_summary(since, until):
+    # One summary row per monitor for [since, until), rounded down to whole
+    # minutes
+    since = int(since // MINUTE) * MINUTE
+    until = int(until // MINUTE) * MINUTE
+    frames = []
+    with get_db_connection() as conn:
+        closed = rolled_until(conn, 'checkRollup1m') or 0
+        stored = {table: rolled_until(conn, table) or 0 for table in SUMMARY_TABLES}
+        first_minute = first_minute_bucket(conn)
+        for start, end, table in split_window(since, until, stored):
+            frame = segment_cache.get((start, end))
+            if frame is not None:
+                report_segments.inc('cache')
+            elif table is not None:
+                frame = summarize(conn, table, start, end)
+                report_segments.inc('summary')
+                segment_cache.put((start, end), frame)
+            else:
+                frame = summarize_rollups(conn, start, end, first_minute)
+                report_segments.inc('rollup')
+                if end <= closed:
+                    segment_cache.put((start, end), frame)
+            frames.append(frame)
+    return combine(frames)
+
+def uptime_report(since, until, group='monitor'):
+    # Uptime %, downtime, outages, MTTR and MTBF (seconds) and latency
+    # percentiles per monitor, or per service host or service type. For a
+    # group, MTBF is the mean uptime of its monitors over its outages, and
+    # percentiles are read from its monitors' histograms merged.
+    import numpy as np
+    import pandas as pd
+    started = time.perf_counter()
+    summary = window_summary(since, until)
+    summary = summary.drop(columns=['StartsDown', 'EndsDown'])
+    key = 'AlertName'
+    if REPORT_GROUPS[group] is not None:
+        resource, field = REPORT_GROUPS[group]
+        lookup = {row['AlertName']: row[field] for row in registry.ensure_loaded().dicts(resource)}
+        key = field
+        summary[key] = summary['AlertName'].map(lookup)
+        summary['Monitors'] = 1
+        grouped = summary.groupby(key, dropna=False, sort=False)
+        histograms = merge_histograms(grouped.ngroup(), summary['LatencyHistogram'], grouped.ngroups)
+        summary = grouped[SUM_COLUMNS + ['Monitors']].sum()
+        summary['LatencyHistogram'] = histograms
+        summary = summary.reset_index()
+    summary = summary.sort_values(key, kind='stable')
+    outages = summary['Outages'].replace(0, np.nan)
+    # Window length each monitor was up, averaged over a group's monitors
+    monitors = summary['Monitors'] if 'Monitors' in summary else 1
+    uptime_seconds = (summary['Seconds'] - summary['DownSeconds']) / monitors
+    p50, p95, p99 = histogram_percentiles(summary['LatencyHistogram'], (0.50, 0.95, 0.99))
+    report = pd.DataFrame({
+        key: summary[key],
+        'Checks': summary['Checks'].astype(int),
+        'Failures': summary['Failures'].astype(int),
+        'Uptime': (100.0 * (summary['Checks'] - summary['Failures']) / summary['Checks']).round(3),
+        'DowntimeSeconds': summary['DownSeconds'].round(1),
+        'Outages': summary['Outages'].astype(int),
+        'MTTRSeconds': (summary['DownSeconds'] / outages).round(1),
+        'MTBFSeconds': (uptime_seconds / outages).round(1),
+        'LatencyP50': p50,
+        'LatencyP95': p95,
+        'LatencyP99': p99,
+    })
+    if 'Monitors' in summary:
+        report.insert(1, 'Monitors', summary['Monitors'].astype(int))
+    rows = report.astype(object).where(report.notna(), None).to_dict('records')
+    report_duration.observe(time.perf_counter() - started)
+    return rows
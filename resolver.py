@@ -0,0 +1,257 @@
+import heapq
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import ConnectTimeoutError, NameResolutionError, NewConnectionError
+from urllib3.util.connection import allowed_gai_family
+from metrics import metrics
+
+# The system resolver does not report record TTLs, so answers are kept for
+# DNS_CACHE_TTL seconds and failed lookups (NXDOMAIN and the like) for
+# DNS_NEGATIVE_TTL seconds
+DNS_CACHE_TTL = float(os.getenv('DNS_CACHE_TTL', '60'))
+DNS_NEGATIVE_TTL = float(os.getenv('DNS_NEGATIVE_TTL', '10'))
+# Answers are refreshed in the background once this share of their TTL has
+# passed, so probes of names still in use never wait on the resolver
+DNS_REFRESH_AHEAD = float(os.getenv('DNS_REFRESH_AHEAD', '0.8'))
+# Names not probed for this long are dropped instead of refreshed
+DNS_IDLE_SECONDS = float(os.getenv('DNS_IDLE_SECONDS', '900'))
+# Lookups run on their own threads; a probe gives up waiting after
+# DNS_LOOKUP_TIMEOUT seconds while the lookup carries on for the next one
+DNS_RESOLVER_THREADS = int(os.getenv('DNS_RESOLVER_THREADS', '8'))
+DNS_LOOKUP_TIMEOUT = float(os.getenv('DNS_LOOKUP_TIMEOUT', '5'))
+
+dns_lookups = metrics.counter('monitor_dns_cache_lookups_total', 'Name lookups by cache outcome', ('result',))
+dns_duration = metrics.histogram('monitor_dns_resolve_duration_seconds', 'Time the system resolver took per lookup')
+
+def is_ip_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (OSError, ValueError):
+            pass
+    return False
+
+class DNSEntry:
+    __slots__ = ('addresses', 'error', 'expires', 'used', 'lookup')
+
+    def __init__(self):
+        self.addresses = None
+        self.error = None
+        self.expires = 0.0
+        self.used = 0.0
+        self.lookup = None
+
+class DNSCache:
+    # getaddrinfo() results keyed by (host, port, family, socket type).
+    # Concurrent misses for one name share a single lookup, and a
+    # background thread refreshes names still in use before they expire.
+
+    def __init__(self, ttl=DNS_CACHE_TTL, negative_ttl=DNS_NEGATIVE_TTL, refresh_ahead=DNS_REFRESH_AHEAD,
+                 idle_seconds=DNS_IDLE_SECONDS, threads=DNS_RESOLVER_THREADS, lookup_timeout=DNS_LOOKUP_TIMEOUT):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.refresh_ahead = refresh_ahead
+        self.idle_seconds = idle_seconds
+        self.lookup_timeout = lookup_timeout
+        self._executor = ThreadPoolExecutor(max_workers=max(1, threads), thread_name_prefix='dns')
+        self._cond = threading.Condition()
+        self._entries = {}
+        # (time, key): answers due a background refresh, and failed names to
+        # drop once idle
+        self._refresh = []
+        self._thread = None
+
+    def __len__(self):
+        with self._cond:
+            return len(self._entries)
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC, type=socket.SOCK_STREAM):
+        # Same result as socket.getaddrinfo(host, port, family, type); raises
+        # socket.gaierror for names that do not resolve and TimeoutError when
+        # the resolver is slower than lookup_timeout
+        if is_ip_address(host.strip('[]')):
+            return socket.getaddrinfo(host.strip('[]'), port, family, type)
+        key = (host.lower(), port, family, type)
+        now = time.monotonic()
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = DNSEntry()
+            entry.used = now
+            if now < entry.expires:
+                if entry.error is not None:
+                    dns_lookups.inc('negative')
+                    raise socket.gaierror(*entry.error.args)
+                dns_lookups.inc('hit')
+                return entry.addresses
+            if entry.lookup is None:
+                dns_lookups.inc('miss')
+                entry.lookup = self._executor.submit(self._lookup, key)
+            else:
+                dns_lookups.inc('coalesced')
+            lookup = entry.lookup
+        try:
+            addresses, error = lookup.result(timeout=self.lookup_timeout)
+        except FutureTimeout:
+            raise TimeoutError(f"DNS lookup for {host} timed out")
+        if error is not None:
+            raise error
+        return addresses
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='dns-refresh', daemon=True)
+                self._thread.start()
+        return self
+
+    def _lookup(self, key):
+        # Runs on the resolver pool; returns (addresses, error)
+        host, port, family, sock_type = key
+        started = time.monotonic()
+        addresses = error = None
+        try:
+            addresses = socket.getaddrinfo(host, port, family, sock_type)
+        except socket.gaierror as e:
+            error = e
+        except Exception as e:
+            # Not cached: say nothing about the name itself
+            with self._cond:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    entry.lookup = None
+            return None, e
+        finished = time.monotonic()
+        dns_duration.observe(finished - started)
+        with self._cond:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = DNSEntry()
+                entry.used = finished
+            entry.lookup = None
+            if error is not None and entry.addresses is not None and finished < entry.expires:
+                # A failed background refresh keeps the last good answer
+                # until it expires
+                return entry.addresses, None
+            entry.addresses = addresses
+            entry.error = error
+            if error is None:
+                entry.expires = finished + self.ttl
+                heapq.heappush(self._refresh, (finished + self.ttl * self.refresh_ahead, key))
+            else:
+                # Not refreshed; looked at again only to drop it once idle
+                entry.expires = finished + self.negative_ttl
+                heapq.heappush(self._refresh, (finished + self.idle_seconds, key))
+            self._cond.notify()
+        return addresses, error
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while True:
+                    now = time.monotonic()
+                    if self._refresh and self._refresh[0][0] <= now:
+                        break
+                    self._cond.wait(self._refresh[0][0] - now if self._refresh else None)
+                _, key = heapq.heappop(self._refresh)
+                entry = self._entries.get(key)
+                if entry is None or entry.lookup is not None:
+                    continue
+                if now - entry.used > self.idle_seconds:
+                    del self._entries[key]
+                elif entry.error is not None:
+                    heapq.heappush(self._refresh, (entry.used + self.idle_seconds, key))
+                else:
+                    entry.lookup = self._executor.submit(self._lookup, key)
+
+dns_cache = DNSCache()
+
+# Phase timings (seconds) of the probe running on this thread, filled in by
+# the connection classes below: dns, connect and tls for new connections
+_timings = threading.local()
+
+def reset_timings():
+    _timings.phases = {}
+    return _timings.phases
+
+def record_phase(phase, seconds):
+    phases = getattr(_timings, 'phases', None)
+    if phases is not None:
+        phases[phase] = phases.get(phase, 0.0) + seconds
+
+def connect_address(addresses, timeout, source_address=None, socket_options=None):
+    # urllib3's create_connection, over already-resolved addresses
+    error = None
+    for family, sock_type, proto, _, address in addresses:
+        sock = None
+        try:
+            sock = socket.socket(family, sock_type, proto)
+            for option in socket_options or ():
+                sock.setsockopt(*option)
+            if timeout is None or isinstance(timeout, (int, float)):
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(address)
+            return sock
+        except OSError as e:
+            error = e
+            if sock is not None:
+                sock.close()
+    raise error or OSError("getaddrinfo returned an empty list")
+
+class CachedDNSConnectionMixin:
+    # Resolves through dns_cache instead of a blocking getaddrinfo per
+    # connection, and records how long each phase took
+
+    def _new_conn(self):
+        started = time.perf_counter()
+        try:
+            addresses = dns_cache.resolve(self._dns_host.strip('[]'), self.port, allowed_gai_family(),
+                                          socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+        except TimeoutError as e:
+            raise ConnectTimeoutError(self, f"DNS lookup for {self.host} timed out") from e
+        resolved = time.perf_counter()
+        record_phase('dns', resolved - started)
+        try:
+            sock = connect_address(addresses, self.timeout, self.source_address, self.socket_options)
+        except TimeoutError as e:
+            raise ConnectTimeoutError(
+                self, f"Connection to {self.host} timed out. (connect timeout={self.timeout})") from e
+        except OSError as e:
+            raise NewConnectionError(self, f"Failed to establish a new connection: {e}") from e
+        record_phase('connect', time.perf_counter() - resolved)
+        return sock
+
+class CachedDNSHTTPConnection(CachedDNSConnectionMixin, HTTPConnection):
+    pass
+
+class CachedDNSHTTPSConnection(CachedDNSConnectionMixin, HTTPSConnection):
+    def connect(self):
+        # Whatever connect() spends beyond DNS and TCP connect is the TLS
+        # handshake
+        phases = getattr(_timings, 'phases', None)
+        before = sum(phases.values()) if phases is not None else 0.0
+        started = time.perf_counter()
+        super().connect()
+        if phases is not None:
+            spent = sum(phases.values()) - before
+            record_phase('tls', max(0.0, time.perf_counter() - started - spent))
+
+class CachedDNSHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = CachedDNSHTTPConnection
+
+class CachedDNSHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = CachedDNSHTTPSConnection
+
+POOL_CLASSES = {'http': CachedDNSHTTPConnectionPool, 'https': CachedDNSHTTPSConnectionPool}
+
+metrics.gauge('monitor_dns_cache_entries', 'Names held in the DNS cache', function=lambda: len(dns_cache))
@@ -0,0 +1,144 @@
+import os
+import queue
+import threading
+import time
+from storage import get_db_connection, count_lock_error, write_transaction, OperationalError
+from history import history_row
+from registry import registry
+from monitor_schedule import schedule_changed, mark_schedule_dirty
+from metrics import metrics, BATCH_BUCKETS
+
+# Flush once this many results are waiting...
+CHECK_WRITE_BATCH = int(os.getenv('CHECK_WRITE_BATCH', '500'))
+# ...or once the oldest waiting result is this old
+CHECK_WRITE_INTERVAL_MS = int(os.getenv('CHECK_WRITE_INTERVAL_MS', '250'))
+# History rows held while writes keep failing; past this the oldest are dropped
+CHECK_WRITE_MAX_PENDING = int(os.getenv('CHECK_WRITE_MAX_PENDING', '100000'))
+
+write_duration = metrics.histogram('monitor_db_write_duration_seconds',
+                                   'Time to write one batch of check results, including lock waits')
+write_batch_rows = metrics.histogram('monitor_db_write_batch_rows', 'Check results per written batch',
+                                     buckets=BATCH_BUCKETS)
+write_errors = metrics.counter('monitor_db_write_errors_total', 'Result batches that failed and were retried')
+write_dropped = metrics.counter('monitor_db_write_dropped_total',
+                                'History rows dropped because writes kept failing')
+writer_queue_depth = metrics.gauge('monitor_result_queue_depth', 'Check results waiting to be written')
+
+class ResultWriter:
+    # Single writer for check results. Probe threads only enqueue; one thread
+    # owns the database connection and applies results in batched
+    # transactions, so concurrent probes never contend for the SQLite lock.
+
+    def __init__(self, batch_size=CHECK_WRITE_BATCH, interval_ms=CHECK_WRITE_INTERVAL_MS,
+                 max_pending=CHECK_WRITE_MAX_PENDING):
+        self.batch_size = max(1, batch_size)
+        self.interval = interval_ms / 1000.0
+        self.max_pending = max(self.batch_size, max_pending)
+        self._queue = queue.Queue()
+        self._pending = {}
+        self._history = []
+        # Monitors whose Status moved in the pending batch
+        self._transitions = set()
+        self._thread = None
+        self._stopping = threading.Event()
+        self._flushed = threading.Condition()
+        self._submitted = 0
+        self._taken = 0
+        self._written = 0
+
+    def submit(self, result):
+        with self._flushed:
+            self._submitted += 1
+        self._queue.put(result)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='result-writer', daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def backlog(self):
+        return self._queue.qsize() + len(self._pending)
+
+    def flush(self, timeout=None):
+        # Wait until everything submitted so far has been written
+        with self._flushed:
+            target = self._submitted
+            return self._flushed.wait_for(lambda: self._written >= target, timeout)
+
+    def _run(self):
+        with get_db_connection() as conn:
+            while not (self._stopping.is_set() and self._queue.empty() and not self._pending):
+                self._collect()
+                if self._pending:
+                    self._write(conn)
+
+    def _collect(self):
+        deadline = time.monotonic() + self.interval
+        taken = 0
+        while taken < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                result = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            # Only the latest result per monitor needs to reach the table,
+            # but every result is kept for the history
+            self._pending[result['AlertName']] = result
+            self._history.append(history_row(result))
+            if result['Status'] != result.get('PreviousStatus'):
+                self._transitions.add(result['AlertName'])
+            taken += 1
+        with self._flushed:
+            self._taken += taken
+        # While the database refuses writes the batch keeps growing; keep the
+        # newest history and drop the oldest. _pending holds one row per
+        # monitor, so it is bounded by the number of monitors.
+        excess = len(self._history) - self.max_pending
+        if excess > 0:
+            del self._history[:excess]
+            write_dropped.inc(amount=excess)
+            print(f"Error writing check results: dropped {excess} history rows, "
+                  f"{len(self._history)} still pending")
+
+    def _write(self, conn):
+        rows = [(r['Status'], r['CheckTime'], r['AlertName']) for r in self._pending.values()]
+        started = time.perf_counter()
+        try:
+            with write_transaction(conn, 'result_writer'):
+                conn.executemany('UPDATE monitors SET Status=?, CheckTime=? WHERE AlertName=?', rows)
+                conn.executemany('UPDATE monitorSchedule SET LastCheckTime=? WHERE AlertName=?',
+                                 [(checked, name) for _, checked, name in rows])
+                conn.executemany('''INSERT INTO checkHistory (AlertName, CheckedAt, LatencyMs, StatusCode, Up)
+                                    VALUES (?, ?, ?, ?, ?)''', self._history)
+        except OperationalError as e:
+            # Keep the batch and retry on the next cycle
+            write_errors.inc()
+            count_lock_error('result_writer', e)
+            print(f"Error writing check results: {str(e)}")
+            return
+        write_duration.observe(time.perf_counter() - started)
+        write_batch_rows.observe(len(rows))
+        registry.update_results(rows)
+        schedule_changed()
+        # monitorSchedule is derived from monitors.Status, so it can only be
+        # brought up to date once the new Status is committed
+        if self._transitions:
+            mark_schedule_dirty(self._transitions)
+            self._transitions = set()
+        self._pending.clear()
+        self._history = []
+        with self._flushed:
+            self._written = self._taken
+            self._flushed.notify_all()
+
+result_writer = ResultWriter()
+writer_queue_depth.set_function(result_writer.backlog)
@@ -0,0 +1,194 @@
+import os
+import heapq
+import itertools
+import random
+import threading
+import time
+from datetime import datetime
+
+# Fraction of the interval each check may drift either way, so checks that
+# share a frequency spread out instead of firing in the same instant
+CHECK_JITTER = float(os.getenv('CHECK_JITTER', '0.1'))
+# Shortest allowed interval between two checks of one monitor
+MIN_CHECK_INTERVAL = float(os.getenv('MIN_CHECK_INTERVAL', '10'))
+# A monitor whose target keeps failing to answer is checked less often:
+# after CHECK_BACKOFF_AFTER consecutive failures its interval doubles with
+# every further failure, up to CHECK_BACKOFF_MAX_SECONDS (never below its
+# own frequency)
+CHECK_BACKOFF_AFTER = int(os.getenv('CHECK_BACKOFF_AFTER', '3'))
+CHECK_BACKOFF_MAX_SECONDS = float(os.getenv('CHECK_BACKOFF_MAX_SECONDS', '300'))
+
+def parse_frequency(value):
+    # Frequency is stored in minutes; fractions allow sub-minute checks
+    try:
+        frequency = float(value)
+    except (TypeError, ValueError):
+        raise ValueError("Frequency must be a number")
+    if frequency * 60 < MIN_CHECK_INTERVAL:
+        raise ValueError(f"Frequency must be at least {MIN_CHECK_INTERVAL / 60:g} minutes")
+    return int(frequency) if frequency.is_integer() else frequency
+
+def check_interval(monitor):
+    try:
+        return max(float(monitor['Frequency']) * 60, MIN_CHECK_INTERVAL)
+    except (KeyError, TypeError, ValueError):
+        return 60.0
+
+def backoff_interval(interval, failures):
+    if failures <= CHECK_BACKOFF_AFTER:
+        return interval
+    return max(interval, min(interval * 2 ** min(failures - CHECK_BACKOFF_AFTER, 32),
+                             CHECK_BACKOFF_MAX_SECONDS))
+
+def last_check_timestamp(monitor):
+    try:
+        return datetime.fromisoformat(monitor['CheckTime']).timestamp()
+    except (KeyError, TypeError, ValueError):
+        return None
+
+class CheckScheduler:
+    # Min-heap of (due time, sequence, AlertName). Entries are invalidated
+    # lazily: an upsert or removal bumps the monitor's sequence number and
+    # stale heap items are dropped when they reach the top, or all at once
+    # when they outnumber the live ones.
+    #
+    # Until load() is called nobody takes checks off the heap (the web
+    # process with CHECKER_EMBEDDED=0, or before the checker thread starts),
+    # and load() reads every monitor anyway, so upserts are ignored.
+
+    def __init__(self, jitter=CHECK_JITTER):
+        self.jitter = jitter
+        self.loaded = False
+        self._heap = []
+        self._entries = {}
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._entries)
+
+    def __contains__(self, alert_name):
+        with self._cond:
+            return alert_name in self._entries
+
+    def names(self):
+        with self._cond:
+            return list(self._entries)
+
+    def load(self, monitors):
+        now = time.time()
+        with self._cond:
+            self._heap = []
+            self._entries = {}
+            for monitor in monitors:
+                interval = check_interval(monitor)
+                self._push(monitor, self._initial_due(monitor, interval, now), interval)
+            self.loaded = True
+            self._cond.notify()
+
+    def upsert(self, monitor):
+        self.upsert_many([monitor])
+
+    def upsert_many(self, monitors):
+        now = time.time()
+        with self._cond:
+            if not self.loaded:
+                return
+            for monitor in monitors:
+                interval = check_interval(monitor)
+                self._push(dict(monitor), self._initial_due(monitor, interval, now), interval)
+            self._compact()
+            self._cond.notify()
+
+    def remove(self, alert_name):
+        with self._cond:
+            self._entries.pop(alert_name, None)
+            self._compact()
+            self._cond.notify()
+
+    def reschedule(self, monitor, status=None, failures=0):
+        # Called once a popped monitor's check has finished. If the monitor was
+        # edited or deleted while the check was running, that change wins.
+        # failures: the target's run of failed probes, for backoff
+        with self._cond:
+            entry = self._entries.get(monitor['AlertName'])
+            if entry is None or entry['seq'] != monitor.get('_seq'):
+                return
+            if status is not None:
+                entry['monitor']['Status'] = status
+            interval = backoff_interval(check_interval(entry['monitor']), failures)
+            nominal = max(entry['nominal'] + interval, time.time())
+            self._push(entry['monitor'], nominal, interval)
+            self._cond.notify()
+
+    def overdue(self, now=None):
+        # Checks past their due time that no probe has picked up yet
+        now = time.time() if now is None else now
+        with self._cond:
+            return sum(1 for item in self._heap if item[0] <= now and not self._is_stale(item))
+
+    def next_due(self):
+        with self._cond:
+            self._drop_stale()
+            return self._heap[0][0] if self._heap else None
+
+    def wait_due(self, timeout=None):
+        # Block until at least one check is due and return every due monitor
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                self._drop_stale()
+                now = time.time()
+                if self._heap and self._heap[0][0] <= now:
+                    return self._pop_due(now)
+                wait = self._heap[0][0] - now if self._heap else None
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return []
+                    wait = remaining if wait is None else min(wait, remaining)
+                self._cond.wait(wait)
+
+    def _initial_due(self, monitor, interval, now):
+        last_check = last_check_timestamp(monitor)
+        if last_check is None or last_check + interval <= now:
+            # Overdue monitors are spread across the jitter window instead of
+            # all firing on the first tick
+            return now + random.uniform(0, interval * self.jitter)
+        return last_check + interval
+
+    def _push(self, monitor, nominal, interval):
+        seq = next(self._seq)
+        due = nominal + random.uniform(-self.jitter, self.jitter) * interval
+        self._entries[monitor['AlertName']] = {'seq': seq, 'nominal': nominal,
+                                               'monitor': monitor, 'in_flight': False}
+        heapq.heappush(self._heap, (due, seq, monitor['AlertName']))
+
+    def _is_stale(self, item):
+        entry = self._entries.get(item[2])
+        return entry is None or entry['seq'] != item[1] or entry['in_flight']
+
+    def _compact(self):
+        # Re-imports and deletes leave superseded items deep in the heap
+        if len(self._heap) > 2 * len(self._entries) + 1024:
+            self._heap = [item for item in self._heap
+                          if item[2] in self._entries and self._entries[item[2]]['seq'] == item[1]]
+            heapq.heapify(self._heap)
+
+    def _drop_stale(self):
+        while self._heap and self._is_stale(self._heap[0]):
+            heapq.heappop(self._heap)
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due_at, seq, alert_name = heapq.heappop(self._heap)
+            entry = self._entries.get(alert_name)
+            if entry is None or entry['seq'] != seq or entry['in_flight']:
+                continue
+            entry['in_flight'] = True
+            due.append(dict(entry['monitor'], _seq=seq, _due=due_at))
+        return due
+
+check_scheduler = CheckScheduler()
@@ -0,0 +1,25 @@
+import os
+import sys
+import tempfile
+import pytest
+
+# The modules live at the repository root rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Settings are read at import time, so the throwaway database must be chosen
+# before any test imports storage; monitor.db is never touched
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='monitor-tests-'), 'test.db')}"
+
+TABLES = ['monitors', 'services', 'monitorSchedule', 'monitorChanges', 'checkHistory', 'checkRollup1m',
+          'checkRollup1h', 'uptimeHourly', 'uptimeDaily', 'latencyHourly', 'latencyDaily', 'rollupState']
+
+@pytest.fixture
+def db():
+    # Migrated database with empty monitor tables; yields get_db_connection
+    from migrations import ensure_schema
+    from storage import get_db_connection
+    ensure_schema()
+    with get_db_connection() as conn:
+        with conn:
+            for table in TABLES:
+                conn.execute(f'DELETE FROM {table}')
+    yield get_db_connection
@@ -0,0 +1,144 @@
+import json
+import time
+from datetime import timedelta
+import pytest
+from flask import Flask
+from requests.structures import CaseInsensitiveDict
+from assertions import compile_assertions, parse_assertions, run_http_check, judge_head, assertion_cache
+from importer import validate_monitors
+
+class Response:
+    # Stands in for a streamed requests.Response
+    def __init__(self, status_code=200, body=b'', headers=None, delay=0):
+        self.status_code = status_code
+        self.body = body
+        self.headers = CaseInsensitiveDict(headers or {})
+        self.elapsed = timedelta(0)
+        self.cookies = {}
+        self.delay = delay
+        self.read = 0
+
+    def iter_content(self, size):
+        time.sleep(self.delay)
+        for start in range(0, len(self.body), size):
+            self.read = start + size
+            yield self.body[start:start + size]
+
+    def close(self):
+        pass
+
+class Session:
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        return self.responses.pop(0)
+
+def check(assertions, *responses, response_code='200'):
+    monitor = {'AlertName': 'api', 'Connection': 'http://api/', 'Response': response_code,
+               'Assertions': assertions if isinstance(assertions, str) or assertions is None
+               else json.dumps(assertions)}
+    assertion_cache.forget('api')
+    session = Session(*responses)
+    status, _ = run_http_check(session, monitor, (1, 1), {})
+    return status, session
+
+def test_response_decides_without_assertions():
+    assert check(None, Response(200))[0] == 'UP'
+    assert check(None, Response(204))[0] == 'DOWN'
+    # Assertions replace Response as the expected status
+    assert check([{'status': [200, 204]}], Response(204))[0] == 'UP'
+    assert check([{'status': 201}], Response(200))[0] == 'DOWN'
+
+def test_body_contains():
+    body = b'{"status": "ok"}' + b' ' * 100_000 + b'ready'
+    assert check([{'body_contains': 'ready'}], Response(body=body))[0] == 'UP'
+    assert check([{'body_contains': 'missing'}], Response(body=body))[0] == 'DOWN'
+    # A match across chunk boundaries still counts
+    assert check([{'body_contains': 'x' * 10}], Response(body=b'a' * 16380 + b'x' * 10))[0] == 'UP'
+
+def test_body_is_read_only_until_the_match():
+    response = Response(body=b'ready' + b' ' * 200_000)
+    assert check([{'body_contains': 'ready'}], response)[0] == 'UP'
+    assert response.read < len(response.body)
+
+def test_json_and_header_checks():
+    body = json.dumps({'data': {'items': [{'status': 'up'}]}}).encode()
+    headers = {'Content-Type': 'application/json'}
+    passing = [{'json': 'data.items.0.status', 'equals': 'up'}, {'header': 'content-type', 'contains': 'json'}]
+    assert check(passing, Response(body=body, headers=headers))[0] == 'UP'
+    assert check([{'json': 'data.items.0.status', 'equals': 'down'}], Response(body=body))[0] == 'DOWN'
+    assert check([{'json': 'data.missing'}], Response(body=body))[0] == 'DOWN'
+    assert check([{'json': 'data'}], Response(body=b'not json'))[0] == 'DOWN'
+    assert check([{'header': 'X-Missing'}], Response(body=body, headers=headers))[0] == 'DOWN'
+
+def test_max_ms():
+    assert check([{'max_ms': 10_000}], Response(body=b'ok'))[0] == 'UP'
+    assert check([{'body_contains': 'ok'}, {'max_ms': 1}], Response(body=b'ok', delay=0.02))[0] == 'DOWN'
+    # Checks answered from a shared plain GET use the measured latency
+    monitor = {'AlertName': 'head', 'Response': '200', 'Assertions': json.dumps([{'max_ms': 100}])}
+    assertion_cache.forget('head')
+    assert judge_head(monitor, 200, {}, 99) == 'UP'
+    assert judge_head(monitor, 200, {}, 101) == 'DOWN'
+    assert judge_head(monitor, 500, {}, 1) == 'DOWN'
+
+def test_steps_share_saved_values():
+    flow = {'steps': [{'url': '/login', 'method': 'post', 'save': {'token': {'json': 'token'}}},
+                      {'url': '/items/${token}', 'expect': [{'body_contains': 'item'}]}]}
+    status, session = check(flow, Response(body=b'{"token": "abc"}'), Response(body=b'item'))
+    assert status == 'UP'
+    assert session.requests == [('POST', 'http://api/login'), ('GET', 'http://api/items/abc')]
+    # A failed step ends the check
+    status, session = check(flow, Response(401), Response(body=b'item'))
+    assert status == 'DOWN' and len(session.requests) == 1
+
+@pytest.mark.parametrize('assertions, message', [
+    ('[{"status": 200}', 'must be JSON'),
+    ('"status"', 'a list of checks'),
+    ('[{"status": 99}]', 'status must be an HTTP status code'),
+    ('[{"body_contains": ""}]', 'body_contains must be a non-empty string'),
+    ('[{"max_ms": 0}]', 'max_ms must be a number'),
+    ('[{"max_ms": true}]', 'max_ms must be a number'),
+    ('[{"status": 200, "max_ms": 5}]', 'exactly one of'),
+    ('[{"body_regex": "("}]', 'Invalid regex'),
+    ('[{"header": "X", "equals": "a", "contains": "b"}]', 'one of equals, contains or regex'),
+    ('[{"json": "a", "above": 1}]', "Unknown key 'above'"),
+    ('{"steps": []}', 'non-empty list'),
+    ('{"steps": [{}, {"expect": [1]}]}', 'Step 2: A check must be an object'),
+])
+def test_malformed_assertions_are_rejected(assertions, message):
+    with pytest.raises(ValueError, match='Invalid Assertions') as error:
+        parse_assertions(assertions)
+    assert message in str(error.value)
+
+def test_parse_assertions():
+    assert parse_assertions(None) is None
+    assert parse_assertions('  ') is None
+    assert parse_assertions(' [{"status": 200}] ') == '[{"status": 200}]'
+    assert len(compile_assertions('{"steps": [{}, {"url": "/b"}]}')) == 2
+
+def test_import_rejects_malformed_assertions():
+    row = ('web', 'http://web', 'HTTP', '/', '200', 'Web', 'UP', '', '', '', '')
+    valid, errors = validate_monitors([(2, row + ('[{"status": 200}]',)), (3, row + ('[{"max_ms": -1}]',))],
+                                      '2024-01-01T00:00:00')
+    assert [entry[-1] for entry in valid] == ['[{"status": 200}]']
+    assert len(errors) == 1 and errors[0][:2] == (3, 'web')
+    assert errors[0][2].startswith('Invalid Assertions: max_ms')
+
+def test_form_rejects_malformed_assertions(db):
+    from app import web
+    app = Flask(__name__)
+    app.register_blueprint(web)
+    form = {'AlertName': 'web', 'Connection': 'http://web', 'ServiceType': 'HTTP', 'HealthCheck': '/',
+            'Response': '200', 'Description': 'Web', 'Status': 'UP', 'ScheduleTime': '2024-01-01T00:00:00',
+            'Assertions': '[{"body_contains": 5}]'}
+    with app.test_client() as client:
+        response = client.post('/monitor', data=form)
+        assert response.status_code == 400
+        assert b'Invalid Assertions: body_contains' in response.data
+        response = client.post('/monitor/web', data=dict(form, Assertions='not json'))
+        assert response.status_code == 400
+    with db() as conn:
+        assert conn.execute('SELECT COUNT(*) AS n FROM monitors').fetchone()['n'] == 0
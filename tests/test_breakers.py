@@ -0,0 +1,129 @@
+import pytest
+from breakers import HostBreakers, EndpointStats, ADAPTIVE_TIMEOUT_SAMPLES, ADAPTIVE_TIMEOUT_BACKOFF_MAX
+
+def trip(breakers, host='h', now=0):
+    for _ in range(breakers.failures):
+        breakers.record(host, False, now)
+
+def test_circuit_opens_after_consecutive_failures():
+    breakers = HostBreakers(failures=3, open_seconds=30, max_open_seconds=600)
+    breakers.record('h', False, 0)
+    breakers.record('h', False, 0)
+    assert breakers.allow('h', 1)
+    # A success in between starts the count again
+    breakers.record('h', True, 1)
+    breakers.record('h', False, 1)
+    breakers.record('h', False, 1)
+    assert breakers.allow('h', 1) and breakers.open_hosts() == 0
+    breakers.record('h', False, 2)
+    assert not breakers.allow('h', 3)
+    assert breakers.open_hosts() == 1
+    # Other hosts are unaffected
+    assert breakers.allow('other', 3)
+
+def test_half_open_lets_one_trial_through():
+    breakers = HostBreakers(failures=2, open_seconds=30, max_open_seconds=600)
+    trip(breakers)
+    assert not breakers.allow('h', 29)
+    assert breakers.allow('h', 30)
+    # Only one probe while the trial is out
+    assert not breakers.allow('h', 31)
+    # The trial succeeds: closed again
+    breakers.record('h', True, 32)
+    assert breakers.allow('h', 32) and breakers.allow('h', 32)
+    assert breakers.open_hosts() == 0
+
+def test_failed_trial_reopens_for_twice_as_long_up_to_the_maximum():
+    breakers = HostBreakers(failures=2, open_seconds=30, max_open_seconds=100)
+    trip(breakers)
+    assert breakers.allow('h', 30)
+    breakers.record('h', False, 30)
+    assert not breakers.allow('h', 89)
+    assert breakers.allow('h', 90)
+    breakers.record('h', False, 90)
+    assert not breakers.allow('h', 189)
+    assert breakers.allow('h', 190)
+    breakers.record('h', False, 190)
+    # Capped at max_open_seconds
+    assert not breakers.allow('h', 289)
+    assert breakers.allow('h', 290)
+
+def test_lost_trial_is_replaced_after_an_open_period():
+    breakers = HostBreakers(failures=2, open_seconds=30, max_open_seconds=600)
+    trip(breakers)
+    assert breakers.allow('h', 30)
+    assert not breakers.allow('h', 59)
+    assert breakers.allow('h', 60)
+
+def test_disabled_breakers_always_allow():
+    breakers = HostBreakers(failures=0)
+    for _ in range(10):
+        breakers.record('h', False, 0)
+    assert breakers.allow('h', 0) and breakers.open_hosts() == 0
+
+def warm(stats, latency, samples=ADAPTIVE_TIMEOUT_SAMPLES):
+    for _ in range(samples):
+        stats.record('m', 'ok', latency)
+
+def test_timeout_unchanged_until_enough_samples():
+    stats = EndpointStats(adaptive=True, minimum=1)
+    assert stats.timeout('m', (5, 30)) == (5, 30)
+    warm(stats, 0.1, ADAPTIVE_TIMEOUT_SAMPLES - 1)
+    assert stats.timeout('m', (5, 30)) == (5, 30)
+    stats.record('m', 'ok', 0.1)
+    assert stats.timeout('m', (5, 30)) == (1, 1)
+
+def test_timeout_follows_latency_within_bounds():
+    stats = EndpointStats(adaptive=True, minimum=1)
+    warm(stats, 2.0)
+    connect, read = stats.timeout('m', (3, 30))
+    # Smoothed latency plus four deviations (the first is half the latency,
+    # then it decays by a quarter per steady sample), never above the
+    # configuration
+    assert connect == 3
+    assert read == pytest.approx(2.0 + 4 * 1.0 * 0.75 ** (ADAPTIVE_TIMEOUT_SAMPLES - 1))
+    # Never below the minimum, however fast the endpoint
+    fast = EndpointStats(adaptive=True, minimum=1)
+    warm(fast, 0.001, 50)
+    assert fast.timeout('m', (5, 30)) == (1, 1)
+    # Configured timeouts below the minimum are kept
+    assert fast.timeout('m', (0.5, 0.5)) == (0.5, 0.5)
+
+def test_timeouts_back_off_and_reset():
+    stats = EndpointStats(adaptive=True, minimum=1)
+    warm(stats, 0.1)
+    assert stats.timeout('m', (60, 60)) == (1, 1)
+    stats.record('m', 'timeout')
+    assert stats.timeout('m', (60, 60)) == (2, 2)
+    for _ in range(10):
+        stats.record('m', 'timeout')
+    assert stats.timeout('m', (60, 60)) == (ADAPTIVE_TIMEOUT_BACKOFF_MAX, ADAPTIVE_TIMEOUT_BACKOFF_MAX)
+    assert stats.failures('m') == 11
+    stats.record('m', 'ok', 0.1)
+    assert stats.failures('m') == 0
+    assert stats.timeout('m', (60, 60)) == (1, 1)
+
+def test_errors_and_short_circuits_count_as_failures():
+    stats = EndpointStats(adaptive=True, minimum=1)
+    stats.record('m', 'error')
+    stats.short_circuited('m')
+    assert stats.failures('m') == 2
+    # Errors are not slow answers: the timeout does not back off
+    warm(stats, 0.1)
+    stats.record('m', 'error')
+    assert stats.timeout('m', (60, 60)) == (1, 1)
+    stats.forget('m')
+    assert stats.failures('m') == 0
+
+def test_not_adaptive_keeps_configured_timeouts():
+    stats = EndpointStats(adaptive=False, minimum=1)
+    warm(stats, 0.1)
+    assert stats.timeout('m', (5, 30)) == (5, 30)
+
+@pytest.mark.parametrize('latency', [0.5, 3.0, 12.0])
+def test_adaptive_timeout_never_exceeds_configured(latency):
+    stats = EndpointStats(adaptive=True, minimum=1)
+    warm(stats, latency, 20)
+    for _ in range(5):
+        stats.record('m', 'timeout')
+    assert all(value <= limit for value, limit in zip(stats.timeout('m', (4, 10)), (4, 10)))
@@ -0,0 +1,90 @@
+import pytest
+from flask import Flask
+from registry import registry
+
+@pytest.fixture
+def client(db):
+    from api import api
+    registry.load()
+    app = Flask(__name__)
+    app.register_blueprint(api)
+    with app.test_client() as client:
+        yield client
+
+def monitor(name, **fields):
+    return dict({'AlertName': name, 'Connection': f'http://{name}', 'ServiceType': 'HTTP', 'HealthCheck': '/',
+                 'Response': '200', 'Description': name, 'Status': 'UP'}, **fields)
+
+def service(name, status='UP'):
+    return {'AlertName': name, 'ServiceType': 'TCP', 'HostName': 'host', 'CheckStatus': status}
+
+def names(db, table):
+    with db() as conn:
+        return sorted(row['AlertName'] for row in conn.execute(f'SELECT AlertName FROM {table}'))
+
+def results(response):
+    return [(result['action'], result['index'], result['result']) for result in response.get_json()['results']]
+
+def test_applies_upserts_and_deletes(client, db):
+    response = client.post('/api/bulk', json={'monitors': {'upsert': [monitor('a'), monitor('b')]},
+                                              'services': {'upsert': [service('s')]}})
+    assert response.status_code == 200
+    assert response.get_json()['applied'] == 3
+    assert names(db, 'monitors') == ['a', 'b'] and names(db, 'services') == ['s']
+    response = client.post('/api/bulk', json={'monitors': {'upsert': [monitor('a', Status='DOWN')],
+                                                           'delete': ['b', 'missing']}})
+    assert results(response) == [('upsert', 0, 'updated'), ('delete', 0, 'deleted'), ('delete', 1, 'not_found')]
+    assert names(db, 'monitors') == ['a']
+    assert registry.get('monitors', 'a')['Status'] == 'DOWN'
+    assert registry.get('monitors', 'b') is None
+
+def test_atomic_batch_with_an_invalid_item_applies_nothing(client, db):
+    response = client.post('/api/bulk', json={'monitors': {'upsert': [monitor('a'), monitor('b', Frequency='often')]}})
+    assert response.status_code == 422
+    body = response.get_json()
+    assert body['applied'] == 0 and body['failed'] == 1
+    assert results(response) == [('upsert', 0, 'skipped'), ('upsert', 1, 'invalid')]
+    assert names(db, 'monitors') == []
+
+def test_non_atomic_batch_applies_the_valid_items(client, db):
+    response = client.post('/api/bulk', json={'atomic': False, 'monitors': {
+        'upsert': [monitor('a'), monitor('b', Assertions=[{'status': 99}])]}})
+    assert response.status_code == 200
+    assert results(response) == [('upsert', 0, 'created'), ('upsert', 1, 'invalid')]
+    assert 'Invalid Assertions' in response.get_json()['results'][1]['error']
+    assert names(db, 'monitors') == ['a']
+
+def test_duplicate_names_are_invalid(client, db):
+    response = client.post('/api/bulk', json={'atomic': False, 'monitors': {
+        'upsert': [monitor('a'), monitor('a')], 'delete': ['a', 'b', 'b']}})
+    assert results(response) == [('upsert', 0, 'created'), ('upsert', 1, 'invalid'),
+                                 ('delete', 0, 'invalid'), ('delete', 1, 'not_found'), ('delete', 2, 'invalid')]
+    assert {result['error'] for result in response.get_json()['results'] if result['result'] == 'invalid'} == \
+        {"AlertName appears more than once in this batch"}
+    assert names(db, 'monitors') == ['a']
+
+@pytest.mark.parametrize('item', [{'AlertName': 'a'}, ['a'], 5, None, ''])
+def test_invalid_deletes_are_reported_not_raised(client, db, item):
+    response = client.post('/api/bulk', json={'atomic': False, 'services': {
+        'upsert': [service('a')], 'delete': [item, 'b']}})
+    assert response.status_code == 200
+    assert results(response) == [('upsert', 0, 'created'), ('delete', 0, 'invalid'), ('delete', 1, 'not_found')]
+    assert response.get_json()['results'][1]['error'] == "Each delete must be an AlertName"
+
+@pytest.mark.parametrize('item', ['a', {'AlertName': 5}, {'AlertName': ''}, {'Connection': 'x'}])
+def test_invalid_upserts_are_reported(client, db, item):
+    response = client.post('/api/bulk', json={'monitors': {'upsert': [monitor('b'), item]}})
+    assert response.status_code == 422
+    assert response.get_json()['results'][1]['error'] == "Each upsert must be an object with an AlertName"
+
+@pytest.mark.parametrize('body, message', [
+    ([], 'Body must be a JSON object'),
+    ({'hosts': {}}, "Unknown key 'hosts'"),
+    ({'atomic': 'yes'}, 'atomic must be true or false'),
+    ({'monitors': {'upsert': {}}}, 'must be lists'),
+    ({'monitors': {'replace': []}}, 'must be an object with upsert'),
+])
+def test_malformed_requests(client, body, message):
+    response = client.post('/api/bulk', json=body)
+    assert response.status_code == 400
+    assert message in response.get_json()['error']
@@ -0,0 +1,68 @@
+import pytest
+from registry import registry
+from worker import apply_remote_changes, latest_change
+from monitor_schedule import take_schedule_dirty
+
+CHANGES = 'SELECT Seq, AlertName, Kind, Status, PreviousStatus, ChangedAt FROM monitorChanges WHERE Seq > ? ORDER BY Seq'
+
+@pytest.fixture
+def loaded(db):
+    # Another process writes straight to the database; this one replays the
+    # changelog onto its registry
+    registry.load()
+    take_schedule_dirty(timeout=0)
+    yield db
+    take_schedule_dirty(timeout=0)
+
+def replay(db, seq):
+    with db() as conn:
+        rows = conn.execute(CHANGES, (seq,)).fetchall()
+        apply_remote_changes(conn, rows, relay_transitions=True)
+        return rows
+
+def seq_now(db):
+    with db() as conn:
+        return latest_change(conn)
+
+def test_service_changes_are_logged_and_replayed(loaded):
+    seq = seq_now(loaded)
+    with loaded() as conn:
+        with conn:
+            conn.execute("INSERT INTO services (AlertName, ServiceType, HostName, CheckStatus) "
+                         "VALUES ('db', 'TCP', 'host', 'UP')")
+    rows = replay(loaded, seq)
+    assert [(row['AlertName'], row['Kind']) for row in rows] == [('db', 'service')]
+    assert registry.get('services', 'db')['CheckStatus'] == 'UP'
+
+    seq = rows[-1]['Seq']
+    with loaded() as conn:
+        with conn:
+            conn.execute("UPDATE services SET CheckStatus = 'DOWN' WHERE AlertName = 'db'")
+    seq = replay(loaded, seq)[-1]['Seq']
+    assert registry.get('services', 'db')['CheckStatus'] == 'DOWN'
+
+    with loaded() as conn:
+        with conn:
+            conn.execute("DELETE FROM services WHERE AlertName = 'db'")
+    replay(loaded, seq)
+    assert registry.get('services', 'db') is None
+    assert take_schedule_dirty(timeout=0) == ['db']
+
+def test_monitor_edits_and_transitions_are_replayed(loaded):
+    seq = seq_now(loaded)
+    with loaded() as conn:
+        with conn:
+            conn.execute('''INSERT INTO monitors (AlertName, Connection, ServiceType, HealthCheck, Response,
+                                                  Description, Status, CheckTime, ScheduleTime, Frequency)
+                            VALUES ('web', 'http://web', 'HTTP', '/health', '200', '', 'UP',
+                                    '2024-01-01T00:00:00', '2024-01-01T00:00:00', 1)''')
+            conn.execute("UPDATE monitors SET Status = 'DOWN' WHERE AlertName = 'web'")
+    rows = replay(loaded, seq)
+    assert [row['Kind'] for row in rows] == ['config', 'status']
+    assert registry.get('monitors', 'web')['Status'] == 'DOWN'
+
+    with loaded() as conn:
+        with conn:
+            conn.execute("DELETE FROM monitors WHERE AlertName = 'web'")
+    replay(loaded, rows[-1]['Seq'])
+    assert registry.get('monitors', 'web') is None
@@ -0,0 +1,84 @@
+import random
+import pytest
+from history import percentile
+from latency_histogram import count_latencies, pack_bins, unpack_bins, merge_histograms, histogram_percentiles, \
+    pack_segment, read_segment, merge_pairs
+
+def test_percentiles_within_a_percent():
+    rng = random.Random(7)
+    latencies = sorted(rng.lognormvariate(4, 1) for _ in range(5000))
+    fractions = (0.5, 0.95, 0.99)
+    values = histogram_percentiles([pack_bins(count_latencies(latencies))], fractions)
+    for fraction, [value] in zip(fractions, values):
+        exact = percentile(latencies, fraction)
+        assert abs(value - exact) <= 0.011 * exact
+
+def test_merged_buckets_match_the_whole():
+    # The point of the histogram: bucket counts add up, percentiles do not
+    rng = random.Random(3)
+    buckets = [[rng.uniform(10, 100) for _ in range(rng.randint(1, 5))] for _ in range(300)]
+    whole = count_latencies(latency for bucket in buckets for latency in bucket)
+    [merged] = merge_histograms([0] * len(buckets), [pack_bins(count_latencies(bucket)) for bucket in buckets], 1)
+    assert unpack_bins(merged) == whole
+    assert histogram_percentiles([merged], [0.5]) == histogram_percentiles([pack_bins(whole)], [0.5])
+
+def test_merge_by_group():
+    rng = random.Random(5)
+    groups = [rng.randrange(50) for _ in range(2000)]
+    latencies = [[rng.lognormvariate(3, 1) for _ in range(rng.randint(0, 4))] for _ in groups]
+    expected = [{} for _ in range(60)]
+    for group, values in zip(groups, latencies):
+        for index, count in count_latencies(values).items():
+            expected[group][index] = expected[group].get(index, 0) + count
+    histograms = [pack_bins(count_latencies(values)) for values in latencies]
+    merged = merge_histograms(groups, histograms, 60)
+    assert [unpack_bins(packed) for packed in merged] == expected
+    # Groups with nothing to merge stay empty
+    assert merged[55:] == [None] * 5
+
+def test_merge_in_slices(monkeypatch):
+    # Many groups are added up a slice of the dense table at a time
+    import latency_histogram
+    monkeypatch.setattr(latency_histogram, 'MERGE_CELLS', 1000)
+    histograms = [pack_bins(count_latencies([group + 1, 500])) for group in range(300)]
+    merged = merge_histograms(list(range(300)) * 2, histograms * 2, 300)
+    assert [unpack_bins(packed) for packed in merged] == \
+        [{index: count * 2 for index, count in unpack_bins(packed).items()} for packed in histograms]
+
+def test_percentiles_of_many_histograms():
+    rng = random.Random(11)
+    samples = [sorted(rng.uniform(1, 1000) for _ in range(rng.randint(1, 200))) for _ in range(100)]
+    histograms = [pack_bins(count_latencies(latencies)) for latencies in samples]
+    # Empty ones in between must not shift the others
+    histograms[10:10] = [None, float('nan')]
+    samples[10:10] = [[], []]
+    p50, p99 = histogram_percentiles(histograms, (0.5, 0.99))
+    for latencies, median, high in zip(samples, p50, p99):
+        if not latencies:
+            assert median is None and high is None
+            continue
+        assert median == histogram_percentiles([pack_bins(count_latencies(latencies))], [0.5])[0][0]
+        assert high == pytest.approx(percentile(latencies, 0.99), rel=0.011)
+
+def test_empty_and_stored_forms():
+    assert pack_bins({}) is None
+    assert unpack_bins(None) == {}
+    assert merge_histograms([0, 0, 1], [None, float('nan'), b''], 2) == [None, None]
+    assert merge_histograms([], [], 0) == []
+    assert histogram_percentiles([None], [0.5]) == [[None]]
+    assert histogram_percentiles([], [0.5]) == [[]]
+    bins = count_latencies([0, 0.001, 5, 5.01, 60000])
+    packed = pack_bins(bins)
+    assert len(packed) == 6 * len(bins)
+    assert unpack_bins(packed) == bins
+    assert unpack_bins(memoryview(packed)) == bins
+    assert histogram_percentiles([packed], [0, 0.2]) == [[0.01], [0.01]]
+
+def test_segment_form():
+    import numpy as np
+    histograms = [pack_bins(count_latencies([1, 2])), None, pack_bins(count_latencies([2, 2, 90]))]
+    sizes, bins, counts = read_segment(*pack_segment(histograms))
+    assert sizes.tolist() == [2, 0, 2]
+    # Monitors missing from the report (-1) are left out
+    merged = merge_pairs(np.repeat([1, 0, -1], sizes), bins, counts, 2)
+    assert [unpack_bins(packed) for packed in merged] == [{}, count_latencies([1, 2])]
@@ -0,0 +1,63 @@
+import queue
+import pytest
+import monitor_schedule
+from monitor_schedule import apply_schedule_changes, mark_schedule_dirty, take_schedule_dirty
+from events import broadcaster
+
+@pytest.fixture
+def up_monitor(db):
+    with db() as conn:
+        with conn:
+            conn.execute('''INSERT INTO monitors (AlertName, Connection, ServiceType, HealthCheck, Response,
+                                                  Description, Status, CheckTime, ScheduleTime, Frequency)
+                            VALUES ('web', 'http://web', 'HTTP', '/health', '200', '', 'UP',
+                                    '2024-01-01T00:00:00', '2024-01-01T00:00:00', 1)''')
+            conn.execute("INSERT INTO services (AlertName, ServiceType, HostName, CheckStatus) "
+                         "VALUES ('web', 'HTTP', 'host', 'UP')")
+    take_schedule_dirty(timeout=0)
+    return db
+
+def schedule_names(db):
+    with db() as conn:
+        return [row[0] for row in conn.execute('SELECT AlertName FROM monitorSchedule')]
+
+def drain(subscriber):
+    events = []
+    while True:
+        try:
+            events.append(subscriber.queue.get_nowait())
+        except queue.Empty:
+            return events
+
+def test_failed_update_is_retried_and_not_published(up_monitor, monkeypatch):
+    write = monitor_schedule.write_schedule_changes
+
+    def write_then_fail(c, upserts, deletes):
+        write(c, upserts, deletes)
+        raise RuntimeError('database is locked')
+
+    subscriber = broadcaster.subscribe()
+    try:
+        monkeypatch.setattr(monitor_schedule, 'write_schedule_changes', write_then_fail)
+        mark_schedule_dirty(['web'])
+        assert apply_schedule_changes(take_schedule_dirty(timeout=0)) is False
+        # Rolled back, nothing announced, and the name is queued again
+        assert schedule_names(up_monitor) == []
+        assert drain(subscriber) == []
+        names = take_schedule_dirty(timeout=0)
+        assert names == ['web']
+
+        monkeypatch.setattr(monitor_schedule, 'write_schedule_changes', write)
+        assert apply_schedule_changes(names) is True
+        assert schedule_names(up_monitor) == ['web']
+        assert [(kind, data['AlertName']) for _, kind, data in drain(subscriber)] == [('schedule', 'web')]
+    finally:
+        broadcaster.unsubscribe(subscriber)
+
+def test_rows_no_longer_up_are_deleted(up_monitor):
+    assert apply_schedule_changes(['web'])
+    with up_monitor() as conn:
+        with conn:
+            conn.execute("UPDATE monitors SET Status = 'DOWN' WHERE AlertName = 'web'")
+    assert apply_schedule_changes(['web'])
+    assert schedule_names(up_monitor) == []
@@ -0,0 +1,169 @@
+import resource
+import socket
+import threading
+import pytest
+from checker import tcp_probe, udp_probe, ProbeEngine, ProbeCoalescer, ProbeExchange
+
+def monitor(port, health_check='', timeout=1):
+    return {'AlertName': f'test-{port}', 'Connection': f'127.0.0.1:{port}', 'HealthCheck': health_check,
+            'ConnectTimeout': timeout, 'ReadTimeout': timeout}
+
+def free_port(sock_type):
+    with socket.socket(socket.AF_INET, sock_type) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+@pytest.fixture
+def tcp_listener():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.listen()
+    yield sock.getsockname()[1]
+    sock.close()
+
+@pytest.fixture
+def udp_echo():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(0.1)
+    stopping = threading.Event()
+
+    def serve():
+        while not stopping.is_set():
+            try:
+                data, peer = sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            sock.sendto(b'pong ' + data, peer)
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    yield sock.getsockname()[1]
+    stopping.set()
+    thread.join()
+    sock.close()
+
+def test_tcp_accept(tcp_listener):
+    status, latency = tcp_probe(monitor(tcp_listener))
+    assert status == 'UP'
+    assert latency >= 0
+
+def test_tcp_refused():
+    with pytest.raises(ConnectionRefusedError):
+        tcp_probe(monitor(free_port(socket.SOCK_STREAM)))
+
+def test_udp_reply(udp_echo):
+    reply, latency = udp_probe(monitor(udp_echo, 'ping'))
+    assert reply == b'pong ping'
+    assert latency >= 0
+
+def test_udp_timeout():
+    # Bound but never answers
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as silent:
+        silent.bind(('127.0.0.1', 0))
+        with pytest.raises(TimeoutError):
+            udp_probe(monitor(silent.getsockname()[1], 'ping', timeout=0.2))
+
+def test_probe_with_high_descriptor(tcp_listener):
+    # Descriptors past FD_SETSIZE must still be probed
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard != resource.RLIM_INFINITY and hard < 2048:
+        pytest.skip("cannot open descriptors past 1024 here")
+    resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, 2048), hard))
+    held = []
+    try:
+        while not held or held[-1].fileno() < 1100:
+            held.append(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+        assert tcp_probe(monitor(tcp_listener))[0] == 'UP'
+    finally:
+        for sock in held:
+            sock.close()
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+class BlockingProbe:
+    # Holds every probe until released and counts the calls that got through
+    def __init__(self, error=None):
+        self.calls = 0
+        self.error = error
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self._lock = threading.Lock()
+
+    def __call__(self, monitor):
+        with self._lock:
+            self.calls += 1
+        self.started.set()
+        assert self.release.wait(5)
+        if self.error is not None:
+            raise self.error
+        exchange = ProbeExchange('TCP')
+        exchange.status, exchange.latency, exchange.outcome = 'UP', 1.0, None
+        return exchange
+
+def submit_together(coalescer, monitors):
+    # Submits from one thread per monitor, all at once
+    barrier = threading.Barrier(len(monitors))
+    futures = [None] * len(monitors)
+
+    def submit(index):
+        barrier.wait()
+        futures[index] = coalescer.submit(monitors[index])
+
+    threads = [threading.Thread(target=submit, args=(index,)) for index in range(len(monitors))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return futures
+
+def tcp_monitor(name, connection='db:5432'):
+    return {'AlertName': name, 'ServiceType': 'TCP', 'Connection': connection}
+
+def test_identical_probes_share_one_call():
+    probe = BlockingProbe()
+    coalescer = ProbeCoalescer(ProbeEngine(probe, max_workers=4), window=60)
+    try:
+        futures = submit_together(coalescer, [tcp_monitor(f'db-{i}') for i in range(20)])
+        assert probe.started.wait(5)
+        assert not any(future.done() for future in futures)
+        probe.release.set()
+        results = [future.result(timeout=5) for future in futures]
+        assert probe.calls == 1
+        # Each waiter gets its own verdict on the shared probe
+        assert [result['AlertName'] for result in results] == [f'db-{i}' for i in range(20)]
+        assert {result['Status'] for result in results} == {'UP'}
+        # Still fresh: answered from the finished probe
+        assert coalescer.submit(tcp_monitor('late')).result(timeout=5)['Status'] == 'UP'
+        assert probe.calls == 1
+        # A different target gets its own probe
+        coalescer.submit(tcp_monitor('other', 'cache:6379')).result(timeout=5)
+        assert probe.calls == 2
+    finally:
+        probe.release.set()
+        coalescer.shutdown()
+
+def test_probe_error_reaches_every_waiter():
+    probe = BlockingProbe(error=ConnectionResetError('reset'))
+    coalescer = ProbeCoalescer(ProbeEngine(probe, max_workers=4), window=60)
+    try:
+        futures = submit_together(coalescer, [tcp_monitor(f'db-{i}') for i in range(10)])
+        assert probe.started.wait(5)
+        probe.release.set()
+        for future in futures:
+            with pytest.raises(ConnectionResetError):
+                future.result(timeout=5)
+        assert probe.calls == 1
+    finally:
+        probe.release.set()
+        coalescer.shutdown()
+
+def test_coalescing_off_probes_every_check():
+    probe = BlockingProbe()
+    probe.release.set()
+    coalescer = ProbeCoalescer(ProbeEngine(probe, max_workers=4), window=0)
+    try:
+        for future in submit_together(coalescer, [tcp_monitor(f'db-{i}') for i in range(5)]):
+            future.result(timeout=5)
+        assert probe.calls == 5
+    finally:
+        coalescer.shutdown()
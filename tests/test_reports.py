@@ -0,0 +1,89 @@
+import json
+import random
+import pytest
+from history import percentile, run_history_maintenance_once, get_uptime
+from latency_histogram import count_latencies, unpack_bins
+from migrations import pack_latency_histograms
+from registry import registry
+from reports import uptime_report, segment_cache, DAY, HOUR
+
+NOW = 1_700_006_400 + 3 * DAY + 120
+
+@pytest.fixture
+def history(db):
+    # Three days of checks every ten minutes for two monitors, rolled up and
+    # summarized; returns the raw latencies per monitor
+    segment_cache._entries.clear()
+    rng = random.Random(1)
+    latencies = {'api': [], 'web': []}
+    rows = []
+    for name, mu in (('api', 3), ('web', 5)):
+        for checked in range(NOW - 3 * DAY - 60, NOW - 60, 600):
+            latency = rng.lognormvariate(mu, 0.5)
+            latencies[name].append(latency)
+            rows.append((name, checked, latency, 200, 1))
+    with db() as conn:
+        with conn:
+            conn.executemany('INSERT INTO checkHistory (AlertName, CheckedAt, LatencyMs, StatusCode, Up) '
+                             'VALUES (?, ?, ?, ?, ?)', rows)
+            for name, service_type in (('api', 'HTTP'), ('web', 'HTTP')):
+                conn.execute('''INSERT INTO monitors (AlertName, Connection, ServiceType, HealthCheck, Response,
+                                                      Description, Status, CheckTime, ScheduleTime, Frequency)
+                                VALUES (?, '', ?, '', '', '', 'UP', '', '', 10)''', (name, service_type))
+    registry.load()
+    run_history_maintenance_once(NOW)
+    yield latencies
+    segment_cache._entries.clear()
+
+def test_window_percentiles_match_raw_history(history, db):
+    with db() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM latencyDaily').fetchone()[0] == 3
+    since, until = NOW - 120 - 2 * DAY, NOW - 120
+    rows = {row['AlertName']: row for row in uptime_report(since, until)}
+    for name, values in history.items():
+        exact = sorted(values[(len(values) - 2 * 144):])
+        assert rows[name]['Checks'] == len(exact)
+        for fraction, column in ((0.5, 'LatencyP50'), (0.95, 'LatencyP95'), (0.99, 'LatencyP99')):
+            assert rows[name][column] == pytest.approx(percentile(exact, fraction), rel=0.011)
+    # Served from the segment cache the second time, with the same result
+    assert {row['AlertName']: row for row in uptime_report(since, until)} == rows
+
+def test_grouped_percentiles_merge_monitors(history):
+    since, until = NOW - 120 - 2 * DAY, NOW - 120
+    [group] = uptime_report(since, until, 'type')
+    values = sorted(value for latencies in history.values() for value in latencies[-2 * 144:])
+    assert group['Monitors'] == 2 and group['Checks'] == len(values)
+    assert group['LatencyP50'] == pytest.approx(percentile(values, 0.5), rel=0.011)
+
+def test_single_monitor_uptime_from_rollups(history):
+    result = get_uptime('web', NOW - 3 * DAY - HOUR, NOW)
+    values = sorted(history['web'])
+    assert result['Checks'] == len(values)
+    assert result['LatencyP95'] == pytest.approx(percentile(values, 0.95), rel=0.011)
+
+def test_json_histograms_are_packed(db):
+    # As left by migration 8: JSON text per rollup and summary row
+    bins = count_latencies([1, 2, 2, 300])
+    text = json.dumps({str(index): count for index, count in bins.items()})
+    with db() as conn:
+        c = conn.cursor()
+        for table in ('checkRollup1m', 'uptimeDaily'):
+            c.execute(f'ALTER TABLE {table} ADD COLUMN LatencyBins TEXT')
+        c.execute('''INSERT INTO checkRollup1m (AlertName, BucketStart, Checks, Failures, LatencyBins)
+                     VALUES ('a', 60, 4, 0, ?)''', (text,))
+        for name in ('a', 'b'):
+            c.execute('''INSERT INTO uptimeDaily (AlertName, SegmentStart, Checks, Failures, DownSeconds, Outages,
+                                                  StartsDown, EndsDown, LatencyBins)
+                         VALUES (?, 0, 4, 0, 0, 0, 0, 0, ?)''', (name, text if name == 'a' else None))
+        for table in ('uptimeDaily', 'uptimeHourly', 'checkRollup1m'):
+            c.execute('INSERT INTO rollupState (RollupTable, RolledUntil) VALUES (?, ?)', (table, DAY))
+        conn.commit()
+        pack_latency_histograms(c)
+        conn.commit()
+        assert unpack_bins(c.execute('SELECT LatencyHistogram FROM checkRollup1m').fetchone()[0]) == bins
+        names, sizes, _, _ = c.execute('SELECT AlertNames, Sizes, Bins, Counts FROM latencyDaily').fetchone()
+        assert json.loads(names) == ['a'] and len(sizes) == 4
+        assert 'LatencyBins' not in [column[1] for column in c.execute('PRAGMA table_info(uptimeDaily)')]
+    segment_cache._entries.clear()
+    [row] = [row for row in uptime_report(0, DAY) if row['AlertName'] == 'a']
+    assert row['LatencyP50'] == pytest.approx(2, rel=0.011)
@@ -0,0 +1,138 @@
+from datetime import datetime
+import pytest
+import scheduler
+from scheduler import CheckScheduler, backoff_interval, parse_frequency, CHECK_BACKOFF_MAX_SECONDS
+
+START = 1_700_000_000.0
+
+class Clock:
+    # Stands in for the time module inside scheduler.py
+    def __init__(self):
+        self.now = START
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scheduler, 'time', clock)
+    return clock
+
+def monitor(name, frequency=1, checked_at=None):
+    return {'AlertName': name, 'Frequency': frequency,
+            'CheckTime': None if checked_at is None else datetime.fromtimestamp(checked_at).isoformat()}
+
+def test_due_in_order(clock):
+    checks = CheckScheduler(jitter=0)
+    # Checked a minute ago minus the offset: due that many seconds from now
+    checks.load([monitor('c', checked_at=START - 55), monitor('a', checked_at=START - 59),
+                 monitor('b', checked_at=START - 57)])
+    assert checks.wait_due(timeout=0) == []
+    assert checks.next_due() == pytest.approx(START + 1)
+    clock.now += 10
+    due = checks.wait_due(timeout=0)
+    assert [m['AlertName'] for m in due] == ['a', 'b', 'c']
+    assert [m['_due'] for m in due] == pytest.approx([START + 1, START + 3, START + 5])
+    # In flight until rescheduled
+    assert checks.wait_due(timeout=0) == []
+    assert checks.overdue() == 0
+
+def test_jitter_bounds(clock):
+    checks = CheckScheduler(jitter=0.1)
+    checks.load([monitor(f'm{i}', checked_at=START) for i in range(300)])
+    clock.now += 120
+    due = [m['_due'] - (START + 60) for m in checks.wait_due(timeout=0)]
+    assert len(due) == 300
+    assert all(-6 <= offset <= 6 for offset in due)
+    assert max(due) - min(due) > 6
+
+def test_overdue_monitors_spread_over_jitter_window(clock):
+    checks = CheckScheduler(jitter=0.1)
+    checks.load([monitor(f'm{i}') for i in range(300)])
+    clock.now += 120
+    # Never checked: due between now and one jitter window (6s) later,
+    # each pushed with its own jitter
+    assert all(START - 6 <= m['_due'] <= START + 12 for m in checks.wait_due(timeout=0))
+
+def test_backoff_interval():
+    assert backoff_interval(60, 0) == 60
+    assert backoff_interval(60, scheduler.CHECK_BACKOFF_AFTER) == 60
+    assert backoff_interval(60, scheduler.CHECK_BACKOFF_AFTER + 1) == min(120, CHECK_BACKOFF_MAX_SECONDS)
+    assert backoff_interval(60, scheduler.CHECK_BACKOFF_AFTER + 40) == max(60, CHECK_BACKOFF_MAX_SECONDS)
+    # Never below the monitor's own frequency
+    assert backoff_interval(CHECK_BACKOFF_MAX_SECONDS * 2, 50) == CHECK_BACKOFF_MAX_SECONDS * 2
+
+def test_reschedule_applies_backoff(clock):
+    checks = CheckScheduler(jitter=0)
+    checks.load([monitor('a', checked_at=START - 60)])
+    popped = checks.wait_due(timeout=0)[0]
+    checks.reschedule(popped, 'DOWN', failures=scheduler.CHECK_BACKOFF_AFTER + 1)
+    assert checks.next_due() == pytest.approx(START + backoff_interval(60, scheduler.CHECK_BACKOFF_AFTER + 1))
+
+def test_upsert_replaces_entry_in_heap(clock):
+    checks = CheckScheduler(jitter=0)
+    checks.load([monitor('a', checked_at=START - 30)])
+    checks.upsert(monitor('a', frequency=2, checked_at=START - 110))
+    assert len(checks) == 1
+    assert checks.next_due() == pytest.approx(START + 10)
+    clock.now += 100
+    due = checks.wait_due(timeout=0)
+    # The superseded heap item is skipped
+    assert len(due) == 1
+    assert due[0]['Frequency'] == 2
+
+def test_upsert_during_check_wins_over_reschedule(clock):
+    checks = CheckScheduler(jitter=0)
+    checks.load([monitor('a', checked_at=START - 60)])
+    popped = checks.wait_due(timeout=0)[0]
+    checks.upsert(monitor('a', frequency=5, checked_at=START))
+    checks.reschedule(popped, 'UP')
+    assert checks.next_due() == pytest.approx(START + 300)
+
+def test_remove(clock):
+    checks = CheckScheduler(jitter=0)
+    checks.load([monitor('a', checked_at=START - 60), monitor('b', checked_at=START - 60)])
+    checks.remove('a')
+    checks.remove('missing')
+    assert 'a' not in checks and len(checks) == 1
+    popped = checks.wait_due(timeout=0)
+    assert [m['AlertName'] for m in popped] == ['b']
+    # A check that finishes after its monitor was deleted is not rescheduled
+    checks.remove('b')
+    checks.reschedule(popped[0], 'UP')
+    assert len(checks) == 0 and checks.next_due() is None
+
+def test_parse_frequency():
+    assert parse_frequency('5') == 5
+    assert parse_frequency('0.5') == 0.5
+    with pytest.raises(ValueError):
+        parse_frequency('often')
+    with pytest.raises(ValueError):
+        parse_frequency(scheduler.MIN_CHECK_INTERVAL / 120)
+
+def test_upserts_ignored_until_loaded(clock):
+    # The web process with CHECKER_EMBEDDED=0 never takes checks off its
+    # scheduler, so it must not hold the monitors it is told about
+    checks = CheckScheduler(jitter=0)
+    checks.upsert_many([monitor(f'm{i}') for i in range(100)])
+    assert len(checks) == 0 and checks._heap == []
+    checks.load([])
+    checks.upsert(monitor('a'))
+    assert 'a' in checks
+
+def test_superseded_items_are_compacted(clock):
+    checks = CheckScheduler(jitter=0)
+    checks.load([monitor(f'm{i}', checked_at=START) for i in range(100)])
+    for _ in range(50):
+        checks.upsert_many([monitor(f'm{i}', checked_at=START) for i in range(100)])
+    assert len(checks._heap) <= 3 * 100 + 1024
+    for i in range(100):
+        checks.remove(f'm{i}')
+    checks.upsert_many([monitor(f'n{i}', checked_at=START) for i in range(2000)])
+    assert len(checks._heap) <= 2 * len(checks) + 1024
+    clock.now += 120
+    assert len(checks.wait_due(timeout=0)) == 2000
@@ -0,0 +1,176 @@
+import json
+import re
+import sqlite3
+import threading
+import pytest
+from sqlalchemy import table, column, bindparam, any_, select
+from sqlalchemy.dialects import postgresql, mysql, sqlite
+import storage
+from storage import translate, upsert_sql, in_list, chunked_delete_sql, Connection
+
+COLUMNS = ['AlertName', 'Status', 'HostName']
+SCHEDULE = table('monitorSchedule', *(column(name) for name in COLUMNS))
+
+def normalize(sql):
+    # Compare statements without quoting, placeholder style or spacing
+    sql = re.sub(r'%\(\w+\)s|%s', '?', str(sql))
+    sql = re.sub(r'["`]', '', sql)
+    sql = re.sub(r'\s*([=(),])\s*', r'\1', sql)
+    return re.sub(r'\s+', ' ', sql).strip()
+
+def values(module):
+    return module.insert(SCHEDULE).values({name: bindparam(name) for name in COLUMNS})
+
+@pytest.fixture
+def dialect(monkeypatch):
+    def use(name):
+        monkeypatch.setattr(storage, 'DIALECT', name)
+    return use
+
+def test_translate_placeholders():
+    assert translate('SELECT * FROM monitors WHERE AlertName = ? AND Status IN (?, ?)') == \
+        'SELECT * FROM monitors WHERE AlertName = %s AND Status IN (%s, %s)'
+
+def test_translate_leaves_literals_alone():
+    sql = "SELECT '?' AS q, 'it''s 100%' AS p FROM monitors WHERE Connection LIKE ? AND x = '%?'"
+    assert translate(sql) == \
+        "SELECT '?' AS q, 'it''s 100%%' AS p FROM monitors WHERE Connection LIKE %s AND x = '%%?'"
+
+@pytest.mark.parametrize('module', [postgresql, sqlite])
+def test_upsert_on_conflict(dialect, module):
+    dialect(module.dialect.name)
+    statement = values(module)
+    expected = statement.on_conflict_do_update(
+        index_elements=['AlertName'],
+        set_={name: statement.excluded[name] for name in COLUMNS[1:]})
+    assert normalize(translate(upsert_sql('monitorSchedule', COLUMNS, ['AlertName']))) == \
+        normalize(expected.compile(dialect=module.dialect()))
+
+@pytest.mark.parametrize('module', [postgresql, sqlite])
+def test_upsert_on_conflict_do_nothing(dialect, module):
+    dialect(module.dialect.name)
+    expected = values(module).on_conflict_do_nothing(index_elements=['AlertName'])
+    assert normalize(translate(upsert_sql('monitorSchedule', COLUMNS, ['AlertName'], []))) == \
+        normalize(expected.compile(dialect=module.dialect()))
+
+def test_upsert_mysql(dialect):
+    dialect('mysql')
+    statement = values(mysql)
+    expected = statement.on_duplicate_key_update({name: statement.inserted[name] for name in ['Status']})
+    assert normalize(translate(upsert_sql('monitorSchedule', COLUMNS, ['AlertName'], ['Status']))) == \
+        normalize(expected.compile(dialect=mysql.dialect()))
+
+def test_upsert_mysql_ignore(dialect):
+    dialect('mysql')
+    expected = values(mysql).prefix_with('IGNORE')
+    assert normalize(translate(upsert_sql('monitorSchedule', COLUMNS, ['AlertName'], []))) == \
+        normalize(expected.compile(dialect=mysql.dialect()))
+
+def test_upsert_sqlite_runs():
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE monitorSchedule (AlertName TEXT PRIMARY KEY, Status TEXT, HostName TEXT)')
+    db.execute(upsert_sql('monitorSchedule', COLUMNS, ['AlertName']), ('a', 'DOWN', 'h1'))
+    db.execute(upsert_sql('monitorSchedule', COLUMNS, ['AlertName']), ('a', 'UP', 'h2'))
+    db.execute(upsert_sql('monitorSchedule', COLUMNS, ['AlertName'], ['Status']), ('a', 'DOWN', 'h3'))
+    assert db.execute('SELECT * FROM monitorSchedule').fetchall() == [('a', 'DOWN', 'h2')]
+
+def test_in_list_postgresql(dialect):
+    # psycopg2 adapts a list parameter to an ARRAY
+    dialect('postgresql')
+    condition, param = in_list('AlertName', ('a', 'b'))
+    expected = select(SCHEDULE.c.AlertName).where(SCHEDULE.c.AlertName == any_(bindparam('v')))
+    assert normalize(expected.compile(dialect=postgresql.dialect())).endswith(
+        normalize(translate('monitorSchedule.' + condition)))
+    assert param == ['a', 'b']
+
+def test_in_list_mysql(dialect):
+    dialect('mysql')
+    condition, param = in_list('AlertName', iter(['a', "b'c"]))
+    assert translate(condition).count('%s') == 1
+    assert json.loads(param) == ['a', "b'c"]
+
+def test_in_list_sqlite_runs(dialect):
+    dialect('sqlite')
+    db = sqlite3.connect(':memory:')
+    db.execute('CREATE TABLE monitors (AlertName TEXT)')
+    db.executemany('INSERT INTO monitors VALUES (?)', [(f'm{i}',) for i in range(2000)])
+    names = [f'm{i}' for i in range(0, 2000, 2)]
+    condition, param = in_list('AlertName', names)
+    assert db.execute(f'SELECT COUNT(*) FROM monitors WHERE {condition}', (param,)).fetchone()[0] == 1000
+
+def test_chunked_delete_params(dialect):
+    for name in ('mysql', 'postgresql', 'sqlite'):
+        dialect(name)
+        assert translate(chunked_delete_sql('checkHistory', 'CheckedAt')).count('%s') == 2
+
+class FakeCursor:
+    # Records what the wrapper hands a format-style driver; answers with
+    # lower-cased column names as PostgreSQL does
+    def __init__(self, rows):
+        self.calls = []
+        self.rows = list(rows)
+        self.description = None
+        self.rowcount = -1
+
+    def execute(self, sql, params):
+        self.calls.append((sql, params))
+        self.description = [('alertname',), ('status',)]
+
+    def executemany(self, sql, params):
+        self.calls.append((sql, params))
+        self.description = None
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchall(self):
+        rows, self.rows = self.rows, []
+        return rows
+
+class FakeConnection:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.committed = self.rolled_back = 0
+
+    def cursor(self):
+        return self._cursor
+
+    def commit(self):
+        self.committed += 1
+
+    def rollback(self):
+        self.rolled_back += 1
+
+def test_connection_wrapper(dialect):
+    dialect('mysql')
+    cursor = FakeCursor([('a', 'UP'), ('b', 'DOWN')])
+    raw = FakeConnection(cursor)
+    conn = Connection(raw)
+    with conn:
+        rows = conn.execute('SELECT AlertName, Status FROM monitors WHERE AlertName IN (?, ?)', ['a', 'b']).fetchall()
+        conn.executemany('UPDATE monitors SET Status=? WHERE AlertName=?', [['UP', 'a']])
+    assert cursor.calls == [('SELECT AlertName, Status FROM monitors WHERE AlertName IN (%s, %s)', ('a', 'b')),
+                            ('UPDATE monitors SET Status=%s WHERE AlertName=%s', [('UP', 'a')])]
+    assert [(row['AlertName'], row['status'], row[1]) for row in rows] == [('a', 'UP', 'UP'), ('b', 'DOWN', 'DOWN')]
+    assert rows[0].keys() == ['AlertName', 'Status']
+    assert raw.committed == 1
+    with pytest.raises(RuntimeError):
+        with conn:
+            raise RuntimeError
+    assert raw.rolled_back == 1
+
+def test_write_transaction_records_lock_wait(db):
+    waits = storage.lock_waits._values.get(('test',), 0)
+    with db() as holder, db() as writer:
+        holder.execute('BEGIN IMMEDIATE')
+        releaser = threading.Timer(0.2, holder.commit)
+        releaser.start()
+        with storage.write_transaction(writer, 'test'):
+            writer.execute("INSERT INTO monitorChanges (AlertName, Kind, ChangedAt) VALUES ('a', 'config', 0)")
+        releaser.join()
+        # Uncontended: timed, but not counted as a wait
+        with storage.write_transaction(writer, 'test'):
+            writer.execute("DELETE FROM monitorChanges")
+    assert storage.lock_waits._values[('test',)] == waits + 1
+    state = storage.lock_wait._values[('test',)]
+    assert sum(state[:-1]) >= 2 and state[-1] >= 0.15
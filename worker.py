@@ -0,0 +1,275 @@
+import bisect
+import hashlib
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime
+from dotenv import load_dotenv
+
+# Settings below and in the checker modules are read at import time
+load_dotenv()
+
+from storage import get_db_connection, upsert_sql, in_list, write_transaction, count_lock_error
+from migrations import ensure_schema
+from history import delete_before, CHANGELOG_RETENTION_SECONDS
+from monitor_schedule import mark_schedule_dirty, schedule_changed
+from checker import ProbeCoalescer, record_result, instrument_checker
+from registry import registry, MONITOR_SELECT, SERVICE_SELECT
+from scheduler import CheckScheduler, check_scheduler
+from result_writer import result_writer
+from alerts import flap_detector, alert_dispatcher
+from breakers import endpoint_stats
+from assertions import assertion_cache
+from resolver import dns_cache
+from events import broadcaster
+from metrics import serve_metrics, WORKER_METRICS_PORT
+
+# Run the checker inside the web process (the default). Set to 0 when
+# checks are run by one or more `python worker.py` processes instead.
+CHECKER_EMBEDDED = os.getenv('CHECKER_EMBEDDED', '1') == '1'
+# Workers refresh their lease this often; a worker whose lease is older
+# than WORKER_LEASE_SECONDS is considered dead and its monitors move on
+WORKER_HEARTBEAT_SECONDS = float(os.getenv('WORKER_HEARTBEAT_SECONDS', '5'))
+WORKER_LEASE_SECONDS = float(os.getenv('WORKER_LEASE_SECONDS', '15'))
+# How often workers (and the web process) read the monitor changelog
+WORKER_POLL_SECONDS = float(os.getenv('WORKER_POLL_SECONDS', '2'))
+# How often the web process copies check results written by workers into
+# its registry
+REGISTRY_REFRESH_SECONDS = float(os.getenv('REGISTRY_REFRESH_SECONDS', '60'))
+# Points per worker on the hash ring; more points even out shard sizes
+WORKER_VNODES = 64
+CHANGELOG_BATCH = 5000
+
+HEARTBEAT_UPSERT = upsert_sql('checkerWorkers', ['WorkerId', 'HostName', 'StartedAt', 'HeartbeatAt'],
+                              ['WorkerId'], ['HeartbeatAt'])
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+class HashRing:
+    # Consistent hashing of AlertName onto worker ids: when a worker joins or
+    # leaves, only the monitors on its arcs of the ring change owner
+
+    def __init__(self, nodes, vnodes=WORKER_VNODES):
+        points = sorted((ring_hash(f'{node}#{i}'), node) for node in nodes for i in range(vnodes))
+        self._keys = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owner(self, key):
+        if not self._keys:
+            return None
+        return self._nodes[bisect.bisect(self._keys, ring_hash(key)) % len(self._keys)]
+
+def latest_change(conn):
+    return conn.execute('SELECT COALESCE(MAX(Seq), 0) FROM monitorChanges').fetchone()[0]
+
+class CheckerWorker:
+    # Checks the shard of monitors the hash ring assigns to this worker. The
+    # ring is built from the live lease rows in checkerWorkers, so every
+    # worker derives the same assignment without talking to the others.
+
+    def __init__(self, worker_id=None, engine=None, writer=None):
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+        self.scheduler = CheckScheduler()
+        # Starts empty and is filled by settle() as monitors are assigned here
+        self.scheduler.load([])
+        self.engine = engine or ProbeCoalescer()
+        self.writer = writer or result_writer
+        self.members = ()
+        self.ring = HashRing([])
+        self.change_seq = 0
+        self.settle_at = None
+        self._stopping = threading.Event()
+
+    def owns(self, alert_name):
+        return self.ring.owner(alert_name) == self.worker_id
+
+    def heartbeat(self, conn, now):
+        with write_transaction(conn, 'worker'):
+            conn.execute(HEARTBEAT_UPSERT, (self.worker_id, socket.gethostname(), now, now))
+            conn.execute('DELETE FROM checkerWorkers WHERE HeartbeatAt < ?', (now - WORKER_LEASE_SECONDS,))
+        return tuple(row[0] for row in conn.execute('SELECT WorkerId FROM checkerWorkers ORDER BY WorkerId'))
+
+    def rebalance(self, members, now):
+        self.members = members
+        self.ring = HashRing(members)
+        # Monitors moving away are dropped now. Monitors moving here are only
+        # picked up after one heartbeat (see settle), once their old owner has
+        # seen the new membership and written its last result, so no check
+        # runs twice.
+        for name in self.scheduler.names():
+            if not self.owns(name):
+                self.scheduler.remove(name)
+                flap_detector.forget(name)
+                endpoint_stats.forget(name)
+                assertion_cache.forget(name)
+        self.settle_at = now + WORKER_HEARTBEAT_SECONDS
+
+    def settle(self, conn):
+        # Monitors already scheduled here keep their due times
+        c = conn.execute(MONITOR_SELECT)
+        self.scheduler.upsert_many([dict(row) for row in c
+                                    if self.owns(row['AlertName']) and row['AlertName'] not in self.scheduler])
+        self.settle_at = None
+        print(f"Worker {self.worker_id}: {len(self.members)} workers, checking {len(self.scheduler)} monitors")
+
+    def apply_changes(self, conn):
+        while True:
+            rows = conn.execute('''SELECT Seq, AlertName FROM monitorChanges
+                                   WHERE Seq > ? AND Kind IN ('config', 'delete')
+                                   ORDER BY Seq LIMIT ?''', (self.change_seq, CHANGELOG_BATCH)).fetchall()
+            if not rows:
+                return
+            self.change_seq = rows[-1]['Seq']
+            names = [name for name in {row['AlertName'] for row in rows} if self.owns(name)]
+            if names:
+                condition, param = in_list('AlertName', names)
+                c = conn.execute(f'{MONITOR_SELECT} WHERE {condition}', (param,))
+                monitors = [dict(row) for row in c]
+                self.scheduler.upsert_many(monitors)
+                for name in set(names) - {monitor['AlertName'] for monitor in monitors}:
+                    self.scheduler.remove(name)
+                    flap_detector.forget(name)
+                    assertion_cache.forget(name)
+                # Edited or removed targets start without latency history
+                for name in names:
+                    endpoint_stats.forget(name)
+            if len(rows) < CHANGELOG_BATCH:
+                return
+
+    def prune(self, conn, now):
+        delete_before(conn, 'monitorChanges', 'ChangedAt', now - CHANGELOG_RETENTION_SECONDS)
+
+    def coordinate(self):
+        next_heartbeat = 0
+        with get_db_connection() as conn:
+            self.change_seq = latest_change(conn)
+            while not self._stopping.is_set():
+                try:
+                    now = time.time()
+                    if now >= next_heartbeat:
+                        members = self.heartbeat(conn, now)
+                        if members != self.members:
+                            self.rebalance(members, now)
+                        elif self.settle_at is not None and now >= self.settle_at:
+                            self.settle(conn)
+                        self.prune(conn, now)
+                        next_heartbeat = now + WORKER_HEARTBEAT_SECONDS
+                    self.apply_changes(conn)
+                except Exception as e:
+                    count_lock_error('worker', e)
+                    print(f"Error coordinating worker {self.worker_id}: {str(e)}")
+                self._stopping.wait(WORKER_POLL_SECONDS)
+
+    def run(self):
+        self.writer.start()
+        alert_dispatcher.start()
+        dns_cache.start()
+        instrument_checker(self.engine, self.scheduler)
+        coordinator = threading.Thread(target=self.coordinate, name='worker-coordinator', daemon=True)
+        coordinator.start()
+        try:
+            while not self._stopping.is_set():
+                for monitor in self.scheduler.wait_due(timeout=1):
+                    future = self.engine.submit(monitor)
+                    future.add_done_callback(
+                        lambda f, monitor=monitor: record_result(monitor, f, self.scheduler, self.writer))
+        finally:
+            self._stopping.set()
+            coordinator.join()
+            self.engine.shutdown()
+            self.writer.stop()
+            self.leave()
+
+    def stop(self):
+        self._stopping.set()
+
+    def leave(self):
+        # Dropping the lease lets the other workers take over right away
+        # instead of waiting for it to expire
+        with get_db_connection() as conn:
+            with conn:
+                conn.execute('DELETE FROM checkerWorkers WHERE WorkerId=?', (self.worker_id,))
+
+def refresh_registry(conn, alert_names):
+    # Re-reads the named monitors; returns the ones that still exist
+    condition, param = in_list('AlertName', alert_names)
+    monitors = [dict(row) for row in conn.execute(f'{MONITOR_SELECT} WHERE {condition}', (param,))]
+    registry.put_many('monitors', monitors)
+    for name in set(alert_names) - {monitor['AlertName'] for monitor in monitors}:
+        registry.remove('monitors', name)
+    return monitors
+
+def refresh_services(conn, alert_names):
+    condition, param = in_list('AlertName', alert_names)
+    services = [dict(row) for row in conn.execute(f'{SERVICE_SELECT} WHERE {condition}', (param,))]
+    registry.put_many('services', services)
+    for name in set(alert_names) - {service['AlertName'] for service in services}:
+        registry.remove('services', name)
+
+def apply_remote_changes(conn, rows, relay_transitions):
+    monitor_names = list({row['AlertName'] for row in rows if row['Kind'] != 'service'})
+    service_names = list({row['AlertName'] for row in rows if row['Kind'] == 'service'})
+    if monitor_names:
+        monitors = refresh_registry(conn, monitor_names)
+        if check_scheduler.loaded:
+            # The embedded checker runs here: edits made through other web
+            # processes must reach it too
+            edited = {row['AlertName'] for row in rows if row['Kind'] in ('config', 'delete')}
+            check_scheduler.upsert_many([monitor for monitor in monitors if monitor['AlertName'] in edited])
+            for name in edited - {monitor['AlertName'] for monitor in monitors}:
+                check_scheduler.remove(name)
+    if service_names:
+        refresh_services(conn, service_names)
+    mark_schedule_dirty(monitor_names + service_names)
+    if relay_transitions:
+        for row in rows:
+            if row['Kind'] == 'status':
+                broadcaster.publish('monitor', {'AlertName': row['AlertName'],
+                                                'Status': row['Status'],
+                                                'PreviousStatus': row['PreviousStatus'],
+                                                'CheckTime': datetime.fromtimestamp(row['ChangedAt']).isoformat()})
+
+def follow_changes(seq, relay_transitions):
+    # Runs in every web process. The registry belongs to one process, so
+    # edits, status changes and service changes made by any other process
+    # (another web process, an import elsewhere, workers) are replayed onto
+    # it from monitorChanges, starting after seq. relay_transitions: this
+    # process has no checker of its own feeding it, so status transitions
+    # also become page events and check times are copied every
+    # REGISTRY_REFRESH_SECONDS.
+    refreshed = time.monotonic()
+    with get_db_connection() as conn:
+        while True:
+            try:
+                rows = conn.execute('''SELECT Seq, AlertName, Kind, Status, PreviousStatus, ChangedAt
+                                       FROM monitorChanges WHERE Seq > ?
+                                       ORDER BY Seq LIMIT ?''', (seq, CHANGELOG_BATCH)).fetchall()
+                if rows:
+                    seq = rows[-1]['Seq']
+                    apply_remote_changes(conn, rows, relay_transitions)
+                    if len(rows) == CHANGELOG_BATCH:
+                        continue
+                if relay_transitions and time.monotonic() - refreshed >= REGISTRY_REFRESH_SECONDS:
+                    registry.update_results(conn.execute('SELECT Status, CheckTime, AlertName FROM monitors'))
+                    # Workers also write LastCheckTime into monitorSchedule
+                    schedule_changed()
+                    refreshed = time.monotonic()
+            except Exception as e:
+                print(f"Error reading monitor changes: {str(e)}")
+            time.sleep(WORKER_POLL_SECONDS)
+
+if __name__ == '__main__':
+    ensure_schema()
+    if WORKER_METRICS_PORT:
+        serve_metrics(WORKER_METRICS_PORT)
+    worker = CheckerWorker()
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop())
+    print(f"Starting checker worker {worker.worker_id}")
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()